@@ -1,276 +1,584 @@
-# for different types of commands in the processor/assembler
-types = {
-    'R' : ['add','sub','sll','slt','sltu','xor','srl','or','and', 'mul'],
-    'I' : ['lw','addi','sltiu','jalr'],
-    'S' : ['sw'],
-    'B' : ['beq','bne','blt','bge','bltu','bgeu'],
-    'U' : ['lui', 'auipc'],
-    'J' : ['jal'],
-}
-# for determining the variation in the same instruction in function field that helps in decoding the assembly code 
-funct3s = {
-    'add' : '000', 'sub' : '000', 'sll' : '001', 'slt' : '010', 'sltu' : '011', 'xor' : '100', 'srl' : '101', 'or' : '110', 'and' : '111', 'mul' : '111',
-    'lw' : '010', 'addi' : '000', 'sltiu' : '011', 'jalr' : '000', 
-    'sw' : '010',
-    'beq' : '000', 'bne' : '001', 'blt' : '100', 'bge' : '101', 'bltu' : '110', 'bgeu' : '111',
-}
-
-# for determining the general type of instruction in command that occupies the most significant bit, allowing
-# to read or decode the instruction type in which we get to know which function is used with the corresponding value in instruction code. 
-opcodes = { 
-    'add' : '0110011', 'sub' : '0110011', 'sll' : '0110011', 'slt' : '0110011', 'sltu' : '0110011', 'xor' : '0110011', 'srl' : '0110011', 'or' : '0110011', 'and' : '0110011', 'mul' : '0110011',
-    'lw' : '0000011', 'addi' : '0010011', 'sltiu' : '0010011', 'jalr' : '1100111',
-    'sw' : '0100011',
-    'beq' : '1100011', 'bne' : '1100011', 'blt' : '1100011', 'bge' : '1100011', 'bltu' : '1100011', 'bgeu' : '1100011',
-    'lui' : '0110111', 'auipc' : '0010111',
-    'jal' : '1101111',
-}
+from collections import namedtuple
+from encoder import types, encode, to_text, to_bytes, EncodeError
+from pseudo import PSEUDO, expand, split
 
 VIRTUAL_HALT_INSTRUCTION_BIN = "00000000000000000000000001100011"
-error_Msg = ""
-
-# below function tends to signify the signed  2s complement approach 
-# to return the integer decimal form of the given binary string in the 2s complement notation system.
-def to_dec(binary):
-    if binary[0] == "1":
-        inverted_binary = "".join(["1" if bit == "0" else "0" for bit in binary])
-        decimal_number = int(inverted_binary, 2) + 1
-        return -decimal_number
-    else:
-        return int(binary, 2)
+VIRTUAL_HALT_INSTRUCTION = int(VIRTUAL_HALT_INSTRUCTION_BIN, 2)
 
-def to_bin(n, bits, checkRange=True):
-    bstr = None
-    try:
-        n = int(n)
-        bstr = bin(n & int("1"*bits, 2))[2:]
-    except:
-        bstr = bin_from_abi(n)
-    #n = int(n)
-    #bstr = bin(n & int("1"*bits, 2))[2:]
-    padded = bstr.zfill(bits)
-    if checkRange and to_dec(padded) != n:
-        global error_Msg
-        error_Msg = "Incorrect Immediate"
-        return None
-    return str(padded)
-
-# below bin_from_abi is responsible for converting ABI (Application Binary Interface) register names 
-# to their corresponding binary representation to indicate the system.
-def bin_from_abi(s):
-    if s == 'zero':
-        return '00000'
-    if s == 'ra':
-        return '00001'
-    if s == 'sp':
-        return '00010'
-    if s == 'gp':
-        return '00011'
-    if s == 'tp':
-        return '00100'
-    if s == 't0':
-        return '00101'
-    if s == 't1' or s == 't2':
-        return '00' + to_bin(int(s[1:]) + 5, 3, False)
-    if s == 's0' or s == 'fp':
-        return '01000'
-    if s == 's1':
-        return '01001'
-    if s == 'a0' or s == 'a1':
-        return '0101' + to_bin(int(s[1:]), 1, False)
-    if s[0] == 'a':
-        if 2 <= int(s[1:]) <= 5:
-            return '011' + to_bin(int(s[1:]) - 2, 2, False)
-        if 6 <= int(s[1:]) <= 7:
-            return '1000' + to_bin((int(s[1:]) - 6), 1, False)
-    if s[0] == 's' and 2 <= int(s[1:]) <= 11:
-        return '1' + to_bin(int(s[1:]), 4, False) 
-    if s[0] == 't' and 3 <= int(s[1:]) <= 6:
-        return '111' + to_bin(int(s[1:]) - 3, 2, False)
-
-    global error_Msg
-    error_Msg = f"Invalid Register '{s}'"
-    return None
-
-# The below function is for parsing across the r-type instructions, including the identification of source registers and
-#  returning the field function value and the instruction command value 
-def parse_r_type(tokens):
-    try:
-        instruction, rd, rs1, rs2 = tokens
-        funct7 = '0100000' if instruction == 'sub'or instruction == 'mul' else '0000000'
-        return funct7 + bin_from_abi(rs2) + bin_from_abi(rs1) + funct3s[instruction] + bin_from_abi(rd) + opcodes[instruction]
-    except:
-# for exceptions or errors in notation while parsing raises an error if the instruction format is invalid as per our ISA.
-        global error_Msg
-        if error_Msg == "": error_Msg = "Invalid Instruction Format"
-        return None
-
-
-# The below function is for parsing across the i-type (immediate instructions, including the identification of source registers and
-#  returning the field function value and the instruction command value .
-def parse_i_type(tokens):
-    try:
-        instruction, rd, rs, imm = tokens
-        if instruction == 'lw': rs,imm = imm,rs
-        return to_bin(imm, 12) + bin_from_abi(rs) + funct3s[instruction] + bin_from_abi(rd) + opcodes[instruction]
-    except:
-# for exceptions or errors in notation while parsing raises an error if the instruction format is invalid as per our ISA.
-        global error_Msg
-        if error_Msg == "": error_Msg = "Invalid Instruction Format"
-        return None
-
-def parse_s_type(tokens):
-    try:
-        # Extract the tokens from the input
-        instruction, rs2, imm, rs1 = tokens
-        # Convert the immediate value to a binary string with a width of 12 bits
-        bin_imm = to_bin(imm, 12)
-        # Concatenate the binary representation parts according to RISC-V S-type format:
-        # [immediate[11:5] | rs2 | rs1 | funct3 | immediate[4:0] | opcode]
-        return bin_imm[0:7] + bin_from_abi(rs2) + bin_from_abi(rs1) + funct3s[instruction] + bin_imm[7:] + opcodes[instruction]
-    except:
-        # If there's any exception, handle it
-        global error_Msg
-        # If the global error message is empty, assign it the message "Invalid Instruction Format"
-        if error_Msg == "": error_Msg = "Invalid Instruction Format"
-        # Return None as the result
-        return None
-
-def parse_b_type(tokens):
-    try:
-        instruction, rs1, rs2, imm = tokens
-        # Convert the immediate value to a binary string with a width of 16 bits
-        bin_imm = to_bin(imm, 16)
-        # Concatenate the binary representation parts according to RISC-V B-type format:
-        # [immediate[12] | immediate[10:5] | rs2 | rs1 | funct3 | immediate[4:1] | immediate[11] | opcode]
-        return bin_imm[3] + bin_imm[5:11] + bin_from_abi(rs2) + bin_from_abi(rs1) + funct3s[instruction] + bin_imm[11:15] + bin_imm[4] + opcodes[instruction]
-    except:
-        global error_Msg
-        if error_Msg == "": error_Msg = "Invalid Instruction Format"
-        return None
-
-def parse_u_type(tokens):
+REGISTER_NAMES = {'zero', 'ra', 'sp', 'gp', 'tp', 'fp'} | {f't{i}' for i in range(7)} | {f's{i}' for i in range(12)} | {f'a{i}' for i in range(8)}
+
+# instructions whose last operand is a branch target
+BRANCH_NAMES = set(types['B'] + types['J'])
+
+# token index of the immediate or offset operand, the only one a relocatable assembler turns
+# into a fixup ('lw a4,20(s1)' and 'sw ra,32(sp)' have the offset before the register)
+IMMEDIATE_OPERAND = dict.fromkeys(types['I'] + types['B'], 3)
+IMMEDIATE_OPERAND.update(dict.fromkeys(types['S'] + types['U'] + types['J'] + ['lw'], 2))
+IMMEDIATE_OPERAND['.word'] = 1
+
+# where the .data section starts, the data memory of the simulator (image.DEFAULT_DATA_BASE)
+DATA_BASE = 0x10000
+
+# how a symbol operand becomes a number, see relocate(). 'pc' is a plain label operand of an
+# instruction and 'abs' one of .word, the others are written %kind(name).
+RELOCATIONS = ('pc', 'abs', 'hi', 'lo', 'pcrel_hi', 'pcrel_lo')
+
+# the value a symbol operand of the word at addr gets when the symbol is at target. The
+# offset of %pcrel_lo is from the instruction before it, the auipc of its auipc/addi pair.
+def relocate(kind, target, addr):
+    if kind == 'pc':
+        return target - addr
+    if kind == 'abs':
+        return target
+    if kind == 'hi':
+        return split(target)[0]
+    if kind == 'lo':
+        return split(target)[1]
+    if kind == 'pcrel_hi':
+        return split(target - addr)[0]
+    return split(target - (addr - 4))[1]
+
+# nesting limit of macro expansion, a macro that expands to itself stops here
+MACRO_DEPTH = 64
+
+# Splits one source line into (labels, tokens): commas and brackets separate the operands,
+# '#' starts a comment and leading 'label:'s are split off. %kind(name) operands become one
+# '%kind=name' token. Blank lines give ([], None), a line with only labels ([...], []).
+def tokenize_line(text):
+    if '#' in text:
+        text = text.split('#', 1)[0]
+    labels = []
+    while ':' in text:
+        label, rest = text.split(':', 1)
+        if len(label.split()) != 1:
+            break
+        labels.append(label.strip())
+        text = rest
+    if len(text.strip()) == 0:
+        return labels, [] if labels else None
+    start = text.find('%')
+    while start >= 0:
+        open_at = text.find('(', start)
+        close_at = text.find(')', open_at)
+        if open_at < 0 or close_at < 0:
+            break
+        text = text[:start] + text[start:open_at] + '=' + text[open_at + 1:close_at].strip() + text[close_at + 1:]
+        start = text.find('%', start + 1)
+    text = text.replace(',', ' ')
+    text = text.replace('(', ' ')
+    text = text.replace(')', '')
+    return labels, text.split()
+
+# an operand that is neither a register nor a number can only be a label
+def is_symbol(token):
+    if token in REGISTER_NAMES:
+        return False
     try:
-        instruction, rd, imm = tokens
-        # Convert the immediate value to a binary string with a width of 32 bits
-        # Take the first 20 bits of the result
-        return to_bin(imm, 32)[:20] + bin_from_abi(rd) + opcodes[instruction]
-    except:
-        global error_Msg
-        if error_Msg == "": error_Msg = "Invalid Instruction Format"
-        return None
-
-# todo: recheck
-def parse_j_type(tokens):
+        int(token)
+        return False
+    except ValueError:
+        return True
+
+# (name, kind) of a symbol operand of an instruction or .word, None for registers and numbers
+def symbol_operand(token, data):
+    if token.startswith('%') and '=' in token:
+        kind, name = token[1:].split('=', 1)
+        if kind not in RELOCATIONS[2:]:
+            raise EncodeError(f"Invalid Relocation '%{kind}'")
+        return name, kind
+    if data:
+        try:
+            int(token, 0)
+            return None
+        except ValueError:
+            return token, 'abs'
+    return (token, 'pc') if is_symbol(token) else None
+
+# a .word or an instruction with its symbols resolved, returns (word, None) or (None, error)
+def encode_word(tokens):
+    if tokens[0] != '.word':
+        return encode(tokens)
     try:
-        # Extract the tokens from the input
-        instruction, rd, imm = tokens
-        # Convert the immediate value to a binary string with a width of 21 bits
-        bin_imm = to_bin(imm, 21)
-        # Concatenate the binary representation parts according to RISC-V J-type format:
-        # [immediate[20] | immediate[10:1] | immediate[11] | immediate[19:12] | rd | opcode]
-        return bin_imm[0] + bin_imm[-11:-1] + bin_imm[10] + bin_imm[1:9] + bin_from_abi(rd) + opcodes[instruction]
-    except:
-        # If there's any exception, handle it
-        global error_Msg
-        # If the global error message is empty, assign it the message "Invalid Instruction Format"
-        if error_Msg == "": error_Msg = "Invalid Instruction Format"
-        return None
-
-def test_parsing():
-    def tokenize(s):
-        s = s.replace(',', ' ')
-        s = s.replace('(', ' ')
-        s = s.replace(')', '')
-        tokens = s.split(' ')
-        return tokens
-    
-    print(parse_j_type(tokenize("jal ra,-1024")) == "11000000000111111111000011101111")
-    print(parse_b_type(tokenize("blt a4,a5,200")) == "00001100111101110100010001100011")
-    print(parse_r_type(tokenize("add s1,s2,s3")) == "00000001001110010000010010110011")
-    print(parse_i_type(tokenize("jalr ra,a5,-07")) == "11111111100101111000000011100111")
-    print(parse_i_type(tokenize("lw a4,20(s1)")) == "00000001010001001010011100000011")
-    print(parse_s_type(tokenize("sw ra,32(sp)")) == "00000010000100010010000000100011")
-    print(parse_u_type(tokenize("auipc s2,-30")) == "11111111111111111111100100010111")
-
-import sys
-
-with open(sys.argv[1], 'r') as f:
-    # read all the lines
-    lines = []
-
-    # Store the address of label definitions and line numbers
-    lables_to_addr = {}
-    lines_to_lineno = {}
-    i = 0
-    line_number = 0
-    for line in f.readlines():
-        line_number += 1
-        if len(line.strip()) == 0: 
-            continue # skip empty lines
-        line = line.replace(',', ' ')
-        line = line.replace('(', ' ')
-        line = line.replace(')', '')
-        # If found label...
-        if len(line.split(':')) == 2:
-            # ...remove it and store line address
-            label, line = line.split(':')
-            lables_to_addr[label] = i*4
-        line = line.strip()
-
-        lines_to_lineno[str(i)+line] = line_number # Ensure every line is unique by appending the line id
-        lines.append(line)
-        i += 1
-
-    # Replace labels with appropriate address
-    for i, line in enumerate(lines):
-        for label, label_addr in lables_to_addr.items():
-            if label in line.split(' '):
-                line = line.replace(label, str((lables_to_addr[label] - i*4)))
-        lines[i] = line
+        value = int(tokens[1], 0)
+    except ValueError:
+        return None, "Incorrect Immediate"
+    if not -(1 << 31) <= value < 1 << 32:
+        return None, "Incorrect Immediate"
+    return value & 0xFFFFFFFF, None
 
-    # Write output file
-    with open(sys.argv[2], 'w') as of:
-        # Convert to binary
-        hasVirtualHalt = False
-        output = []
-        for i, line in enumerate(lines):
-            binary = None
-            error_Msg = ""
-
-            if line == "rst":
-                binary = '00000000000000000000000001111111'
-            elif line == "halt":
-                binary = '11111111111111111111111111111111'
+Diagnostic = namedtuple('Diagnostic', ['line', 'message', 'file'], defaults=[None])  # line is 1 based, None for whole-program errors
+AssemblyResult = namedtuple('AssemblyResult', ['words', 'labels', 'diagnostics', 'data'], defaults=[()])
+
+# .macro name param, ... up to .endm, \param in the body is replaced by the argument and \@
+# by a number that is different in every expansion (for labels inside the macro)
+class Macro:
+    def __init__(self, name, params):
+        self.name = name
+        self.params = params
+        self.body = []
+        self.expansions = 0
+
+    def expand(self, args):
+        self.expansions += 1
+        values = dict(zip(self.params, args))
+        lines = []
+        for line in self.body:
+            for param in sorted(self.params, key=len, reverse=True): # \ab before \a
+                line = line.replace('\\' + param, values[param])
+            lines.append(line.replace('\\@', str(self.expansions)))
+        return lines
+
+
+# One source line. A line becomes any number of words (ops, one token list each): an
+# instruction one, a pseudo-instruction or macro call what it expands to, a .word its
+# values and a directive or label-only line none. Labels are bound to the index of the word
+# they are on, the next word of the section for a label-only line.
+class SourceLine:
+    __slots__ = ('text', 'labels', 'tokens', 'ops', 'refs', 'section', 'globals', 'macro_def', 'expanded',
+                 'parse_error', 'segment', 'addr', 'duplicate', 'resolved', 'words', 'error', 'fixups')
+
+    def __init__(self, text, macros=None, in_macro=False):
+        self.text = text
+        self.section = None
+        self.globals = ()
+        self.parse_error = None
+        # 'start', 'body' or 'end' for the lines of a macro definition
+        self.macro_def = 'body' if in_macro else None
+        # calls a macro
+        self.expanded = False
+        self.segment = 'text'
+        self.addr = None
+        self.duplicate = None
+        self.resolved = None
+        self.words = ()
+        self.error = None
+        self.fixups = ()
+        # (word index, operand index, name, kind) of the operands that refer to a label,
+        # patched once every label is defined so forward references work
+        self.refs = ()
+        # most lines are blank or one instruction without a label, those share the empty
+        # tuples instead of holding lists of their own
+        self.labels = ()
+        if in_macro:
+            self.tokens = None
+            self.ops = ()
+            return
+        labels, tokens = tokenize_line(text)
+        self.tokens = tokens
+        if not tokens:
+            self.ops = ()
+            if labels:
+                self.labels = [(label, 0) for label in labels]
+            return
+        name = tokens[0]
+        try:
+            forms = PSEUDO.get(name)
+            if ((forms is None or name in ('jal', 'jalr') and len(tokens) != 2)
+                    and name[0] != '.' and not (macros and name in macros)):
+                # a real instruction, most lines (jal and jalr are pseudo-instructions only
+                # with one operand)
+                self.ops = [tokens]
+                if labels:
+                    self.labels = [(label, 0) for label in labels]
+                refs = [(0, i, t, 'pc') for i, t in enumerate(tokens[1:], 1) if t not in REGISTER_NAMES and is_symbol(t)]
+                if refs:
+                    self.refs = self.operand_refs() if '%' in text else refs
+                return
+            self.ops = []
+            self.labels = []
+            if name == '.macro' or name == '.endm':
+                self.macro_def = 'start' if name == '.macro' else 'end'
+                if name == '.macro' and len(tokens) < 2:
+                    raise EncodeError("Invalid Directive Format")
             else:
-                # Tokenize and parse
-                tokens = line.split()
-                if tokens[0] == "rvrs":
-                    instruction, rd, rs = tokens
-                    binary = '0000000' + '00000' + bin_from_abi(rs) + '000' + bin_from_abi(rd) + '0000001'
-                elif tokens[0] in types['R']: binary = parse_r_type(tokens)
-                elif tokens[0] in types['I']: binary = parse_i_type(tokens)
-                elif tokens[0] in types['S']: binary = parse_s_type(tokens)
-                elif tokens[0] in types['B']: binary = parse_b_type(tokens)
-                elif tokens[0] in types['U']: binary = parse_u_type(tokens)
-                elif tokens[0] in types['J']: binary = parse_j_type(tokens)
-                else: error_Msg = f"Invalid Instruction '{tokens[0]}'"
-            
-            # Print error
-            if binary is None or error_Msg != "":
-                print(f"ERROR: Line {lines_to_lineno[str(i)+line]}: {error_Msg}!")
-                break
-            
-            # Keep track of wether or not we have found virtual halt instruction
-            if binary == VIRTUAL_HALT_INSTRUCTION_BIN:
-                hasVirtualHalt = True
-
-            if i < len(lines) - 1:
-                binary += "\n"
-            output.append(binary)
-        
-        # Write to file only if we don't have any errors
-        if not hasVirtualHalt and error_Msg == "":
-            print("ERROR: Virtual Halt Not Found!")
+                self.add(labels, tokens, macros or {}, 0)
+            self.refs = self.operand_refs()
+        except EncodeError as e:
+            # an instruction that cannot be expanded still takes its place, like one that
+            # cannot be encoded
+            self.parse_error = str(e)
+            self.ops = [] if name[0] == '.' else [tokens]
+            self.labels = [(label, 0) for label in labels]
+            self.refs = ()
+
+    def operand_refs(self):
+        refs = []
+        for k, op in enumerate(self.ops):
+            data = op[0] == '.word'
+            for i in range(1, len(op)):
+                if op[i] not in REGISTER_NAMES:
+                    symbol = symbol_operand(op[i], data)
+                    if symbol is not None:
+                        refs.append((k, i, symbol[0], symbol[1]))
+        return refs
+
+    def add(self, labels, tokens, macros, depth):
+        self.labels.extend((label, len(self.ops)) for label in labels)
+        if not tokens:
+            return
+        name = tokens[0]
+        if name.startswith('.'):
+            self.directive(tokens, depth)
+        elif name in macros:
+            macro = macros[name]
+            if len(tokens) - 1 != len(macro.params):
+                raise EncodeError(f"Macro '{name}' Takes {len(macro.params)} Operands")
+            if depth >= MACRO_DEPTH:
+                raise EncodeError(f"Macro '{name}' Nested Too Deep")
+            self.expanded = True
+            for line in macro.expand(tokens[1:]):
+                body_labels, body_tokens = tokenize_line(line)
+                if body_tokens is not None:
+                    self.add(body_labels, body_tokens, macros, depth + 1)
+        else:
+            self.ops.extend(expand(tokens))
+
+    def directive(self, tokens, depth):
+        name = tokens[0]
+        if name in ('.text', '.data') and depth == 0:
+            if len(tokens) != 1:
+                raise EncodeError("Invalid Directive Format")
+            self.section = name[1:]
+        elif name in ('.globl', '.global') and depth == 0:
+            if len(tokens) < 2:
+                raise EncodeError("Invalid Directive Format")
+            self.globals = tokens[1:]
+        elif name == '.word':
+            if len(tokens) < 2:
+                raise EncodeError("Invalid Directive Format")
+            self.ops.extend(['.word', value] for value in tokens[1:])
+        elif name in ('.space', '.zero'):
+            try:
+                size = int(tokens[1], 0) if len(tokens) == 2 else -1
+            except ValueError:
+                size = -1
+            if size < 0 or size % 4:
+                raise EncodeError("Invalid Directive Format")
+            self.ops.extend(['.word', '0'] for i in range(size // 4))
         else:
-            of.writelines(output)
+            raise EncodeError(f"Invalid Directive '{name}'")
+
+    def size(self):
+        return len(self.ops)
+
+
+# Two pass assembler. The first pass tokenizes every line once, assigns addresses in the
+# .text and .data sections and builds the symbol table, the second patches the label
+# operands through their relocation (the pc relative offset for instruction operands) and
+# encodes. The tokenized lines, label addresses and encoded words are kept, so after
+# assemble() single lines can be replaced, inserted or deleted and only that line plus the
+# lines whose label-relative immediates changed get re-encoded, edits to a macro
+# definition reassemble everything.
+#
+# A relocatable assembler (linker.py) puts both sections at 0 and leaves the operands that
+# refer to another section or to a symbol it does not define to the linker: they are
+# encoded as 0 and listed in the fixups of their line.
+class Assembler:
+    def __init__(self, relocatable=False):
+        self.relocatable = relocatable
+        self.bases = {'text': 0, 'data': 0 if relocatable else DATA_BASE}
+        self.source = []
+        self.macros = {}
+        # label -> address of the word it is on, and the section it is in
+        self.labels = {}
+        self.label_sections = {}
+        # label name -> lines with a fixup referring to it
+        self.users = {}
+
+    def assemble(self, text):
+        return self.assemble_lines(text.splitlines())
+
+    def assemble_lines(self, lines):
+        self.source = self.parse(lines)
+        self.users = {}
+        for sl in self.source:
+            self.add_users(sl)
+        self.relink()
+        for sl in self.source:
+            if sl.tokens is not None:
+                self.encode(sl)
+        return self.result()
+
+    # tokenizes the lines. The macro definitions are collected first, so a macro can be used
+    # anywhere in the file.
+    def parse(self, lines):
+        self.macros = {}
+        joined = "\n".join(lines)
+        if '.macro' not in joined and '.endm' not in joined:
+            return [SourceLine(text) for text in lines]
+        kinds = [None] * len(lines) # 'start', 'body' and 'end' of the macro definitions
+        errors = {}
+        macro = None # the definition being read, and the line it starts on
+        start = None
+        for n, text in enumerate(lines):
+            if '.macro' not in text and '.endm' not in text:
+                if macro is not None:
+                    kinds[n] = 'body'
+                    macro.body.append(text)
+                continue
+            labels, tokens = tokenize_line(text)
+            name = tokens[0] if tokens else None
+            if macro is not None and name != '.endm':
+                kinds[n] = 'body'
+                macro.body.append(text)
+            elif name == '.macro':
+                kinds[n] = 'start'
+                macro, start = Macro(tokens[1] if len(tokens) > 1 else None, tokens[2:]), n
+                if macro.name in self.macros:
+                    errors[n] = f"Duplicate Macro '{macro.name}'"
+            elif name == '.endm':
+                kinds[n] = 'end'
+                if macro is None:
+                    errors[n] = "Invalid Directive '.endm'"
+                else:
+                    if macro.name is not None and start not in errors:
+                        self.macros[macro.name] = macro
+                    macro = None
+        if macro is not None:
+            errors[start] = "Missing .endm"
+
+        source = []
+        for n, text in enumerate(lines):
+            if kinds[n] == 'body':
+                sl = SourceLine(text, in_macro=True)
+            else:
+                sl = SourceLine(text, self.macros)
+                if n in errors and sl.parse_error is None:
+                    sl.parse_error = errors[n]
+            source.append(sl)
+        return source
+
+    def update_line(self, number, text):
+        index = number - 1
+        old = self.source[index]
+        self.source[index] = SourceLine(text, self.macros)
+        return self.changed(old, self.source[index], index)
+
+    def insert_line(self, number, text):
+        self.source.insert(number - 1, SourceLine(text, self.macros))
+        return self.changed(None, self.source[number - 1], number - 1)
+
+    def delete_line(self, number):
+        return self.changed(self.source.pop(number - 1), None, number - 1)
+
+    def changed(self, old, new, index):
+        # macro definitions and calls (\\@ counts the expansions) reassemble everything
+        inside = index > 0 and self.source[index - 1].macro_def in ('start', 'body')
+        if inside or any(sl is not None and (sl.macro_def or sl.expanded) for sl in (old, new)):
+            return self.assemble_lines([sl.text for sl in self.source])
+        old_blank = old is None or old.tokens is None
+        new_blank = new is None or new.tokens is None
+        old_labels = list(old.labels) if old is not None else []
+        new_labels = list(new.labels) if new is not None else []
+        # the addresses of the lines after this one change
+        moved = ((old.size() if old is not None else 0) != (new.size() if new is not None else 0)
+                 or (old.section if old is not None else None) != (new.section if new is not None else None))
+        if old is not None:
+            self.remove_users(old)
+        if new is not None:
+            self.add_users(new)
+
+        candidates = set()
+        for label, k in old_labels + new_labels:
+            candidates.update(self.users.get(label, ()))
+        relinked = set()
+        if moved or old_blank != new_blank or old_labels != new_labels:
+            relinked = self.relink()
+            candidates |= relinked
+        elif not new_blank: # same address, size and labels as the line it replaces
+            new.addr = old.addr
+            new.segment = old.segment
+            new.duplicate = old.duplicate
+        if moved: # every label-relative immediate may have changed
+            candidates.update(sl for label in self.labels for sl in self.users.get(label, ()))
+        for sl in candidates:
+            if sl is not new and sl.tokens is not None and (sl in relinked or self.resolve(sl) != sl.resolved):
+                self.encode(sl)
+        if not new_blank:
+            self.encode(new)
+        return self.result()
+
+    def add_users(self, sl):
+        for k, i, name, kind in sl.refs:
+            self.users.setdefault(name, set()).add(sl)
+
+    def remove_users(self, sl):
+        for k, i, name, kind in sl.refs:
+            self.users[name].discard(sl)
+
+    # first pass: addresses and the symbol table, returns the lines whose labels became or
+    # stopped being duplicates
+    def relink(self):
+        self.labels = {}
+        self.label_sections = {}
+        changed = set()
+        counters = dict(self.bases)
+        section = 'text'
+        labels = self.labels
+        for sl in self.source:
+            if sl.tokens is None:
+                continue
+            if sl.section is not None:
+                section = sl.section
+            sl.segment = section
+            addr = sl.addr = counters[section]
+            duplicate = None
+            for label, k in sl.labels:
+                if label in labels:
+                    duplicate = duplicate or label
+                else:
+                    labels[label] = addr + 4*k
+                    self.label_sections[label] = section
+            if duplicate != sl.duplicate:
+                sl.duplicate = duplicate
+                changed.add(sl)
+            counters[section] = addr + 4 * len(sl.ops)
+        return changed
+
+    # label operands the assembler can resolve: all defined ones, in a relocatable assembler
+    # only pc relative ones into the same section
+    def resolvable(self, sl, name, kind):
+        if name not in self.labels:
+            return False
+        return not self.relocatable or (kind == 'pc' and self.label_sections[name] == sl.segment)
+
+    # second pass: label operands become their relocated value
+    def resolve(self, sl):
+        if not sl.refs:
+            return sl.ops
+        resolved = list(sl.ops)
+        for k, i, name, kind in sl.refs:
+            if self.resolvable(sl, name, kind):
+                if resolved[k] is sl.ops[k]:
+                    resolved[k] = list(sl.ops[k])
+                resolved[k][i] = str(relocate(kind, self.labels[name], sl.addr + 4*k))
+        return resolved
+
+    def encode(self, sl):
+        sl.resolved = self.resolve(sl)
+        fixups = []
+        error = sl.parse_error
+        if error is None and sl.duplicate:
+            error = f"Duplicate Label '{sl.duplicate}'"
+        if error is None and not sl.refs and len(sl.ops) == 1:
+            # one instruction without labels, most lines. The word is kept in a tuple, which
+            # the garbage collector stops tracking unlike a list.
+            word, error = encode_word(sl.ops[0])
+            sl.words, sl.error, sl.fixups = (word,), error, ()
+            return
+        words = []
+        for k, tokens in enumerate(sl.resolved):
+            if error is not None:
+                break
+            if not sl.refs:
+                word, error = encode_word(tokens)
+                words.append(word)
+                continue
+            undefined = [(i, name, kind) for j, i, name, kind in sl.refs if j == k and not self.resolvable(sl, name, kind)]
+            if undefined and self.relocatable:
+                # a name anywhere else (a mistyped register) is left for encode_word to report
+                position = IMMEDIATE_OPERAND.get(tokens[0])
+                undefined = [(i, name, kind) for i, name, kind in undefined if i == position]
+                if undefined:
+                    fixups.append(k)
+                    tokens = list(tokens)
+                    for i, name, kind in undefined:
+                        tokens[i] = '0'
+            elif undefined and (tokens[0] in BRANCH_NAMES or tokens[0] == '.word' or any(kind != 'pc' for i, name, kind in undefined)):
+                error = f"Undefined Label '{undefined[-1][1]}'"
+                break
+            word, error = encode_word(tokens)
+            words.append(word)
+        if error is not None:
+            words = [None] * max(sl.size(), 1)
+        sl.words, sl.error = words, error
+        sl.fixups = fixups or ()
+
+    def result(self):
+        words = []
+        data = []
+        diagnostics = []
+        for number, sl in enumerate(self.source, 1):
+            if sl.tokens is None:
+                continue
+            if sl.segment == 'data':
+                data.extend(sl.words)
+            else:
+                words.extend(sl.words)
+            if sl.error is not None:
+                diagnostics.append(Diagnostic(number, sl.error))
+        if not self.relocatable and not diagnostics and VIRTUAL_HALT_INSTRUCTION not in words:
+            diagnostics.append(Diagnostic(None, "Virtual Halt Not Found"))
+        return AssemblyResult(words, dict(self.labels), diagnostics, data)
+
+
+def diagnostic_text(error):
+    where = f"{error.file}: " if error.file else ""
+    if error.line is None:
+        return f"ERROR: {where}{error.message}!"
+    return f"ERROR: {where}Line {error.line}: {error.message}!"
+
+# an assembled program as the simulator loads it: {pc -> word}, or with a .data section an
+# image.ImageProgram like the one of a program image
+def program_memory(result):
+    if not result.data:
+        return {4 * i: word for i, word in enumerate(result.words)}
+    import image
+    return image.ImageProgram(result.words, 0, 0, [(DATA_BASE + 4*i, word) for i, word in enumerate(result.data)])
+
+# writes the words of an assembled (or linked) program, returns the exit status
+def write_output(result, out_file, image_output=False, binary_output=False):
+    words = result.words
+    status = 0
+    if result.diagnostics:
+        # Print the first error, the instructions before it are still written
+        error = result.diagnostics[0]
+        status = 1
+        print(diagnostic_text(error))
+        words = [] if error.line is None else words[:words.index(None)] if None in words else words
+    elif result.data and not image_output:
+        # only an image has a data segment
+        status = 1
+        print(diagnostic_text(Diagnostic(None, ".data Needs An Image Output (--image)")))
+
+    # Write output file
+    if image_output:
+        import image
+        image.write_image(out_file, words, result.data if status == 0 else ())
+    elif binary_output:
+        with open(out_file, 'wb') as of:
+            of.write(to_bytes(words))
+    else:
+        with open(out_file, 'w') as of:
+            if status == 0:
+                of.write(to_text(words))
+            else:
+                of.writelines(format(word, '032b') + "\n" for word in words)
+    return status
+
+def main(argv=None):
+    if argv is None:
+        import sys
+        argv = sys.argv[1:]
+    # the plain 'Assembler.py in_file out_file' call does not need argparse, which costs
+    # more to import than the assembler itself
+    if len(argv) == 2 and not any(arg.startswith('-') for arg in argv):
+        in_file, out_file, image_output, binary_output = argv[0], argv[1], False, False
+    else:
+        import argparse
+        parser = argparse.ArgumentParser(description="RISC-V assembler, writes one 32 bit binary word per line")
+        parser.add_argument('in_file', help="assembly source")
+        parser.add_argument('out_file', help="machine code output")
+        output = parser.add_mutually_exclusive_group()
+        output.add_argument('--binary', action='store_true', help="write raw little-endian 32 bit words instead of text")
+        output.add_argument('--image', action='store_true', help="write a packed program image (image.py)")
+        args = parser.parse_args(argv)
+        in_file, out_file, image_output, binary_output = args.in_file, args.out_file, args.image, args.binary
+
+    with open(in_file, 'r') as f:
+        result = Assembler().assemble(f.read())
+    return write_output(result, out_file, image_output, binary_output)
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
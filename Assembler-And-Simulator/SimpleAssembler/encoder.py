@@ -0,0 +1,167 @@
+import sys
+from array import array
+
+# Integer instruction encoder. Register names, opcodes and function fields are looked up in
+# precomputed tables and every instruction word is put together with shifts and masks, the
+# '0'/'1' text is only produced when the output is written. Range checks and error messages
+# are the same as the original string based to_bin/bin_from_abi/parse_*_type functions.
+
+# for different types of commands in the processor/assembler
+types = {
+    'R' : ['add','sub','sll','slt','sltu','xor','srl','or','and', 'mul'],
+    'I' : ['lw','addi','sltiu','jalr'],
+    'S' : ['sw'],
+    'B' : ['beq','bne','blt','bge','bltu','bgeu'],
+    'U' : ['lui', 'auipc'],
+    'J' : ['jal'],
+}
+
+funct3s = {
+    'add' : 0b000, 'sub' : 0b000, 'sll' : 0b001, 'slt' : 0b010, 'sltu' : 0b011, 'xor' : 0b100, 'srl' : 0b101, 'or' : 0b110, 'and' : 0b111, 'mul' : 0b111,
+    'lw' : 0b010, 'addi' : 0b000, 'sltiu' : 0b011, 'jalr' : 0b000,
+    'sw' : 0b010,
+    'beq' : 0b000, 'bne' : 0b001, 'blt' : 0b100, 'bge' : 0b101, 'bltu' : 0b110, 'bgeu' : 0b111,
+}
+
+funct7s = {'sub' : 0b0100000, 'mul' : 0b0100000}
+
+opcodes = {
+    'add' : 0b0110011, 'sub' : 0b0110011, 'sll' : 0b0110011, 'slt' : 0b0110011, 'sltu' : 0b0110011, 'xor' : 0b0110011, 'srl' : 0b0110011, 'or' : 0b0110011, 'and' : 0b0110011, 'mul' : 0b0110011,
+    'lw' : 0b0000011, 'addi' : 0b0010011, 'sltiu' : 0b0010011, 'jalr' : 0b1100111,
+    'sw' : 0b0100011,
+    'beq' : 0b1100011, 'bne' : 0b1100011, 'blt' : 0b1100011, 'bge' : 0b1100011, 'bltu' : 0b1100011, 'bgeu' : 0b1100011,
+    'lui' : 0b0110111, 'auipc' : 0b0010111,
+    'jal' : 0b1101111,
+}
+
+registers = {
+    'zero' : 0, 'ra' : 1, 'sp' : 2, 'gp' : 3, 'tp' : 4, 't0' : 5, 't1' : 6, 't2' : 7,
+    's0' : 8, 'fp' : 8, 's1' : 9, 'a0' : 10, 'a1' : 11, 'a2' : 12, 'a3' : 13, 'a4' : 14, 'a5' : 15,
+    'a6' : 16, 'a7' : 17, 's2' : 18, 's3' : 19, 's4' : 20, 's5' : 21, 's6' : 22, 's7' : 23,
+    's8' : 24, 's9' : 25, 's10' : 26, 's11' : 27, 't3' : 28, 't4' : 29, 't5' : 30, 't6' : 31,
+}
+
+RST_INSTRUCTION = 0x0000007F
+HALT_INSTRUCTION = 0xFFFFFFFF
+RVRS_OPCODE = 0b0000001
+
+class EncodeError(Exception):
+    pass
+
+# register number of an ABI name. Names the table does not have go through the same rules
+# as the old bin_from_abi, which also accepted spellings like 's05'.
+def register(s):
+    number = registers.get(s)
+    if number is not None:
+        return number
+    try:
+        if s[0] == 'a':
+            if 2 <= int(s[1:]) <= 7:
+                return 10 + int(s[1:])
+        if s[0] == 's' and 2 <= int(s[1:]) <= 11:
+            return 16 + int(s[1:])
+        if s[0] == 't' and 3 <= int(s[1:]) <= 6:
+            return 25 + int(s[1:])
+    except (ValueError, IndexError):
+        raise EncodeError("Invalid Instruction Format") from None
+    raise EncodeError(f"Invalid Register '{s}'")
+
+# a signed immediate that has to fit in `bits` bits, returned masked to those bits
+def immediate(s, bits):
+    try:
+        n = int(s)
+    except ValueError:
+        register(s) # a register where a number belongs: its error, or else an immediate error
+        raise EncodeError("Incorrect Immediate") from None
+    if not -(1 << (bits - 1)) <= n < 1 << (bits - 1):
+        raise EncodeError("Incorrect Immediate")
+    return n & ((1 << bits) - 1)
+
+def encode_r_type(instruction, rd, rs1, rs2):
+    rs2, rs1, rd = register(rs2), register(rs1), register(rd)
+    return funct7s.get(instruction, 0) << 25 | rs2 << 20 | rs1 << 15 | funct3s[instruction] << 12 | rd << 7 | opcodes[instruction]
+
+def encode_i_type(instruction, rd, rs, imm):
+    if instruction == 'lw': rs,imm = imm,rs
+    try:
+        imm = immediate(imm, 12)
+    except EncodeError as e:
+        # an out of range immediate is reported as the invalid register rs, like the string encoder did
+        if str(e) == "Incorrect Immediate" and rs not in registers:
+            try:
+                register(rs)
+            except EncodeError as r:
+                if str(r) != "Invalid Instruction Format":
+                    raise r from None
+        raise
+    rs, rd = register(rs), register(rd)
+    return imm << 20 | rs << 15 | funct3s[instruction] << 12 | rd << 7 | opcodes[instruction]
+
+# [immediate[11:5] | rs2 | rs1 | funct3 | immediate[4:0] | opcode]
+def encode_s_type(instruction, rs2, imm, rs1):
+    imm = immediate(imm, 12)
+    rs2, rs1 = register(rs2), register(rs1)
+    return (imm >> 5) << 25 | rs2 << 20 | rs1 << 15 | funct3s[instruction] << 12 | (imm & 0x1F) << 7 | opcodes[instruction]
+
+# [immediate[12] | immediate[10:5] | rs2 | rs1 | funct3 | immediate[4:1] | immediate[11] | opcode]
+# the immediate is range checked as 16 bits
+def encode_b_type(instruction, rs1, rs2, imm):
+    imm = immediate(imm, 16)
+    rs2, rs1 = register(rs2), register(rs1)
+    return ((imm >> 12 & 1) << 31 | (imm >> 5 & 0x3F) << 25 | rs2 << 20 | rs1 << 15 | funct3s[instruction] << 12
+            | (imm >> 1 & 0xF) << 8 | (imm >> 11 & 1) << 7 | opcodes[instruction])
+
+# the immediate is the full 32 bit value, its upper 20 bits are kept
+def encode_u_type(instruction, rd, imm):
+    imm = immediate(imm, 32)
+    return (imm & 0xFFFFF000) | register(rd) << 7 | opcodes[instruction]
+
+# [immediate[20] | immediate[10:1] | immediate[10] | immediate[19:12] | rd | opcode]
+# bit 20 of the word holds immediate[10] rather than immediate[11], as the string encoder did
+def encode_j_type(instruction, rd, imm):
+    imm = immediate(imm, 21)
+    return ((imm >> 20 & 1) << 31 | (imm >> 1 & 0x3FF) << 21 | (imm >> 10 & 1) << 20 | (imm >> 12 & 0xFF) << 12
+            | register(rd) << 7 | opcodes[instruction])
+
+def encode_rvrs(instruction, rd, rs):
+    rs, rd = register(rs), register(rd)
+    return rs << 15 | rd << 7 | RVRS_OPCODE
+
+encoders = {}
+encoders.update((name, (encode_r_type, 4)) for name in types['R'])
+encoders.update((name, (encode_i_type, 4)) for name in types['I'])
+encoders.update((name, (encode_s_type, 4)) for name in types['S'])
+encoders.update((name, (encode_b_type, 4)) for name in types['B'])
+encoders.update((name, (encode_u_type, 3)) for name in types['U'])
+encoders.update((name, (encode_j_type, 3)) for name in types['J'])
+encoders['rvrs'] = (encode_rvrs, 3)
+
+# encodes one tokenized instruction (labels already resolved), returns (word, None) or
+# (None, error message)
+def encode(tokens):
+    if tokens == ["rst"]:
+        return RST_INSTRUCTION, None
+    if tokens == ["halt"]:
+        return HALT_INSTRUCTION, None
+    if len(tokens) == 0:
+        return None, "Invalid Instruction Format"
+    entry = encoders.get(tokens[0])
+    if entry is None:
+        return None, f"Invalid Instruction '{tokens[0]}'"
+    fn, count = entry
+    if len(tokens) != count:
+        return None, "Invalid Instruction Format"
+    try:
+        return fn(*tokens), None
+    except EncodeError as e:
+        return None, str(e)
+
+def to_text(words):
+    return "\n".join(format(word, '032b') for word in words)
+
+# raw little-endian 32 bit words
+def to_bytes(words):
+    data = array('I', words)
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return data.tobytes()
@@ -0,0 +1,111 @@
+import os
+import sys
+import mmap
+import heapq
+import bisect
+import struct
+from array import array
+from encoder import to_bytes
+
+# Packed program image, the binary alternative to one '0'/'1' text line per instruction.
+# All fields are little-endian:
+#
+#   header  '<4sHHIIIII'  magic, version, flags (0), entry pc,
+#                         text address, text words, data address, data words
+#   text    text words * 4 bytes
+#   data    data words * 4 bytes, loaded into data memory before the program starts
+#
+# read_image maps the file and returns an ImageProgram, a {pc -> word} dict that reads
+# words out of the mapped text segment the first time they are looked up.
+
+IMAGE_MAGIC = b'RVIM'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIIII')
+DEFAULT_DATA_BASE = 0x10000
+
+def is_image(path):
+    with open(path, 'rb') as f:
+        return f.read(len(IMAGE_MAGIC)) == IMAGE_MAGIC
+
+def write_image(path, text, data=(), entry=0, text_base=0, data_base=DEFAULT_DATA_BASE):
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(IMAGE_MAGIC, VERSION, 0, entry, text_base, len(text), data_base, len(data)))
+        f.write(to_bytes(text))
+        f.write(to_bytes(data))
+
+
+class ImageProgram(dict):
+    def __init__(self, words, text_base, entry, data):
+        super().__init__()
+        self.words = words
+        self.text_base = text_base
+        self.text_end = text_base + 4 * len(words)
+        # every pc of the text segment, fixed by the header's text size
+        self.text = range(self.text_base, self.text_end, 4)
+        # sorted pcs stored outside the text segment (self-modifying code writing past it)
+        self.outside = []
+        self.entry = entry
+        # (address, word) pairs of the data segment
+        self.data = data
+
+    def __missing__(self, pc):
+        if pc not in self.text:
+            raise KeyError(pc)
+        word = self[pc] = self.words[(pc - self.text_base) >> 2]
+        return word
+
+    def __setitem__(self, pc, word):
+        if pc not in self.text and not dict.__contains__(self, pc):
+            bisect.insort(self.outside, pc)
+        dict.__setitem__(self, pc, word)
+
+    def get(self, pc, default=None):
+        return self[pc] if pc in self else default
+
+    def __contains__(self, pc):
+        return pc in self.text or dict.__contains__(self, pc)
+
+    def __len__(self):
+        return len(self.text) + len(self.outside)
+
+    def __iter__(self):
+        if not self.outside:
+            return iter(self.text)
+        return heapq.merge(self.text, self.outside)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(pc, self[pc]) for pc in self]
+
+
+def segment_words(view):
+    if sys.byteorder == 'little':
+        return view.cast('I')
+    words = array('I') # copied, then swapped to host order
+    words.frombytes(view)
+    words.byteswap()
+    return words
+
+def read_image(path):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+    return parse_image(mapped, path)
+
+# an image already in memory (bytes, mmap or anything else with the buffer protocol)
+def parse_image(buffer, name="data"):
+    view = memoryview(buffer)
+    if len(view) < HEADER.size:
+        raise ValueError(f"{name} is not a program image")
+    magic, version, flags, entry, text_base, text_words, data_base, data_words = HEADER.unpack_from(view)
+    if magic != IMAGE_MAGIC or version != VERSION:
+        raise ValueError(f"{name} is not a program image")
+    text_end = HEADER.size + 4 * text_words
+    data_end = text_end + 4 * data_words
+    if len(view) < data_end:
+        raise ValueError(f"{name} is truncated")
+    text = segment_words(view[HEADER.size:text_end])
+    data = segment_words(view[text_end:data_end])
+    return ImageProgram(text, text_base, entry, [(data_base + 4*i, word) for i, word in enumerate(data)])
@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import hashlib
+import Assembler
+from Assembler import Diagnostic, AssemblyResult, relocate, encode_word, DATA_BASE, VIRTUAL_HALT_INSTRUCTION
+
+# Separate assembly and linking. Every source file is assembled on its own into a
+# relocatable object: its .text and .data words with both sections starting at 0, its
+# symbols and the fixups, the words that refer to a symbol of another file or another
+# section. link() puts the sections of the objects one after the other (text from 0, data
+# from DATA_BASE, in the order the files are given), resolves the symbols and encodes the
+# fixup words again with their final values.
+#
+# Labels are local to their file unless a .globl lists them, a global defined in two files
+# is a Duplicate Label and a symbol no file defines an Undefined Label. Execution starts at
+# 0, the first instruction of the first file.
+#
+# An object is JSON:
+#
+#   {"version": 1, "name": "kernel.s", "hash": "<blake2b of the source>",
+#    "text": [word, ...], "data": [word, ...],
+#    "symbols": {"label": ["text", offset], ...}, "globals": ["label", ...],
+#    "fixups": [[section, word index, tokens, [[operand, symbol, relocation], ...], line], ...]}
+#
+# ObjectCache keeps one object per source file keyed by the hash of its text, so a build
+# of many files only assembles the files that changed since the last build.
+
+OBJECT_VERSION = 1
+
+def source_hash(text):
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+# (object, diagnostics) of one source file, the object is None when it has errors
+def assemble_object(text, name):
+    asm = Assembler.Assembler(relocatable=True)
+    result = asm.assemble(text)
+    if result.diagnostics:
+        return None, [d._replace(file=name) for d in result.diagnostics]
+    fixups = []
+    exported = []
+    for number, sl in enumerate(asm.source, 1):
+        exported.extend(sl.globals)
+        for k in sl.fixups:
+            refs = [[i, symbol, kind] for j, i, symbol, kind in sl.refs if j == k]
+            fixups.append([sl.segment, sl.addr // 4 + k, sl.ops[k], refs, number])
+    return {
+        'version': OBJECT_VERSION,
+        'name': name,
+        'hash': source_hash(text),
+        'text': result.words,
+        'data': list(result.data),
+        'symbols': {label: [asm.label_sections[label], addr] for label, addr in asm.labels.items()},
+        'globals': [label for label in dict.fromkeys(exported) if label in asm.labels],
+        'fixups': fixups,
+    }, []
+
+def read_object(path):
+    with open(path) as f:
+        obj = json.load(f)
+    if obj.get('version') != OBJECT_VERSION:
+        raise ValueError(f"{path} is not an object of this assembler")
+    return obj
+
+def write_object(path, obj):
+    with open(path, 'w') as f:
+        json.dump(obj, f, separators=(',', ':'))
+
+# links objects into one program, returns an AssemblyResult with the global symbols as labels
+def link(objects, data_base=DATA_BASE):
+    text = []
+    data = []
+    diagnostics = []
+    placed = []
+    exports = {}
+    for obj in objects:
+        bases = {'text': 4 * len(text), 'data': data_base + 4 * len(data)}
+        placed.append(bases)
+        text.extend(obj['text'])
+        data.extend(obj['data'])
+        for label in obj['globals']:
+            section, offset = obj['symbols'][label]
+            if label in exports:
+                diagnostics.append(Diagnostic(None, f"Duplicate Label '{label}'", obj['name']))
+            else:
+                exports[label] = bases[section] + offset
+
+    for obj, bases in zip(objects, placed):
+        symbols = obj['symbols']
+        for section, index, tokens, refs, line in obj['fixups']:
+            addr = bases[section] + 4 * index
+            tokens = list(tokens)
+            error = None
+            for i, name, kind in refs:
+                if name in symbols:
+                    target = bases[symbols[name][0]] + symbols[name][1]
+                elif name in exports:
+                    target = exports[name]
+                else:
+                    error = f"Undefined Label '{name}'"
+                    continue
+                tokens[i] = str(relocate(kind, target, addr))
+            if error is None:
+                word, error = encode_word(tokens)
+            if error is not None:
+                diagnostics.append(Diagnostic(line, error, obj['name']))
+            elif section == 'text':
+                text[addr // 4] = word
+            else:
+                data[(addr - data_base) // 4] = word
+
+    if not diagnostics and VIRTUAL_HALT_INSTRUCTION not in text:
+        diagnostics.append(Diagnostic(None, "Virtual Halt Not Found"))
+    return AssemblyResult(text, exports, diagnostics, data)
+
+
+# one object file per source file in a directory
+class ObjectCache:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, source_path):
+        absolute = os.path.abspath(source_path)
+        key = hashlib.blake2b(absolute.encode(), digest_size=8).hexdigest()
+        return os.path.join(self.directory, f"{os.path.basename(source_path)}.{key}.o")
+
+    # the cached object of a source file with this hash, or None
+    def load(self, source_path, digest):
+        try:
+            obj = read_object(self.path(source_path))
+        except (OSError, ValueError):
+            return None
+        return obj if obj.get('hash') == digest else None
+
+    def store(self, source_path, obj):
+        # written next to the final name and renamed, a build that is interrupted or runs
+        # alongside another never leaves half an object behind
+        path = self.path(source_path)
+        write_object(path + f".{os.getpid()}.tmp", obj)
+        os.replace(path + f".{os.getpid()}.tmp", path)
+
+def assemble_file(path):
+    with open(path) as f:
+        return assemble_object(f.read(), path)
+
+# objects of the given source (.s and anything else) and object (.o) files, in order.
+# Returns (objects, diagnostics, number of files assembled); the stale files are assembled
+# by `jobs` worker processes when there are several.
+def build(paths, cache=None, jobs=1):
+    objects = [None] * len(paths)
+    diagnostics = []
+    stale = []
+    for n, path in enumerate(paths):
+        if path.endswith('.o'):
+            objects[n] = read_object(path)
+            continue
+        if cache is not None:
+            with open(path) as f:
+                objects[n] = cache.load(path, source_hash(f.read()))
+        if objects[n] is None:
+            stale.append(n)
+
+    if jobs > 1 and len(stale) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(assemble_file, [paths[n] for n in stale], chunksize=8))
+    else:
+        results = [assemble_file(paths[n]) for n in stale]
+    for n, (obj, errors) in zip(stale, results):
+        objects[n] = obj
+        diagnostics.extend(errors)
+        if obj is not None and cache is not None:
+            cache.store(paths[n], obj)
+    return objects, diagnostics, len(stale)
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Assemble source files separately and link them into one program")
+    parser.add_argument('inputs', nargs='+', help="assembly sources and objects (.o)")
+    parser.add_argument('-o', '--output', required=True, help="linked program, or the object with -c")
+    parser.add_argument('-c', '--compile', action='store_true', help="only assemble the one input into a relocatable object")
+    parser.add_argument('--cache', help="directory of cached objects, only the sources that changed are assembled")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="worker processes assembling the changed sources (default 1)")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument('--binary', action='store_true', help="write raw little-endian 32 bit words instead of text")
+    output.add_argument('--image', action='store_true', help="write a packed program image (image.py)")
+    parser.add_argument('--verbose', action='store_true', help="report how many sources were assembled")
+    args = parser.parse_args(argv)
+
+    if args.compile:
+        if len(args.inputs) != 1:
+            parser.error("-c takes one input")
+        obj, diagnostics = assemble_file(args.inputs[0])
+        if diagnostics:
+            print(Assembler.diagnostic_text(diagnostics[0]))
+            return 1
+        write_object(args.output, obj)
+        return 0
+
+    cache = ObjectCache(args.cache) if args.cache else None
+    try:
+        objects, diagnostics, assembled = build(args.inputs, cache, args.jobs)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}!")
+        return 1
+    if args.verbose:
+        print(f"assembled {assembled} of {len(args.inputs)} inputs", file=sys.stderr)
+    if diagnostics:
+        print(Assembler.diagnostic_text(diagnostics[0]))
+        return 1
+    return Assembler.write_output(link(objects), args.output, args.image, args.binary)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+from encoder import EncodeError
+
+# Pseudo-instructions. expand() turns one tokenized source instruction into the real
+# instructions it stands for, anything that is not a pseudo-instruction comes back as it
+# is. The expansion only depends on the operands, so the size of every line is known
+# before any label is, and label operands stay where the first pass finds them.
+#
+# An operand '%kind=name' refers to a symbol through a relocation (Assembler.py writes
+# %hi(name) this way): hi and lo are the two halves of its address for a lui/addi pair,
+# pcrel_hi and pcrel_lo the halves of its offset from the auipc of an auipc/addi pair.
+
+# upper and lower part of a 32 bit value for lui + addi: hi + lo == value (mod 2**32) and
+# lo fits the 12 bit immediate of addi
+def split(value):
+    hi = (value + 0x800) & 0xFFFFF000
+    lo = (value - hi) & 0xFFFFFFFF
+    return hi - (1 << 32) if hi & 0x80000000 else hi, lo - (1 << 32) if lo & 0x80000000 else lo
+
+# li accepts decimal, hex, octal and binary numbers and anything a 32 bit register holds
+def constant(token):
+    try:
+        value = int(token, 0)
+    except ValueError:
+        return None
+    if not -(1 << 31) <= value < 1 << 32:
+        raise EncodeError("Incorrect Immediate")
+    return value
+
+def load_immediate(rd, value):
+    if -2048 <= value < 2048:
+        return [['addi', rd, 'zero', str(value)]]
+    hi, lo = split(value)
+    if lo == 0:
+        return [['lui', rd, str(hi)]]
+    return [['lui', rd, str(hi)], ['addi', rd, rd, str(lo)]]
+
+def li(rd, imm):
+    value = constant(imm)
+    if value is None: # a symbol: its address
+        return [['lui', rd, '%hi=' + imm], ['addi', rd, rd, '%lo=' + imm]]
+    return load_immediate(rd, value)
+
+# name -> {operand count -> expansion}
+PSEUDO = {
+    'nop':  {0: lambda: [['addi', 'zero', 'zero', '0']]},
+    'li':   {2: li},
+    'la':   {2: lambda rd, sym: [['auipc', rd, '%pcrel_hi=' + sym], ['addi', rd, rd, '%pcrel_lo=' + sym]]},
+    'mv':   {2: lambda rd, rs: [['addi', rd, rs, '0']]},
+    'not':  {2: lambda rd, rs: [['sub', rd, 'zero', rs], ['addi', rd, rd, '-1']]},
+    'neg':  {2: lambda rd, rs: [['sub', rd, 'zero', rs]]},
+    'seqz': {2: lambda rd, rs: [['sltiu', rd, rs, '1']]},
+    'snez': {2: lambda rd, rs: [['sltu', rd, 'zero', rs]]},
+    'sltz': {2: lambda rd, rs: [['slt', rd, rs, 'zero']]},
+    'sgtz': {2: lambda rd, rs: [['slt', rd, 'zero', rs]]},
+    'beqz': {2: lambda rs, target: [['beq', rs, 'zero', target]]},
+    'bnez': {2: lambda rs, target: [['bne', rs, 'zero', target]]},
+    'blez': {2: lambda rs, target: [['bge', 'zero', rs, target]]},
+    'bgez': {2: lambda rs, target: [['bge', rs, 'zero', target]]},
+    'bltz': {2: lambda rs, target: [['blt', rs, 'zero', target]]},
+    'bgtz': {2: lambda rs, target: [['blt', 'zero', rs, target]]},
+    'bgt':  {3: lambda rs, rt, target: [['blt', rt, rs, target]]},
+    'ble':  {3: lambda rs, rt, target: [['bge', rt, rs, target]]},
+    'bgtu': {3: lambda rs, rt, target: [['bltu', rt, rs, target]]},
+    'bleu': {3: lambda rs, rt, target: [['bgeu', rt, rs, target]]},
+    'j':    {1: lambda target: [['jal', 'zero', target]]},
+    'jr':   {1: lambda rs: [['jalr', 'zero', rs, '0']]},
+    'ret':  {0: lambda: [['jalr', 'zero', 'ra', '0']]},
+    # call and tail go through auipc/jalr like the standard expansion, which reaches the
+    # whole address space where jal reaches +-1 MiB
+    'call': {1: lambda sym: [['auipc', 'ra', '%pcrel_hi=' + sym], ['jalr', 'ra', 'ra', '%pcrel_lo=' + sym]]},
+    'tail': {1: lambda sym: [['auipc', 't1', '%pcrel_hi=' + sym], ['jalr', 'zero', 't1', '%pcrel_lo=' + sym]]},
+    # the one operand forms of jal and jalr link through ra
+    'jal':  {1: lambda target: [['jal', 'ra', target]]},
+    'jalr': {1: lambda rs: [['jalr', 'ra', rs, '0']]},
+}
+
+# list of instructions (token lists) for the tokens of one source instruction, raises
+# EncodeError for a pseudo-instruction with the wrong operands
+def expand(tokens):
+    forms = PSEUDO.get(tokens[0]) if tokens else None
+    if forms is None:
+        return [tokens]
+    form = forms.get(len(tokens) - 1)
+    if form is None:
+        if tokens[0] in ('jal', 'jalr'): # the real instruction, the encoder checks it
+            return [tokens]
+        raise EncodeError("Invalid Instruction Format")
+    return form(*tokens[1:])
@@ -1,261 +1,199 @@
 import sys
-import reversesim
+from alu import MASK32, R_OPS, B_OPS, to_signed, sign_extend, add, sltu
+from tracing import TRACE_LEVELS, TRACE_FINAL, TRACE_REGS, TRACE_VERBOSE, DEFAULT_FLUSH_SIZE, TraceWriter
+
+# The string engine: registers and memory are kept as '0'/'1' strings exactly like the
+# original simulator, it is the reference the faster engines in machine.py are checked
+# against. The machine state lives in module globals, load_program() resets it.
 
-in_file, out_file = sys.argv[1], sys.argv[2]
 VIRTUAL_HALT_INSTRUCTION_BIN = "00000000000000000000000001100011"
+ZERO_WORD = format(0, '032b')
+trace_level = TRACE_REGS
+verbose = False
+trace_writer = None
 
-def to_dec(binary, unsigned=False):
-    if '0b' in binary:
-        binary = binary[2:]
-    if not unsigned and binary[0] == "1":
-        inverted_binary = "".join(["1" if bit == "0" else "0" for bit in binary])
-        decimal_number = int(inverted_binary, 2) + 1
-        return -decimal_number
-    else:
-        return int(binary, 2)
+# the disassembler, only imported for verbose output (see simulate_lines)
+reversesim = None
 
-def to_bin(n, bits):
-    bstr = None
-    n = int(n)
-    bstr = bin(n & int("1"*bits, 2))[2:]
-    padded = bstr.zfill(bits)
-    return str(padded)
+# the alu tables keyed by the funct3 bits as they appear in the instruction text
+r_ops = {(format(funct3, '03b'), alt): op for (funct3, alt), op in R_OPS.items()}
+b_ops = {format(funct3, '03b'): op for funct3, op in B_OPS.items()}
 
 # store the instructions {int -> 32bin}
 program_memory = {}
-with open(in_file) as f:
-    lines = f.readlines()
-    for i, line in enumerate(lines):
-        program_memory[i*4] = line.strip()
-
 program_counter = 0
-
 # stack memory {5bin -> 32bin}
 registers = {}
-for i in range(32):
-    registers[format(i, '05b')] = format(0, '032b')
-registers['00010'] = format(256, '032b') # sp
-
 # data memory {8hex -> 32bin}
 data_memory = {}
-for i in range(0x10000, 0x1007F, 4):
-    data_memory[format(i, '08x')] = format(0, '032b')
+cur_instruction = None
+step_count = 0
+
+def load_program(lines):
+    global program_counter, cur_instruction, step_count
+    program_memory.clear()
+    for i, line in enumerate(lines):
+        program_memory[i*4] = line.strip()
+
+    program_counter = 0
+    cur_instruction = None
+    step_count = 0
+
+    registers.clear()
+    for i in range(32):
+        registers[format(i, '05b')] = format(0, '032b')
+    registers['00010'] = format(256, '032b') # sp
+
+    data_memory.clear()
+    for i in range(0x10000, 0x1007F, 4):
+        data_memory[format(i, '08x')] = format(0, '032b')
+
+# Register and memory words stay '0'/'1' text, the execute functions read each operand once
+# with int(text, 2), compute on masked 32 bit values (alu.py) and write the result back
+# with format(). The verbose prints show values as signed.
 
 def execute_r_type(instruction: str):
     global program_counter
-    funct7 = instruction[:7]
     rs2 = instruction[7:12]
     rs1 = instruction[12:17]
-    funct3 = instruction[17:20]
     rd = instruction[20:25]
+    name, operation = r_ops[instruction[17:20], instruction[:7] != '0000000']
 
-    rs1_int, rs2_int, rs1_uint, rs2_uint = to_dec(registers[rs1]), to_dec(registers[rs2]), to_dec(registers[rs1], True), to_dec(registers[rs2], True)
-
-    result = None
-
-    if funct3 == '000':
-        if funct7 == '0000000': # x[rd] = x[rs1] + x[rs2]
-            result = rs1_int + rs2_int
-            print('add', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), reversesim.bin_to_abi(rs2), result)
-        else: # x[rd] = x[rs1] - x[rs2]
-            result = rs1_int - rs2_int
-            print('sub', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), reversesim.bin_to_abi(rs2), result)
-    elif funct3 == '001': # x[rd] = x[rs1] << x[rs2] (lower 5 bits)
-        result = rs1_int << to_dec(registers[rs2][-5:], True)
-        print('sll', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), reversesim.bin_to_abi(rs2, True), result)
-    elif funct3 == '010': # x[rd] = x[rs1] <s x[rs2]
-        result = 1 if rs1_int < rs2_int else 0
-        print('slt', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), reversesim.bin_to_abi(rs2), result)
-    elif funct3 == '011': # x[rd] = x[rs1] <u x[rs2]
-        result = 1 if rs1_uint < rs2_uint else 0
-        print('sltu', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1, True), reversesim.bin_to_abi(rs2, True), result)
-    elif funct3 == '100': # x[rd] = x[rs1] ^ x[rs2]
-        result = rs1_int ^ rs2_int
-        print('xor', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), reversesim.bin_to_abi(rs2), result)
-    elif funct3 == '101': # x[rd] = x[rs1] >>u x[rs2] (lower 5 bits)
-        result = rs1_int >> to_dec(registers[rs2][-5:], True)
-        print('srl', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), reversesim.bin_to_abi(rs2, True), result)
-    elif funct3 == '110': # x[rd] = x[rs1] | x[rs2]
-        result = rs1_int | rs2_int
-        print('or', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), reversesim.bin_to_abi(rs2), result)
-    elif funct3 == '111':
-        if funct7 == '0000000': # x[rd] = x[rs1] & x[rs2]
-            result = rs1_int & rs2_int
-            print('and', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), reversesim.bin_to_abi(rs2), result)
-        else: # BONUS: # x[rd] = x[rs1] * x[rs2]
-            result = rs1_int * rs2_int
-            print('mul', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), reversesim.bin_to_abi(rs2), result)
-    
-    program_counter += 4
+    result = operation(int(registers[rs1], 2), int(registers[rs2], 2))
+    if verbose:
+        # sltu compares and the shifts use their operands unsigned
+        print(name, reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1, name == 'sltu'),
+              reversesim.bin_to_abi(rs2, name in ('sltu', 'sll', 'srl')), to_signed(result))
 
-    registers[rd] = to_bin(result, 32)
-    # if funct7 != '0000000' and funct3 == '000': # sub
-    #     print(f'{rs1_int} - {rs2_int} = {result} : storing in x{int(rd,2)} : reg is {registers[rd]}')
+    program_counter += 4
+    registers[rd] = format(result, '032b')
 
 def execute_i_type(instruction: str):
     global program_counter
     opcode = instruction[-7:]
-    imm = instruction[-32:-20]
-    rs1 = instruction[-20:-15]
-    funct3 = instruction[-15:-12]
-    rd = instruction[-12:-7]
+    imm = int(instruction[:12], 2)
+    rs1 = instruction[12:17]
+    funct3 = instruction[17:20]
+    rd = instruction[20:25]
 
-    rs1_int = to_dec(registers[rs1])
-    result = None
+    imm_int = sign_extend(imm, 12)
+    rs1_value = int(registers[rs1], 2)
 
     if funct3 == '010' and opcode == '0000011': # lw
-        mem_addr = rs1_int + to_dec(imm)
-        result = to_dec(data_memory[format(mem_addr, '08x')])
+        result = int(data_memory[format(to_signed(rs1_value) + imm_int, '08x')], 2)
         program_counter += 4
-        print('lw', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), to_dec(imm), result)
+        if verbose: print('lw', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), imm_int, to_signed(result))
     elif funct3 == '000' and opcode == '0010011': # addi
-        result = rs1_int + to_dec(imm)
+        result = add(rs1_value, imm_int & MASK32)
         program_counter += 4
-        print('addi', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), to_dec(imm), result)
-    elif funct3 == '011' and opcode == '0010011': # sltiu
-        result = 1 if to_dec(registers[rs1], True) < to_dec(imm, True) else 0
-        print('sltiu', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), to_dec(imm), result)
+        if verbose: print('addi', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), imm_int, to_signed(result))
+    elif funct3 == '011' and opcode == '0010011': # sltiu, compares with the unsigned 12 bit field
+        result = sltu(rs1_value, imm)
+        if verbose: print('sltiu', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), imm_int, result)
         program_counter += 4
     elif funct3 == '000' and opcode == '1100111': # jalr
-        result = program_counter + 4
-        program_counter = (rs1_int + to_dec(imm))
-        print('jalr', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), to_dec(imm), result)
+        result = (program_counter + 4) & MASK32
+        program_counter = to_signed(rs1_value) + imm_int
+        if verbose: print('jalr', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), imm_int, result)
+    else:
+        raise ValueError(f"Unsupported I-type instruction at pc {program_counter}")
 
-    registers[rd] = to_bin(result, 32)
+    registers[rd] = format(result, '032b')
 
 def execute_s_type(instruction: str):
-    imm = instruction[:7] + instruction[20:25]
+    imm = sign_extend(int(instruction[:7] + instruction[20:25], 2), 12)
     rs2 = instruction[7:12]
     rs1 = instruction[12:17]
     # sw
-    mem_addr = to_dec(registers[rs1]) + to_dec(imm)
+    mem_addr = to_signed(int(registers[rs1], 2)) + imm
     data_memory[format(mem_addr, '08x')] = registers[rs2]
-    print('sw', reversesim.bin_to_abi(rs2), f'{to_dec(imm)}({reversesim.bin_to_abi(rs1)})', mem_addr)
+    if verbose: print('sw', reversesim.bin_to_abi(rs2), f'{imm}({reversesim.bin_to_abi(rs1)})', mem_addr)
     global program_counter
     program_counter += 4
 
 def execute_b_type(instruction: str):
     global program_counter
-    imm = instruction[0] + instruction[24] + instruction[1:7] + instruction[20:24] + '0'
-    rs2 = instruction[7:12]
-    rs1 = instruction[12:17]
-    funct3 = instruction[17:20]
-
-    rs1_int, rs2_int, rs1_uint, rs2_uint = to_dec(registers[rs1]), to_dec(registers[rs2]), to_dec(registers[rs1], True), to_dec(registers[rs2], True)
-    imm_int, imm_uint = to_dec(imm), to_dec(imm, True)
-
     if cur_instruction == VIRTUAL_HALT_INSTRUCTION_BIN:
-        print("VIRTUAL HALT")
+        if verbose: print("VIRTUAL HALT")
         return
 
-    if funct3 == '000': # if (x[rs1] == x[rs2]) pc += sext(offset)
-        if rs1_int == rs2_int:
-            program_counter += imm_int
-        else:
-            program_counter += 4
-        print('beq', reversesim.bin_to_abi(rs1), reversesim.bin_to_abi(rs2), imm_int, rs1_int == rs2_int)
-    elif funct3 == '001': # if (x[rs1] != x[rs2]) pc += sext(offset)
-        if rs1_int != rs2_int:
-            program_counter += imm_int
-        else:
-            program_counter += 4
-        print('bne', reversesim.bin_to_abi(rs1), reversesim.bin_to_abi(rs2), imm_int, rs1_int != rs2_int)
-    elif funct3 == '100': # if (x[rs1] < x[rs2]) pc += sext(offset)
-        if rs1_int < rs2_int:
-            program_counter += imm_int
-        else:
-            program_counter += 4
-        print('blt', reversesim.bin_to_abi(rs1), reversesim.bin_to_abi(rs2), imm_int, rs1_int < rs2_int)
-    elif funct3 == '101': # if (x[rs1] >= x[rs2]) pc += sext(offset)
-        if rs1_int >= rs2_int:
-            program_counter += imm_int
-        else:
-            program_counter += 4
-        print('bge', reversesim.bin_to_abi(rs1), reversesim.bin_to_abi(rs2), imm_int, rs1_int >= rs2_int)
-    elif funct3 == '110': # if (x[rs1] <u x[rs2]) pc += sext(offset)
-        if rs1_uint < rs2_uint:
-            program_counter += imm_uint
-        else:
-            program_counter += 4
-        print('bltu', reversesim.bin_to_abi(rs1, True), reversesim.bin_to_abi(rs2, True), imm_int, rs1_uint < rs2_uint)
-    elif funct3 == '111': # if (x[rs1] >=u x[rs2]) pc += sext(offset)
-        if rs1_uint >= rs2_uint:
-            program_counter += imm_uint
-        else:
-            program_counter += 4
-        print('bgeu', reversesim.bin_to_abi(rs1, True), reversesim.bin_to_abi(rs2, True), imm_int, rs1_uint >= rs2_uint)
+    entry = b_ops.get(instruction[17:20])
+    if entry is None: # funct3 010 and 011 are no branch, the pc stays
+        return
+    name, condition = entry
+    imm = int(instruction[0] + instruction[24] + instruction[1:7] + instruction[20:24] + '0', 2)
+    rs2 = instruction[7:12]
+    rs1 = instruction[12:17]
+
+    imm_int = sign_extend(imm, 13)
+    # bltu and bgeu compare unsigned and jump by the unsigned offset
+    unsigned = name == 'bltu' or name == 'bgeu'
+    taken = condition(int(registers[rs1], 2), int(registers[rs2], 2))
+    if taken:
+        program_counter += imm if unsigned else imm_int
+    else:
+        program_counter += 4
+    if verbose: print(name, reversesim.bin_to_abi(rs1, unsigned), reversesim.bin_to_abi(rs2, unsigned), imm_int, taken)
 
 def execute_u_type(instruction: str):
     global program_counter
     opcode = instruction[-7:]
-    imm = instruction[:20] + format(0, '012b')
+    upper = int(instruction[:20], 2)
     rd = instruction[20:25]
 
-    result = None
-
     if opcode == "0110111": # x[rd] = sext(immediate[31:12] << 12)
-        result = to_dec(imm)
-        print('lui', reversesim.bin_to_abi(rd), to_dec(instruction[:20]), result)
+        result = upper << 12
+        if verbose: print('lui', reversesim.bin_to_abi(rd), sign_extend(upper, 20), to_signed(result))
     else: # x[rd] = pc + sext(immediate[31:12] << 12)
-        result = program_counter + to_dec(imm)
-        print('auipc', reversesim.bin_to_abi(rd), to_dec(instruction[:20]), result)
+        result = add(program_counter, upper << 12)
+        if verbose: print('auipc', reversesim.bin_to_abi(rd), sign_extend(upper, 20), to_signed(result))
 
     program_counter += 4
-    registers[rd] = to_bin(result, 32)
+    registers[rd] = format(result, '032b')
 
 def execute_j_type(instruction: str):
-    imm = instruction[0] + instruction[12:20] + instruction[11] + instruction[1:11] + '0'
+    imm = sign_extend(int(instruction[0] + instruction[12:20] + instruction[11] + instruction[1:11] + '0', 2), 21)
     rd = instruction[20:25]
 
     global program_counter
     result = program_counter + 4
-    program_counter = program_counter + to_dec(imm)
+    program_counter = program_counter + imm
 
-    print('jal', reversesim.bin_to_abi(rd), to_dec(imm), result, program_counter)
+    if verbose: print('jal', reversesim.bin_to_abi(rd), imm, result, program_counter)
 
-    registers[rd] = to_bin(result, 32)
-
-
-out_string = ""
+    registers[rd] = format(result & MASK32, '032b')
 
 def print_registers():
-    global out_string
-    out_string += "0b" + format(program_counter, '032b') + " "
-    for i, reg_data in enumerate(registers.values()):
-        out_string += "0b" + reg_data + " "
-    out_string += "\n"
-
+    trace_writer.write("0b" + format(program_counter, '032b') + " 0b" + " 0b".join(registers.values()) + " \n")
 
-i = 0
-while True:
-    i += 1
+# executes the instruction at program_counter, returns False once a halt was reached
+def step():
+    global program_counter, cur_instruction, step_count
+    step_count += 1
     cur_instruction = program_memory[program_counter]
-    reversesim.reg_mem = registers
-    print(f"#{i:02d} {program_counter:02d}", end=": ")
+    if verbose:
+        reversesim.reg_mem = registers
+        print(f"#{step_count:02d} {program_counter:02d}", end=": ")
 
     opcode = cur_instruction[-7:]
-    # if cur_instruction == "00000000000000000000000001100011":
-    #     print("HALT")
-    #     break
 
     # BOUNS
     if cur_instruction == "00000000000000000000000001111111": # rst
         for i in range(32):
             registers[format(i, '05b')] = format(0, '032b')
         registers['00010'] = format(256, '032b')
-        print("rst", [val == format(0, '032b') for i, val in enumerate(registers.values()) if i != 2] == [True]*31)
+        if verbose: print("rst", [val == format(0, '032b') for i, val in enumerate(registers.values()) if i != 2] == [True]*31)
         program_counter += 4
     # BOUNS
     elif cur_instruction == "11111111111111111111111111111111": # halt
-        print("halt")
-        print_registers()
-        break
+        if verbose: print("halt")
+        return False
     # BONUS
     elif opcode == '0000001': # rvrs rd, rs1
         rd = cur_instruction[-12:-7]
         rs1 = cur_instruction[-20:-15]
         registers[rd] = registers[rs1][::-1]
-        print('rvrs', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), registers[rd])
+        if verbose: print('rvrs', reversesim.bin_to_abi(rd), reversesim.bin_to_abi(rs1), registers[rd])
         program_counter += 4
     elif opcode == "0110011": # R-type
         execute_r_type(cur_instruction)
@@ -270,17 +208,197 @@ while True:
     elif opcode == "1101111": # J-type
         execute_j_type(cur_instruction)
 
-    registers['00000'] = format(0, '032b') # x0 is hardwired to 0
-    
-    print_registers()
-    # print(i, out_string.strip().split('\n')[-1].split()[20] if len(out_string.split('\n')) > 1 else "")
-    # print x19 
-
-    if cur_instruction == VIRTUAL_HALT_INSTRUCTION_BIN:
-        break
-
-for addr, data in data_memory.items():
-    out_string += "0x" + addr + ":0b" + data + "\n"
+    registers['00000'] = ZERO_WORD # x0 is hardwired to 0
+
+    return cur_instruction != VIRTUAL_HALT_INSTRUCTION_BIN
+
+# runs the program in in_file on the string engine and writes its trace to out_file
+def simulate(in_file, out_file, level=TRACE_REGS, flush_size=DEFAULT_FLUSH_SIZE, compress=None):
+    with open(in_file) as f:
+        simulate_lines(f.readlines(), out_file, level, flush_size, compress)
+
+# simulate() for a program that is already in memory, one 32 bit binary word per line
+def simulate_lines(lines, out_file, level=TRACE_REGS, flush_size=DEFAULT_FLUSH_SIZE, compress=None):
+    global trace_level, verbose, trace_writer, reversesim
+    trace_level = level
+    verbose = level >= TRACE_VERBOSE
+    if verbose and reversesim is None:
+        import reversesim
+    load_program(lines)
+
+    trace_writer = TraceWriter(out_file, flush_size, compress) if level >= TRACE_FINAL else None
+    try:
+        while step():
+            if trace_level >= TRACE_REGS: print_registers()
+        if trace_level >= TRACE_FINAL:
+            print_registers()
+            for addr, data in data_memory.items():
+                trace_writer.write("0x" + addr + ":0b" + data + "\n")
+    finally:
+        # whatever was traced still reaches the file if the run crashes
+        if trace_writer is not None:
+            trace_writer.close()
+
+# --serve: one warm process runs many jobs. Every line on stdin holds the arguments of one
+# run as they would be given on the command line, every answer is one JSON line with the
+# exit status and whatever the run printed.
+def serve():
+    import io
+    import json
+    import shlex
+    import traceback
+    from contextlib import redirect_stdout, redirect_stderr
+    import argparse, machine, image, reversesim # loaded once for all jobs
+    out = sys.stdout
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                argv = shlex.split(line)
+                if '--serve' in argv:
+                    print("--serve cannot be used in a job", file=sys.stderr)
+                    status = 2
+                else:
+                    status = main(argv)
+            except SystemExit as e: # argparse errors and --help
+                status = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+        out.write(json.dumps({'status': status, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}) + "\n")
+        out.flush()
+    return 0
+
+# assembles a source file with the assembler of SimpleAssembler, returns {pc -> word} or
+# None after printing the first error
+def assemble_file(path):
+    import machine # puts SimpleAssembler on the path
+    import Assembler
+    with open(path) as f:
+        result = Assembler.Assembler().assemble(f.read())
+    if result.diagnostics:
+        print(Assembler.diagnostic_text(result.diagnostics[0]), file=sys.stderr)
+        return None
+    return Assembler.program_memory(result)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    # the plain 'Simulator.py in_file out_file' call runs without argparse, which costs
+    # more to import than the string engine itself
+    if len(argv) == 2 and not any(arg.startswith('-') for arg in argv):
+        import machine # puts SimpleAssembler with image.py on the path
+        import image
+        if not image.is_image(argv[0]):
+            simulate(argv[0], argv[1])
+            return 0
+
+    import argparse
+    parser = argparse.ArgumentParser(description="RISC-V simulator, writes the register/memory trace of a program")
+    parser.add_argument('in_file', nargs='?', help="assembled program, one 32 bit binary word per line or a program image")
+    parser.add_argument('out_file', nargs='?', help="trace output")
+    parser.add_argument('--assemble-and-run', action='store_true', help="in_file is assembly source, it is assembled in this process and run")
+    parser.add_argument('--serve', action='store_true', help="read the arguments of one run per line on stdin and answer each with a JSON line (status, stdout, stderr)")
+    parser.add_argument('--int', action='store_true', help="run on the integer backed machine state (machine.py)")
+    parser.add_argument('--jit', action='store_true', help="run translated basic blocks, implies --int and needs --trace none or final")
+    parser.add_argument('--trace', choices=TRACE_LEVELS, default='regs',
+                        help="none, final state only, registers after every step (default) or verbose disassembly on stdout")
+    parser.add_argument('--flush-size', type=int, default=DEFAULT_FLUSH_SIZE, help="characters buffered before the trace is written out")
+    parser.add_argument('--compress', choices=['gzip', 'zstd'], help="compress the trace (default: from the .gz/.zst extension of out_file)")
+    parser.add_argument('--trace-format', choices=['text', 'binary'], default='text',
+                        help="text trace or the indexed binary trace of bintrace.py (implies --int)")
+    parser.add_argument('--max-steps', type=int, help="stop after this many instructions (implies --int)")
+    parser.add_argument('--timeout', type=float, help="stop after this many seconds (implies --int), checked every 65536 steps: a long translated block or slow mmio device can overrun it")
+    parser.add_argument('--detect-stuck', action='store_true', help="stop a run whose machine state repeats, it could never halt (implies --int)")
+    parser.add_argument('--memory', choices=['window', 'paged'], default='window',
+                        help="data memory of Simulator.py (default) or sparse paged memory, whose dump covers the pages the run wrote (implies --int)")
+    parser.add_argument('--memory-map', help="regions of the paged memory as name:start-end[:ram|rom|mmio],... (implies --memory paged)")
+    parser.add_argument('--profile', metavar='REPORT', help="write an execution profile: hot pcs, branches, instruction mix, cycles (implies --int)")
+    parser.add_argument('--folded', metavar='FILE', help="write flamegraph folded stacks built from jal/jalr calls (implies --int)")
+    parser.add_argument('--cpi', help="cycles per instruction for the profile, a JSON file or name=cycles,... (e.g. lw=3,branch_taken=2)")
+    parser.add_argument('--timing', metavar='REPORT', help="estimate cycles with the pipeline and cache model of timing.py, REPORT is text or .json (implies --int)")
+    parser.add_argument('--timing-config', metavar='SPEC', help="timing model settings, a JSON file or name=value,... (e.g. predictor=gshare,dcache_size=8192)")
+    parser.add_argument('--checkpoint', metavar='SNAPSHOT', help="save the machine state to this file every --checkpoint-every steps (implies --int)")
+    parser.add_argument('--checkpoint-every', type=int, default=1000000, metavar='N', help="steps between checkpoints (default 1000000)")
+    parser.add_argument('--resume', metavar='SNAPSHOT', help="continue from a saved snapshot instead of the start of in_file, the trace is continued where the snapshot left it (implies --int)")
+    args = parser.parse_args(argv)
+    if args.serve:
+        if args.in_file is not None:
+            parser.error("--serve takes no files, the jobs are read from stdin")
+        return serve()
+    if args.out_file is None:
+        parser.error("in_file and out_file are required")
+    level = TRACE_LEVELS[args.trace]
+    if args.jit and level >= TRACE_REGS:
+        parser.error("--jit needs --trace none or final")
+    if args.timing is not None and (args.jit or args.profile is not None or args.folded is not None):
+        parser.error("--timing runs its own loop, it cannot be combined with --jit or --profile")
+
+    # run on the integer backed machine state (machine.py), the trace is identical. Program
+    # images (image.py in SimpleAssembler) are only read by the integer machine.
+    import machine
+    import image
+    program = None
+    if args.assemble_and_run:
+        program = assemble_file(args.in_file)
+        if program is None:
+            return 1
+    paged = args.memory == 'paged' or args.memory_map is not None
+    profile = args.profile is not None or args.folded is not None
+    if (args.int or args.jit or args.trace_format == 'binary' or args.max_steps is not None or args.timeout is not None
+            or args.detect_stuck or paged or profile or args.timing is not None or args.checkpoint is not None or args.resume is not None
+            or (image.is_image(args.in_file) if program is None else getattr(program, 'data', None))):
+        memory = None
+        if paged:
+            import memory as paged_memory
+            try:
+                memory_map = paged_memory.parse_memory_map(args.memory_map) if args.memory_map else paged_memory.DEFAULT_MEMORY_MAP
+                memory = paged_memory.PagedMemory(memory_map)
+            except ValueError as e:
+                parser.error(str(e))
+        trace_offset = None
+        if args.resume is not None:
+            import snapshot
+            try:
+                m, trace_offset = snapshot.load(args.resume)
+            except (OSError, ValueError) as e:
+                parser.error(f"cannot resume from {args.resume}: {e}")
+        else:
+            m = machine.Machine(program if program is not None else machine.read_program(args.in_file), memory)
+        prof = None
+        if profile:
+            import profiler
+            prof = profiler.Profiler(m, profiler.parse_cpi(args.cpi) if args.cpi else profiler.DEFAULT_CPI)
+        if args.timing is not None:
+            import timing
+            try:
+                prof = timing.Timing(m, timing.parse_timing(args.timing_config) if args.timing_config else timing.DEFAULT_TIMING)
+            except (OSError, ValueError) as e:
+                parser.error(f"bad --timing-config: {e}")
+        on_checkpoint = None
+        if args.checkpoint is not None:
+            import snapshot
+            on_checkpoint = lambda m, offset: snapshot.save(m, args.checkpoint, offset)
+        machine.simulate(m, args.out_file, level, args.jit, args.flush_size, args.compress,
+                         args.trace_format, args.max_steps, args.timeout, prof,
+                         args.checkpoint_every, on_checkpoint, trace_offset, args.detect_stuck)
+        if args.timing is not None:
+            prof.write(args.timing)
+        elif prof is not None:
+            prof.write(args.profile, args.folded)
+        if m.exit_reason != machine.EXIT_HALT:
+            print(f"{args.in_file}: stopped after {m.steps} steps at pc {m.pc}: {m.exit_reason}"
+                  + (f" ({m.error})" if m.error else ""), file=sys.stderr)
+            return 1
+        return 0
+
+    if program is not None:
+        simulate_lines([format(word, '032b') for word in program.values()], args.out_file, level, args.flush_size, args.compress)
+    else:
+        simulate(args.in_file, args.out_file, level, args.flush_size, args.compress)
+    return 0
 
-with open(out_file, "w") as f:
-    f.write(out_string)
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+# 32 bit arithmetic shared by the simulator engines. Register values are unsigned Python
+# ints masked to 32 bits, the signed view of a value is one subtraction (to_signed) and
+# signed comparisons flip the sign bit so they can compare the unsigned words directly.
+# Shift amounts are the low 5 bits of the second operand and srl is a logical shift.
+
+MASK32 = 0xFFFFFFFF
+SIGN32 = 0x80000000
+SHAMT_MASK = 0x1F
+
+# bit reversal of every byte, used by the bonus rvrs instruction
+REVERSED_BYTES = bytes(int(format(i, '08b')[::-1], 2) for i in range(256))
+
+def to_signed(value):
+    return value - 0x100000000 if value & SIGN32 else value
+
+# the signed value of a `bits` wide two's complement field
+def sign_extend(value, bits):
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+def reverse_bits(value):
+    return (REVERSED_BYTES[value & 0xFF] << 24 | REVERSED_BYTES[(value >> 8) & 0xFF] << 16
+            | REVERSED_BYTES[(value >> 16) & 0xFF] << 8 | REVERSED_BYTES[value >> 24])
+
+def add(a, b):
+    return (a + b) & MASK32
+
+def sub(a, b):
+    return (a - b) & MASK32
+
+def sll(a, b):
+    return (a << (b & SHAMT_MASK)) & MASK32
+
+def slt(a, b):
+    return 1 if a ^ SIGN32 < b ^ SIGN32 else 0
+
+def sltu(a, b):
+    return 1 if a < b else 0
+
+def xor(a, b):
+    return a ^ b
+
+def srl(a, b):
+    return a >> (b & SHAMT_MASK)
+
+def or_(a, b):
+    return a | b
+
+def and_(a, b):
+    return a & b
+
+def mul(a, b): # BONUS
+    return (a * b) & MASK32
+
+# branch conditions
+def eq(a, b):
+    return a == b
+
+def ne(a, b):
+    return a != b
+
+def lt(a, b):
+    return a ^ SIGN32 < b ^ SIGN32
+
+def ge(a, b):
+    return a ^ SIGN32 >= b ^ SIGN32
+
+def ltu(a, b):
+    return a < b
+
+def geu(a, b):
+    return a >= b
+
+# (funct3, funct7 != 0) -> (name, operation), every funct7 other than 0 selects sub/mul
+R_OPS = {
+    (0b000, False): ('add', add), (0b000, True): ('sub', sub),
+    (0b001, False): ('sll', sll), (0b001, True): ('sll', sll),
+    (0b010, False): ('slt', slt), (0b010, True): ('slt', slt),
+    (0b011, False): ('sltu', sltu), (0b011, True): ('sltu', sltu),
+    (0b100, False): ('xor', xor), (0b100, True): ('xor', xor),
+    (0b101, False): ('srl', srl), (0b101, True): ('srl', srl),
+    (0b110, False): ('or', or_), (0b110, True): ('or', or_),
+    (0b111, False): ('and', and_), (0b111, True): ('mul', mul),
+}
+
+# funct3 -> (name, condition)
+B_OPS = {
+    0b000: ('beq', eq), 0b001: ('bne', ne), 0b100: ('blt', lt),
+    0b101: ('bge', ge), 0b110: ('bltu', ltu), 0b111: ('bgeu', geu),
+}
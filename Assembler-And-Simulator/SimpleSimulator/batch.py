@@ -0,0 +1,186 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import multiprocessing
+from multiprocessing.connection import wait
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import machine
+from tracing import TRACE_LEVELS, TRACE_NONE
+
+# Batch runner: simulates many assembled programs in parallel on a process pool using the
+# machine.py engine, with a step limit and a wall clock limit per job, and reports steps,
+# wall time and exit reason for every job. Jobs whose machine state repeats can never
+# halt and are stopped as 'stuck' unless --no-stuck-detection is given.
+#
+# Jobs come from a directory (every file matching --pattern) or from a manifest file with
+# one "program [trace]" pair per line, paths relative to the manifest, '#' starts a comment.
+#
+# The machine checks the wall clock limit only between chunks of machine.CHUNK_STEPS steps,
+# so a long translated block or a slow mmio callback can overrun it. With a limit the jobs
+# run on workers of run_killable, which kills and replaces a worker whose job is still
+# running KILL_GRACE seconds later.
+
+KILL_GRACE = 1.0
+
+def load_jobs(source, pattern='*.txt', out_dir=None):
+    jobs = []
+    if os.path.isdir(source):
+        for program in sorted(glob.glob(os.path.join(source, pattern))):
+            jobs.append((program, None))
+    else:
+        base = os.path.dirname(source)
+        with open(source) as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if not line:
+                    continue
+                parts = line.split()
+                program = os.path.join(base, parts[0])
+                trace = os.path.join(base, parts[1]) if len(parts) > 1 else None
+                jobs.append((program, trace))
+    if out_dir is not None:
+        jobs = [(program, trace or os.path.join(out_dir, os.path.basename(program) + '.trace')) for program, trace in jobs]
+    return jobs
+
+# runs one program in a worker process and returns its summary
+def run_job(program, trace=None, level=TRACE_NONE, jit=False, max_steps=None, max_seconds=None, detect_stuck=True):
+    start = time.perf_counter()
+    result = {'program': program, 'exit_reason': None, 'steps': 0, 'pc': None, 'wall_time': 0.0, 'error': None}
+    try:
+        m = machine.Machine(machine.read_program(program))
+        machine.simulate(m, trace, level if trace else TRACE_NONE, jit, max_steps=max_steps, max_seconds=max_seconds,
+                         detect_stuck=detect_stuck)
+        result.update(exit_reason=m.exit_reason, steps=m.steps, pc=m.pc, error=m.error)
+    except Exception as e:
+        result.update(exit_reason=machine.EXIT_FAULT, error=f"{type(e).__name__}: {e}")
+    result['wall_time'] = round(time.perf_counter() - start, 6)
+    return result
+
+def failed_job(program, reason, error, wall_time=0.0):
+    return {'program': program, 'exit_reason': reason, 'steps': 0, 'pc': None, 'wall_time': round(wall_time, 6),
+            'error': error}
+
+def run_batch(jobs, workers=None, level=TRACE_NONE, jit=False, max_steps=None, max_seconds=None, on_result=None,
+              detect_stuck=True):
+    if max_seconds is not None:
+        return run_killable(jobs, workers, level, jit, max_steps, max_seconds, on_result, detect_stuck)
+    results = [None] * len(jobs)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_job, program, trace, level, jit, max_steps, max_seconds, detect_stuck): i
+                   for i, (program, trace) in enumerate(jobs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e: # the worker itself died
+                results[i] = failed_job(jobs[i][0], machine.EXIT_FAULT, f"{type(e).__name__}: {e}")
+            if on_result is not None:
+                on_result(results[i])
+    return results
+
+# a long-lived worker process of run_killable: runs the jobs it is sent until it gets None
+def serve_jobs(conn):
+    for args in iter(conn.recv, None):
+        conn.send(run_job(*args))
+
+def start_worker():
+    conn, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve_jobs, args=(child,), daemon=True)
+    process.start()
+    child.close()
+    return process, conn
+
+# run_batch with a time limit: a fixed set of workers, each fed one job at a time over a pipe
+# of its own. Only a worker still busy KILL_GRACE seconds after max_seconds is killed and
+# replaced, or one that died.
+def run_killable(jobs, workers, level, jit, max_steps, max_seconds, on_result, detect_stuck):
+    results = [None] * len(jobs)
+    waiting = list(enumerate(jobs))[::-1]
+    idle = [start_worker() for _ in range(min(workers or os.cpu_count() or 1, len(jobs)))]
+    busy = {} # pipe -> (worker, job index, start time)
+    try:
+        while waiting or busy:
+            while waiting and idle:
+                i, (program, trace) = waiting.pop()
+                process, conn = worker = idle.pop()
+                conn.send((program, trace, level, jit, max_steps, max_seconds, detect_stuck))
+                busy[conn] = (worker, i, time.monotonic())
+            first_kill = min(start for _, _, start in busy.values()) + max_seconds + KILL_GRACE
+            ready = wait(list(busy), max(0.0, first_kill - time.monotonic()))
+            now = time.monotonic()
+            for conn, (worker, i, start) in list(busy.items()):
+                process = worker[0]
+                if conn in ready:
+                    try:
+                        result = conn.recv()
+                    except EOFError: # the worker died before sending its summary
+                        process.join()
+                        result = failed_job(jobs[i][0], machine.EXIT_FAULT,
+                                            f"worker exited with code {process.exitcode}", now - start)
+                elif now - start >= max_seconds + KILL_GRACE:
+                    process.kill()
+                    process.join()
+                    result = failed_job(jobs[i][0], machine.EXIT_TIMEOUT, f"killed after {now - start:.3f}s", now - start)
+                else:
+                    continue
+                del busy[conn]
+                if process.is_alive():
+                    idle.append(worker)
+                else:
+                    conn.close()
+                    if waiting:
+                        idle.append(start_worker())
+                results[i] = result
+                if on_result is not None:
+                    on_result(result)
+    finally:
+        for process, conn in idle + [worker for worker, _, _ in busy.values()]:
+            if process.is_alive() and conn not in busy:
+                conn.send(None)
+            else:
+                process.kill()
+            process.join()
+            conn.close()
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate many programs in parallel")
+    parser.add_argument('source', help="directory of assembled programs or a manifest file")
+    parser.add_argument('--pattern', default='*.txt', help="program file pattern when source is a directory")
+    parser.add_argument('-j', '--jobs', type=int, help="worker processes (default: cpu count)")
+    parser.add_argument('--max-steps', type=int, help="step limit per job")
+    parser.add_argument('--timeout', type=float, help="wall clock limit per job in seconds, a job still running %gs later is killed" % KILL_GRACE)
+    parser.add_argument('--no-stuck-detection', action='store_true', help="keep running jobs whose machine state repeats (they never halt)")
+    parser.add_argument('--jit', action='store_true', help="run translated basic blocks (only with --trace none or final)")
+    parser.add_argument('--out-dir', help="write a trace for every job into this directory")
+    parser.add_argument('--trace', choices=TRACE_LEVELS, default='regs', help="trace level of the written traces")
+    parser.add_argument('--summary', help="write the per-job summary as JSON to this file")
+    args = parser.parse_args(argv)
+
+    if args.out_dir is not None:
+        os.makedirs(args.out_dir, exist_ok=True)
+    jobs = load_jobs(args.source, args.pattern, args.out_dir)
+    if not jobs:
+        print(f"no programs found in {args.source}", file=sys.stderr)
+        return 1
+
+    start = time.perf_counter()
+    print_result = lambda r: print(f"{r['exit_reason']:<10} {r['steps']:>12} {r['wall_time']:>10.3f}s  {r['program']}"
+                                   + (f"  ({r['error']})" if r['error'] else ""))
+    results = run_batch(jobs, args.jobs, TRACE_LEVELS[args.trace], args.jit, args.max_steps, args.timeout, print_result,
+                        not args.no_stuck_detection)
+    elapsed = time.perf_counter() - start
+
+    halted = sum(r['exit_reason'] == machine.EXIT_HALT for r in results)
+    steps = sum(r['steps'] for r in results)
+    print(f"{len(results)} jobs, {halted} halted, {steps} steps in {elapsed:.3f}s")
+    if args.summary is not None:
+        with open(args.summary, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0 if halted == len(results) else 2
+
+if __name__ == "__main__":
+    sys.exit(main())
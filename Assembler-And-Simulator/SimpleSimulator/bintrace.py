@@ -0,0 +1,191 @@
+import sys
+import struct
+from array import array
+
+# Compact binary trace. Instead of 33 '0b...' words per step every record stores the pc
+# and only the registers that changed, with a full keyframe every `interval` steps. An
+# index file (<trace>.idx) written on close holds the keyframe offsets and the first step
+# each pc was executed at, so a reader can jump to step N or to the first visit of a pc
+# by replaying at most `interval` records.
+#
+# trace file:  header  '<4sHI'  magic, version, keyframe interval
+#              'K' '<qi32I'      step, pc, all registers
+#              'D' '<iI' + n*I   pc, mask of changed registers, their new values
+#              'M' '<I' + n*qI   final memory dump as (address, word) pairs
+# index file:  header  '<4sHIQQ' magic, version, interval, steps, offset of the memory record
+#              '<I' count, count * '<Q' keyframe offsets (keyframe k is at step k*interval)
+#              '<I' count, count * '<iQ' (pc, first step)
+
+TRACE_MAGIC = b'RVBT'
+INDEX_MAGIC = b'RVBI'
+VERSION = 1
+DEFAULT_INTERVAL = 1024
+
+TAG_KEYFRAME = ord('K')
+TAG_DELTA = ord('D')
+TAG_MEMORY = ord('M')
+
+HEADER = struct.Struct('<4sHI')
+KEYFRAME = struct.Struct('<qi32I')
+DELTA = struct.Struct('<iI')
+INDEX_HEADER = struct.Struct('<4sHIQQ')
+
+def index_path(path):
+    return path + '.idx'
+
+
+class BinaryTraceWriter:
+    def __init__(self, path, interval=DEFAULT_INTERVAL):
+        self.path = path
+        self.f = open(path, 'wb')
+        self.f.write(HEADER.pack(TRACE_MAGIC, VERSION, interval))
+        self.interval = interval
+        self.steps = 0
+        self.prev = array('I', [0] * 32)
+        self.keyframes = []
+        self.first_visit = {}
+
+    # records the state after one step, pc is the pc the machine will continue from
+    def step(self, pc, regs):
+        f = self.f
+        if pc not in self.first_visit:
+            self.first_visit[pc] = self.steps
+        if self.steps % self.interval == 0:
+            self.keyframes.append(f.tell())
+            f.write(bytes((TAG_KEYFRAME,)) + KEYFRAME.pack(self.steps, pc, *regs))
+            self.prev = array('I', regs)
+        else:
+            prev = self.prev
+            mask = 0
+            changed = []
+            if regs != prev:
+                for i in range(32):
+                    if regs[i] != prev[i]:
+                        mask |= 1 << i
+                        changed.append(regs[i])
+                        prev[i] = regs[i]
+            f.write(bytes((TAG_DELTA,)) + DELTA.pack(pc, mask) + struct.pack(f'<{len(changed)}I', *changed))
+        self.steps += 1
+
+    # memory is a list of (address, word) pairs in dump order
+    def close(self, memory=()):
+        memory_offset = self.f.tell()
+        self.f.write(bytes((TAG_MEMORY,)) + struct.pack('<I', len(memory)))
+        for addr, word in memory:
+            self.f.write(struct.pack('<qI', addr, word))
+        self.f.close()
+        with open(index_path(self.path), 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, VERSION, self.interval, self.steps, memory_offset))
+            f.write(struct.pack(f'<I{len(self.keyframes)}Q', len(self.keyframes), *self.keyframes))
+            f.write(struct.pack('<I', len(self.first_visit)))
+            for pc, step in sorted(self.first_visit.items()):
+                f.write(struct.pack('<iQ', pc, step))
+
+
+class BinaryTrace:
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        magic, version, self.interval = HEADER.unpack(self.f.read(HEADER.size))
+        if magic != TRACE_MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a binary trace")
+        with open(index_path(path), 'rb') as f:
+            data = f.read()
+        magic, version, interval, self.steps, self.memory_offset = INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC or version != VERSION:
+            raise ValueError(f"{index_path(path)} is not a binary trace index")
+        pos = INDEX_HEADER.size
+        count, = struct.unpack_from('<I', data, pos)
+        self.keyframes = list(struct.unpack_from(f'<{count}Q', data, pos + 4))
+        pos += 4 + 8 * count
+        count, = struct.unpack_from('<I', data, pos)
+        self.first_visits = {}
+        for i in range(count):
+            pc, step = struct.unpack_from('<iQ', data, pos + 4 + 12 * i)
+            self.first_visits[pc] = step
+
+    def close(self):
+        self.f.close()
+
+    # yields (step, pc, registers) starting at the keyframe before `start`
+    def states(self, start=0):
+        if not 0 <= start < self.steps:
+            return
+        f = self.f
+        f.seek(self.keyframes[start // self.interval])
+        regs = array('I', [0] * 32)
+        step = pc = None
+        while True:
+            tag = f.read(1)[0]
+            if tag == TAG_KEYFRAME:
+                step, pc, *values = KEYFRAME.unpack(f.read(KEYFRAME.size))
+                regs = array('I', values)
+            elif tag == TAG_DELTA:
+                pc, mask = DELTA.unpack(f.read(DELTA.size))
+                changed = array('I', f.read(4 * bin(mask).count('1')))
+                if sys.byteorder != 'little':
+                    changed.byteswap()
+                j = 0
+                for i in range(32):
+                    if mask >> i & 1:
+                        regs[i] = changed[j]
+                        j += 1
+                step += 1
+            else:
+                return
+            if step >= start:
+                yield step, pc, regs
+
+    # (pc, registers) after step n
+    def state_at(self, n):
+        for step, pc, regs in self.states(n):
+            return pc, list(regs)
+        raise IndexError(f"step {n} is outside the trace ({self.steps} steps)")
+
+    # first step after which the machine was about to execute pc, None if it never was
+    def first_visit(self, pc):
+        return self.first_visits.get(pc)
+
+    def memory(self):
+        self.f.seek(self.memory_offset + 1)
+        count, = struct.unpack('<I', self.f.read(4))
+        return [struct.unpack('<qI', self.f.read(12)) for i in range(count)]
+
+
+# writes the binary trace back out in the '0b...' text format of Simulator.py
+def to_text(path, out_path):
+    trace = BinaryTrace(path)
+    with open(out_path, 'w') as out:
+        for step, pc, regs in trace.states():
+            out.write("0b" + format(pc, '032b') + " 0b" + " 0b".join([format(r, '032b') for r in regs]) + " \n")
+        for addr, word in trace.memory():
+            out.write("0x" + format(addr, '08x') + ":0b" + format(word, '032b') + "\n")
+    trace.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Inspect or convert binary simulator traces")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('totext', help="convert to the text trace format")
+    p.add_argument('trace')
+    p.add_argument('out')
+    p = sub.add_parser('show', help="print the state after a step, or at the first visit of a pc")
+    p.add_argument('trace')
+    group = p.add_mutually_exclusive_group(required=True)
+    group.add_argument('--step', type=int)
+    group.add_argument('--pc', type=lambda s: int(s, 0))
+    args = parser.parse_args()
+
+    if args.command == 'totext':
+        to_text(args.trace, args.out)
+    else:
+        trace = BinaryTrace(args.trace)
+        step = args.step
+        if args.pc is not None:
+            step = trace.first_visit(args.pc)
+            if step is None:
+                sys.exit(f"pc {args.pc} is never reached")
+        pc, regs = trace.state_at(step)
+        print(f"step {step}: pc {pc}")
+        for i, value in enumerate(regs):
+            print(f"x{i}: {value} (0x{value:08x})")
@@ -0,0 +1,242 @@
+import sys
+from array import array
+from collections import namedtuple
+import Simulator
+import machine
+import reversesim
+from tracing import abi
+
+# Lockstep co-simulation. The string engine of Simulator.py is the reference model (the
+# traces it writes are the expected ones) and a machine.py engine, the interpreter or the
+# jit, runs the same program next to it. Every `every` steps the two have to agree on the
+# step count, the pc, all registers, whether the run has ended and every memory word
+# either of them stored to since the last comparison. Once both have ended the whole
+# memory dump, order included, has to be the same as well.
+#
+# When a comparison fails after more than one step both engines are put back to the last
+# point where they agreed and run again one instruction (with the jit one block) at a
+# time, so the report names the first instruction or block whose result differs and only
+# the values that differ.
+
+CosimResult = namedtuple('CosimResult', ['steps', 'outcome', 'end', 'divergence'])  # outcome 'match', 'diverged' or 'step_limit'
+Divergence = namedtuple('Divergence', ['step', 'pc', 'word', 'differences', 'note'])
+
+# the data memory of the string engine, remembering which addresses were stored to
+class TouchedDict(dict):
+    def __init__(self):
+        super().__init__()
+        self.touched = set()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.touched.add(key)
+
+def value_text(value):
+    if value is None:
+        return "never stored"
+    return f"0x{value:08x} ({value - 0x100000000 if value & 0x80000000 else value})"
+
+
+class Lockstep:
+    def __init__(self, lines, jit=False, every=1):
+        self.every = every
+        self.jit = jit
+        self.engine = 'jit' if jit else 'int'
+
+        Simulator.verbose = False
+        if not isinstance(Simulator.data_memory, TouchedDict):
+            Simulator.data_memory = TouchedDict()
+        Simulator.load_program(lines)
+        Simulator.data_memory.touched.clear()
+        self.ref_running = True
+        self.ref_error = None
+
+        m = self.m = machine.Machine(machine.parse_program(lines))
+        self.fast_error = None
+        self.touched = set()
+        store_word = m.store_word
+        def recording_store_word(addr, value):
+            self.touched.add(addr)
+            store_word(addr, value)
+        m.store_word = recording_store_word
+        if jit:
+            import translator
+            self.run_fast = translator.translator_for(m).run
+        else:
+            self.run_fast = lambda n: m.run(None, n)
+
+    def reference_step(self):
+        try:
+            self.ref_running = Simulator.step()
+        except Exception as e:
+            self.ref_error = e
+            self.ref_running = False
+
+    # Simulator.step() counts an instruction before running it, a fault is not a step
+    def reference_steps(self):
+        return Simulator.step_count - (1 if self.ref_error is not None else 0)
+
+    def fast_running(self):
+        return not self.m.halted and self.fast_error is None
+
+    # runs the fast engine for (about, with the jit) n steps and the reference up to the
+    # same step, one step further if the fast engine faulted to see if it faults as well
+    def advance(self, n, runner):
+        m = self.m
+        try:
+            runner(n)
+        except Exception as e:
+            self.fast_error = e
+        end = m.steps + (1 if self.fast_error is not None else 0)
+        while self.ref_running and Simulator.step_count < end:
+            self.reference_step()
+
+    def end_state(self, running, error):
+        if running:
+            return "running"
+        if error is not None:
+            return f"faulted ({type(error).__name__}: {error})"
+        return "halted"
+
+    def differences(self):
+        m = self.m
+        engine = self.engine
+        diffs = []
+        if self.reference_steps() != m.steps:
+            diffs.append(f"steps: reference {self.reference_steps()}, {engine} {m.steps}")
+        ref_end = self.end_state(self.ref_running, self.ref_error)
+        fast_end = self.end_state(self.fast_running(), self.fast_error)
+        if ref_end.split(':')[0] != fast_end.split(':')[0]:
+            diffs.append(f"state: reference {ref_end}, {engine} {fast_end}")
+        if Simulator.program_counter != m.pc:
+            diffs.append(f"pc: reference 0x{Simulator.program_counter:08x}, {engine} 0x{m.pc:08x}")
+        for i, binary in enumerate(Simulator.registers.values()):
+            value = int(binary, 2)
+            if value != m.regs[i]:
+                diffs.append(f"{abi(i)} (x{i}): reference {value_text(value)}, {engine} {value_text(m.regs[i])}")
+
+        ref_memory = Simulator.data_memory
+        keys = ref_memory.touched | {format(addr, '08x') for addr in self.touched}
+        for key in sorted(keys, key=lambda key: int(key, 16)):
+            ref = ref_memory.get(key)
+            ref = int(ref, 2) if ref is not None else None
+            try:
+                fast = m.memory.load_word(int(key, 16))
+            except KeyError:
+                fast = None
+            if ref != fast:
+                diffs.append(f"memory 0x{key}: reference {value_text(ref)}, {engine} {value_text(fast)}")
+        ref_memory.touched.clear()
+        self.touched.clear()
+        return diffs
+
+    # the memory dump of the trace, checked once both engines have ended
+    def dump_differences(self):
+        ref = list(Simulator.data_memory.items())
+        fast = [(format(addr, '08x'), format(word, '032b')) for addr, word in self.m.memory_items()]
+        for i, (a, b) in enumerate(zip(ref, fast)):
+            if a != b:
+                return [f"memory dump line {i + 1}: reference 0x{a[0]}:0b{a[1]}, {self.engine} 0x{b[0]}:0b{b[1]}"]
+        if len(ref) != len(fast):
+            return [f"memory dump: reference {len(ref)} words, {self.engine} {len(fast)} words"]
+        return []
+
+    def save(self):
+        m = self.m
+        return (Simulator.program_counter, Simulator.step_count, Simulator.cur_instruction, dict(Simulator.registers),
+                dict(Simulator.data_memory), self.ref_running, self.ref_error,
+                m.pc, m.steps, m.halted, array('I', m.regs), m.memory.state(), self.fast_error)
+
+    def restore(self, state):
+        m = self.m
+        (Simulator.program_counter, Simulator.step_count, Simulator.cur_instruction, registers,
+         data_memory, self.ref_running, self.ref_error,
+         m.pc, m.steps, m.halted, regs, memory, self.fast_error) = state
+        Simulator.registers.clear()
+        Simulator.registers.update(registers)
+        dict.clear(Simulator.data_memory)
+        dict.update(Simulator.data_memory, data_memory)
+        Simulator.data_memory.touched.clear()
+        m.regs[:] = regs
+        m.memory.set_state(memory)
+        self.touched.clear()
+
+    # runs both engines forward from the last point they agreed on, one instruction (one
+    # block with the jit) at a time up to step `end`, returns the Divergence of the first
+    # step they disagree on or None
+    def pinpoint(self, end):
+        m = self.m
+        while (self.fast_running() or self.ref_running) and m.steps < end:
+            pc = m.pc
+            start = m.steps
+            word = m.program_memory.get(pc)
+            self.advance(1, self.run_fast)
+            diffs = self.differences()
+            if diffs:
+                note = f"in the block of steps {start + 1}-{m.steps} starting here" if m.steps - start > 1 else None
+                return Divergence(m.steps, pc, word, diffs, note)
+            if not self.fast_running():
+                break
+        return None
+
+    def run(self, max_steps=None):
+        m = self.m
+        rewind = self.every > 1 or self.jit
+        while True:
+            if max_steps is not None and m.steps >= max_steps:
+                return CosimResult(m.steps, 'step_limit', 'running', None)
+            saved = self.save() if rewind else None
+            start = m.steps
+            pc = m.pc
+            n = self.every if max_steps is None else min(self.every, max_steps - m.steps)
+            self.advance(n, self.run_fast)
+            diffs = self.differences()
+            if diffs:
+                if not rewind:
+                    return CosimResult(m.steps, 'diverged', None, Divergence(m.steps, pc, m.program_memory.get(pc), diffs, None))
+                end = max(m.steps, self.reference_steps())
+                self.restore(saved)
+                divergence = self.pinpoint(end)
+                if divergence is None:
+                    divergence = Divergence(end, None, None, diffs,
+                                            f"between steps {start} and {end}, not when run again from step {start}")
+                return CosimResult(divergence.step, 'diverged', None, divergence)
+            if not self.fast_running() and not self.ref_running:
+                diffs = self.dump_differences()
+                if diffs:
+                    return CosimResult(m.steps, 'diverged', None, Divergence(m.steps, None, None, diffs, "at the end of the run"))
+                return CosimResult(m.steps, 'match', self.end_state(False, self.fast_error), None)
+
+def report(result):
+    if result.outcome == 'match':
+        return f"{result.steps} steps, no differences, both engines {result.end}"
+    if result.outcome == 'step_limit':
+        return f"stopped after {result.steps} steps, no differences"
+    d = result.divergence
+    lines = [f"diverged at step {d.step}"]
+    if d.pc is not None:
+        text = reversesim.disassemble_word(d.word) if d.word is not None else "outside the program"
+        lines[0] += f", pc 0x{d.pc:08x}: {text}"
+    if d.note:
+        lines[0] += f" ({d.note})"
+    lines += ["  " + diff for diff in d.differences]
+    return "\n".join(lines)
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Run a program on the string engine and a machine.py engine in lockstep")
+    parser.add_argument('program', help="assembled program, one 32 bit binary word per line")
+    parser.add_argument('--jit', action='store_true', help="check the jit instead of the interpreter")
+    parser.add_argument('--every', type=int, default=1, metavar='N', help="compare every N steps (default 1)")
+    parser.add_argument('--max-steps', type=int, help="stop after this many instructions")
+    args = parser.parse_args(argv)
+
+    with open(args.program) as f:
+        lines = f.readlines()
+    lockstep = Lockstep(lines, args.jit, max(1, args.every))
+    result = lockstep.run(args.max_steps)
+    print(report(result))
+    return 1 if result.outcome == 'diverged' else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
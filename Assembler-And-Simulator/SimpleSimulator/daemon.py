@@ -0,0 +1,382 @@
+import io
+import os
+import sys
+import json
+import time
+import stat
+import signal
+import socket
+import tempfile
+import threading
+import socketserver
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import machine
+from batch import KILL_GRACE
+from tracing import TRACE_LEVELS, TRACE_FINAL, TRACE_REGS
+
+# Simulation service: a long running process that keeps a pool of warm worker processes
+# (the assembler and machine.py already imported) and takes jobs over a Unix domain socket,
+# so a submission costs a socket round trip instead of two fresh interpreters.
+#
+# The protocol is one JSON object per line in each direction, a connection can send any
+# number of jobs one after the other. A job:
+#
+#   {"id": ...,                     echoed back
+#    "source": "addi ...\n..."      assembly source, assembled in the worker, or
+#    "binary": "0000...\n..."       one 32 bit binary word per line, or
+#    "image": "<base64>"            a program image (image.py)
+#    "trace": "regs",               none, final or regs (default)
+#    "jit": false, "max_steps": N, "timeout": seconds, "detect_stuck": true,
+#    "expected": "<trace text>"}    compare with this trace instead of returning it
+#
+# and the answer {"id", "status", "exit_reason", "steps", "pc", "error", "wall_time"} with
+# "trace", or with "match" and "difference" (the first line that differs) when the job has
+# an expected trace. status is 'ok' once the program ran, whatever its exit reason,
+# 'error' for jobs that could not run and 'busy' when the queue is full. {"op": "stats"}
+# returns the counters of the service.
+#
+# At most workers + queue_size jobs are accepted at a time, more are answered 'busy'
+# right away so the clients back off instead of piling up on the socket. The limits of the
+# service (--max-steps, --timeout) cap the limits of every job. A job still running
+# KILL_GRACE seconds past its time limit (a long translated block or a slow mmio callback
+# the machine does not look at the clock in) has its pool killed and replaced, the job
+# gets a timeout error and the others that were running on the pool are run again.
+#
+# The socket only lets in its owner (mode 0600) and by default it is in a directory of the
+# user's own, $XDG_RUNTIME_DIR or a 0700 directory under the temp directory, where no other
+# user can put a socket of theirs first.
+
+SOCKET_NAME = 'simulator.sock'
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_QUEUE_SIZE = 64
+JOB_TRACE_LEVELS = ('none', 'final', 'regs')
+
+class JobError(Exception):
+    pass
+
+# the default socket path, creating its directory when there is no XDG_RUNTIME_DIR
+def default_socket():
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime and os.path.isdir(runtime):
+        return os.path.join(runtime, SOCKET_NAME)
+    directory = os.path.join(tempfile.gettempdir(), f"simulator-{os.getuid()}")
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError(f"{directory} is not a directory only this user can use")
+    return os.path.join(directory, SOCKET_NAME)
+
+# runs in every worker when it starts
+def warm():
+    import Assembler
+    import image
+
+# {pc -> word} of the program of a job
+def job_program(job):
+    if 'source' in job:
+        import Assembler
+        result = Assembler.Assembler().assemble(job['source'])
+        if result.diagnostics:
+            raise JobError(Assembler.diagnostic_text(result.diagnostics[0]))
+        return Assembler.program_memory(result)
+    if 'binary' in job:
+        try:
+            return machine.parse_program(job['binary'].splitlines())
+        except ValueError as e:
+            raise JobError(f"bad binary program: {e}") from None
+    if 'image' in job:
+        import base64
+        import image
+        try:
+            return image.parse_image(base64.b64decode(job['image']), "the image")
+        except ValueError as e:
+            raise JobError(str(e)) from None
+    raise JobError("the job has no 'source', 'binary' or 'image'")
+
+# the smaller of the job's limit and the service's, either may be None
+def capped(value, cap):
+    if value is None:
+        return cap
+    return value if cap is None else min(value, cap)
+
+# kills the workers of a pool, its running jobs fail with BrokenProcessPool
+def kill_pool(pool):
+    pool.killed = True
+    for process in list(pool._processes.values()):
+        process.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+# first line where the traces differ, None when they are the same
+def trace_difference(expected, actual):
+    expected = expected.splitlines()
+    actual = actual.splitlines()
+    for i, (a, b) in enumerate(zip(expected, actual)):
+        if a != b:
+            return {'line': i + 1, 'expected': a, 'actual': b}
+    if len(expected) != len(actual):
+        n = min(len(expected), len(actual))
+        return {'line': n + 1, 'expected': expected[n] if n < len(expected) else None,
+                'actual': actual[n] if n < len(actual) else None}
+    return None
+
+# runs one job in a worker process and returns the answer
+def run_job(job, max_steps=None, max_seconds=None):
+    start = time.perf_counter()
+    result = {'id': job.get('id'), 'status': 'ok', 'exit_reason': None, 'steps': 0, 'pc': None, 'error': None}
+    try:
+        trace = job.get('trace', 'regs')
+        if trace not in JOB_TRACE_LEVELS:
+            raise JobError(f"unknown trace level '{trace}', expected one of {', '.join(JOB_TRACE_LEVELS)}")
+        level = TRACE_LEVELS[trace]
+        jit = bool(job.get('jit', False))
+        if jit and level >= TRACE_REGS:
+            raise JobError("jit needs trace none or final")
+        m = machine.Machine(job_program(job))
+        out = io.StringIO() if level >= TRACE_FINAL else None
+        machine.simulate(m, out, level, jit, max_steps=capped(job.get('max_steps'), max_steps),
+                         max_seconds=capped(job.get('timeout'), max_seconds), detect_stuck=job.get('detect_stuck', True))
+        result.update(exit_reason=m.exit_reason, steps=m.steps, pc=m.pc, error=m.error)
+        if out is not None:
+            if job.get('expected') is not None:
+                difference = trace_difference(job['expected'], out.getvalue())
+                result.update(match=difference is None, difference=difference)
+            else:
+                result['trace'] = out.getvalue()
+    except JobError as e:
+        result.update(status='error', error=str(e))
+    except Exception as e:
+        result.update(status='error', error=f"{type(e).__name__}: {e}")
+    result['wall_time'] = round(time.perf_counter() - start, 6)
+    return result
+
+
+class Service:
+    def __init__(self, workers=None, queue_size=DEFAULT_QUEUE_SIZE, max_steps=None, max_seconds=DEFAULT_TIMEOUT):
+        self.workers = workers or os.cpu_count() or 1
+        self.capacity = self.workers + queue_size
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.slots = threading.BoundedSemaphore(self.capacity)
+        # a job is handed to the pool only when a worker is free, so its deadline counts
+        # from when it starts running
+        self.free_workers = threading.BoundedSemaphore(self.workers)
+        self.lock = threading.Lock()
+        self.counters = {'accepted': 0, 'rejected': 0, 'completed': 0, 'errors': 0, 'running': 0}
+        self.pool = self.new_pool()
+
+    # a pool whose workers are all started and warm
+    def new_pool(self):
+        pool = ProcessPoolExecutor(self.workers, initializer=warm)
+        for future in [pool.submit(time.sleep, 0.01) for i in range(self.workers)]:
+            future.result()
+        return pool
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def handle(self, job):
+        if not isinstance(job, dict):
+            return {'status': 'error', 'error': "a job is a JSON object"}
+        op = job.get('op', 'run')
+        if op == 'stats':
+            with self.lock:
+                return dict(self.counters, status='ok', workers=self.workers, capacity=self.capacity)
+        if op != 'run':
+            return {'id': job.get('id'), 'status': 'error', 'error': f"unknown op '{op}'"}
+        if not self.slots.acquire(blocking=False):
+            self.count('rejected')
+            return {'id': job.get('id'), 'status': 'busy', 'error': f"{self.capacity} jobs are queued or running, try again later"}
+        self.count('accepted')
+        self.count('running')
+        try:
+            with self.free_workers:
+                result = self.run(job)
+        finally:
+            self.count('running', -1)
+            self.slots.release()
+        self.count('completed' if result['status'] == 'ok' else 'errors')
+        return result
+
+    # seconds a job may take in its worker before its pool is killed, None without a limit
+    def deadline(self, job):
+        limit = job.get('timeout')
+        if not isinstance(limit, (int, float)) or isinstance(limit, bool):
+            limit = None # run_job reports a bad limit
+        limit = capped(limit, self.max_seconds)
+        return None if limit is None else limit + KILL_GRACE
+
+    # runs a job on the pool, again on the next one when the pool is killed for another job
+    def run(self, job):
+        while True:
+            pool = self.pool
+            try:
+                return pool.submit(run_job, job, self.max_steps, self.max_seconds).result(timeout=self.deadline(job))
+            except TimeoutError:
+                self.replace_pool(pool, kill=True)
+                return {'id': job.get('id'), 'status': 'error', 'exit_reason': machine.EXIT_TIMEOUT,
+                        'error': f"killed after running {self.deadline(job):g}s"}
+            except BrokenProcessPool:
+                if getattr(pool, 'killed', False):
+                    continue
+                # a worker died, later jobs get a fresh pool
+                self.replace_pool(pool)
+                return {'id': job.get('id'), 'status': 'error', 'error': "the worker running the job died"}
+            except RuntimeError: # submitted to a pool killed in the meantime
+                if not getattr(pool, 'killed', False):
+                    raise
+
+    def replace_pool(self, pool, kill=False):
+        with self.lock:
+            if self.pool is pool:
+                if kill:
+                    kill_pool(pool)
+                self.pool = self.new_pool()
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                answer = {'status': 'error', 'error': f"bad JSON: {e}"}
+            else:
+                answer = self.server.service.handle(job)
+            self.wfile.write(json.dumps(answer).encode() + b"\n")
+            self.wfile.flush()
+
+class JobServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    # the socket is created without permissions for anybody else, not opened up and closed
+    # again by a chmod after the bind
+    def server_bind(self):
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0o600)
+
+def serve(socket_path, service):
+    if os.path.exists(socket_path):
+        # a socket left behind by a service that is gone, a live one still accepts connections
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.connect(socket_path)
+            raise RuntimeError(f"a service is already listening on {socket_path}")
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+    # stopped by ^C or SIGTERM, both remove the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with JobServer(socket_path, JobHandler) as server:
+        server.service = service
+        print(f"listening on {socket_path} with {service.workers} workers", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.shutdown()
+            os.unlink(socket_path)
+
+# sends one job (or op) and returns the answer
+def submit(job, socket_path=None):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path or default_socket())
+        s.sendall(json.dumps(job).encode() + b"\n")
+        with s.makefile('rb') as f:
+            return json.loads(f.readline())
+
+# the job for a program file: a program image, assembled words or assembly source
+def file_job(path):
+    import image
+    if image.is_image(path):
+        import base64
+        with open(path, 'rb') as f:
+            return {'image': base64.b64encode(f.read()).decode()}
+    with open(path) as f:
+        text = f.read()
+    words = [line.strip() for line in text.splitlines() if line.strip()]
+    if words and all(len(word) == 32 and set(word) <= {'0', '1'} for word in words):
+        return {'binary': text}
+    return {'source': text}
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Simulation service on a Unix domain socket")
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('serve', help="run the service")
+    p.add_argument('--socket', help=f"socket path (default $XDG_RUNTIME_DIR/{SOCKET_NAME} or a directory of the user's under {tempfile.gettempdir()})")
+    p.add_argument('-j', '--workers', type=int, help="worker processes (default: cpu count)")
+    p.add_argument('--queue', type=int, default=DEFAULT_QUEUE_SIZE, help="jobs waiting for a worker before new ones are answered 'busy'")
+    p.add_argument('--max-steps', type=int, help="step limit of every job")
+    p.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help=f"wall clock limit of every job in seconds (default {DEFAULT_TIMEOUT:g})")
+    p = commands.add_parser('submit', help="run a program on the service")
+    p.add_argument('program', help="assembly source, assembled program or program image")
+    p.add_argument('--socket', help=f"socket path (default $XDG_RUNTIME_DIR/{SOCKET_NAME} or a directory of the user's under {tempfile.gettempdir()})")
+    p.add_argument('--trace', choices=JOB_TRACE_LEVELS, default='regs', help="trace level (default regs)")
+    p.add_argument('--jit', action='store_true', help="run translated basic blocks (trace none or final)")
+    p.add_argument('--max-steps', type=int, help="step limit")
+    p.add_argument('--timeout', type=float, help="wall clock limit in seconds")
+    p.add_argument('--expected', metavar='TRACE', help="compare with this trace file instead of writing the trace")
+    p.add_argument('--out', metavar='FILE', help="write the trace here (default stdout)")
+    p = commands.add_parser('stats', help="print the counters of the service")
+    p.add_argument('--socket', help=f"socket path (default $XDG_RUNTIME_DIR/{SOCKET_NAME} or a directory of the user's under {tempfile.gettempdir()})")
+    args = parser.parse_args(argv)
+    try:
+        args.socket = args.socket or default_socket()
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    if args.command == 'serve':
+        service = Service(args.workers, args.queue, args.max_steps, args.timeout)
+        try:
+            serve(args.socket, service)
+        except RuntimeError as e:
+            service.shutdown()
+            print(e, file=sys.stderr)
+            return 1
+        return 0
+    if args.command == 'stats':
+        print(json.dumps(submit({'op': 'stats'}, args.socket)))
+        return 0
+
+    job = file_job(args.program)
+    job.update(id=args.program, trace=args.trace, jit=args.jit, max_steps=args.max_steps, timeout=args.timeout)
+    if args.expected is not None:
+        with open(args.expected) as f:
+            job['expected'] = f.read()
+    answer = submit(job, args.socket)
+    if answer['status'] != 'ok':
+        print(f"{args.program}: {answer['status']}: {answer['error']}", file=sys.stderr)
+        return 1
+    if 'trace' in answer:
+        if args.out is not None:
+            with open(args.out, 'w') as f:
+                f.write(answer['trace'])
+        else:
+            sys.stdout.write(answer['trace'])
+    print(f"{args.program}: {answer['exit_reason']} after {answer['steps']} steps in {answer['wall_time']:.3f}s"
+          + (f" ({answer['error']})" if answer['error'] else ""), file=sys.stderr)
+    if 'match' in answer:
+        d = answer['difference']
+        print(f"{args.program}: " + ("trace matches" if answer['match'] else
+              f"trace differs at line {d['line']}: expected {d['expected']!r}, got {d['actual']!r}"), file=sys.stderr)
+        if not answer['match']:
+            return 1
+    return 0 if answer['exit_reason'] == machine.EXIT_HALT else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
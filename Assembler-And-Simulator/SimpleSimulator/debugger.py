@@ -0,0 +1,335 @@
+import sys
+import ast
+import operator
+from alu import to_signed
+import machine
+
+# Debug engine for machine.py. Debugger.run is a copy of Machine.run that stops at
+# breakpoints and watchpoints; every check in its loop is one dict or set lookup (the pc,
+# the register an instruction writes, the word a lw/sw touches), so a run with breakpoints
+# set is barely slower than one without and a failure deep in a long run can be reached
+# without writing a trace.
+#
+# - a breakpoint stops before the instruction at its pc runs, a conditional one only when
+#   its condition is true then. Conditions are expressions over the registers (ABI names
+#   or x0-x31, signed), pc, steps and mem(addr), see parse_expression().
+# - a register watchpoint stops after an instruction that changed the register.
+# - a memory watchpoint stops after a lw ('read'), sw ('write') or either ('access') of a
+#   word it covers.
+#
+# gdbstub.py puts the engine behind the GDB remote protocol, main() below is a small
+# command loop.
+
+STOP_BREAKPOINT = 'breakpoint'
+STOP_WATCHPOINT = 'watchpoint'
+STOP_STEP = 'step'
+STOP_STEP_LIMIT = 'step_limit'
+STOP_HALT = 'halt'
+STOP_FAULT = 'fault'
+
+WATCH_KINDS = ('write', 'read', 'access')
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod,
+    ast.LShift: operator.lshift, ast.RShift: operator.rshift,
+    ast.BitAnd: operator.and_, ast.BitOr: operator.or_, ast.BitXor: operator.xor,
+}
+UNARY_OPERATORS = {ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Invert: operator.invert, ast.Not: operator.not_}
+COMPARE_OPERATORS = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt,
+    ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge,
+}
+# shifts are limited so an expression cannot build a huge integer
+MAX_SHIFT = 64
+
+register_numbers = {}
+
+# register name (ABI or xN) -> number
+def registers():
+    if not register_numbers:
+        from tracing import abi
+        for i in range(32):
+            register_numbers[abi(i)] = register_numbers[f"x{i}"] = i
+    return register_numbers
+
+# Conditions and `p` take integers, register names, pc, steps, mem(addr), arithmetic,
+# bitwise and comparison operators and and/or/not. The expression is parsed with ast and
+# every node is checked here, anything else is refused: the text can come from a gdb
+# monitor command over the network, so it is never handed to eval().
+def parse_expression(text):
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except SyntaxError:
+        raise ValueError(f"bad expression '{text.strip()}'") from None
+    check_expression(tree.body)
+    return tree.body
+
+def check_expression(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, int):
+        return
+    if isinstance(node, ast.Name) and (node.id in ('pc', 'steps') or node.id in registers()):
+        return
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+        check_expression(node.left)
+        check_expression(node.right)
+        return
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+        check_expression(node.operand)
+        return
+    if isinstance(node, ast.BoolOp):
+        for value in node.values:
+            check_expression(value)
+        return
+    if isinstance(node, ast.Compare) and all(type(op) in COMPARE_OPERATORS for op in node.ops):
+        for value in [node.left] + node.comparators:
+            check_expression(value)
+        return
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'mem'
+            and len(node.args) == 1 and not node.keywords):
+        check_expression(node.args[0])
+        return
+    raise ValueError(f"'{ast.unparse(node)}' is not allowed in an expression")
+
+# value of a checked expression on the current state of m
+def evaluate(node, m):
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.Name):
+        if node.id == 'pc':
+            return m.pc
+        if node.id == 'steps':
+            return m.steps
+        return to_signed(m.regs[register_numbers[node.id]])
+    if isinstance(node, ast.BinOp):
+        left, right = evaluate(node.left, m), evaluate(node.right, m)
+        if isinstance(node.op, (ast.LShift, ast.RShift)) and not 0 <= right <= MAX_SHIFT:
+            raise ValueError(f"shift by {right}")
+        return BINARY_OPERATORS[type(node.op)](left, right)
+    if isinstance(node, ast.UnaryOp):
+        return UNARY_OPERATORS[type(node.op)](evaluate(node.operand, m))
+    if isinstance(node, ast.BoolOp):
+        for value in node.values:
+            result = evaluate(value, m)
+            if bool(result) == isinstance(node.op, ast.Or):
+                return result
+        return result
+    if isinstance(node, ast.Compare):
+        left = evaluate(node.left, m)
+        for op, comparator in zip(node.ops, node.comparators):
+            right = evaluate(comparator, m)
+            if not COMPARE_OPERATORS[type(op)](left, right):
+                return False
+            left = right
+        return True
+    return to_signed(m.load_word(evaluate(node.args[0], m))) # mem(addr)
+
+class Debugger:
+    def __init__(self, m):
+        self.m = m
+        # pc -> parsed condition or None
+        self.breakpoints = {}
+        self.conditions = {}
+        self.watch_registers = set()
+        # word address -> (kind, address the watchpoint was set on)
+        self.watch_memory = {}
+        # why the last run stopped: one of the STOP_ values, and for a watchpoint
+        # ('register', number, old value) or (kind, address)
+        self.stop_reason = None
+        self.stop_detail = None
+
+    def add_breakpoint(self, pc, condition=None):
+        self.breakpoints[pc] = parse_expression(condition) if condition else None
+        self.conditions[pc] = condition
+
+    def remove_breakpoint(self, pc):
+        self.breakpoints.pop(pc, None)
+        self.conditions.pop(pc, None)
+
+    # watches the words covering [addr, addr + length)
+    def add_watchpoint(self, addr, length=4, kind='write'):
+        if kind not in WATCH_KINDS:
+            raise ValueError(f"unknown watchpoint kind '{kind}', expected one of {', '.join(WATCH_KINDS)}")
+        for word in range(addr & ~3, addr + max(length, 1), 4):
+            self.watch_memory[word] = (kind, addr)
+
+    def remove_watchpoint(self, addr, length=4):
+        for word in range(addr & ~3, addr + max(length, 1), 4):
+            self.watch_memory.pop(word, None)
+
+    def condition_true(self, pc):
+        condition = self.breakpoints[pc]
+        if condition is None:
+            return True
+        try:
+            return bool(evaluate(condition, self.m))
+        except Exception: # a condition that cannot be evaluated stops, like gdb
+            return True
+
+    # the watchpoint a lw/sw at addr hits, or None
+    def memory_hit(self, name, addr):
+        for word in (addr & ~3, (addr + 3) & ~3):
+            entry = self.watch_memory.get(word)
+            if entry is not None:
+                kind, watched = entry
+                if kind == 'access' or (kind == 'read') == (name == 'lw'):
+                    return (kind, watched)
+        return None
+
+    # runs until a breakpoint, watchpoint, halt, fault or max_steps instructions, returns
+    # and records why it stopped. With resume a breakpoint at the pc the run starts from does
+    # not stop it (it is the one the last run stopped at), a run in chunks passes False after
+    # the first chunk.
+    def run(self, max_steps=None, resume=True):
+        m = self.m
+        code = m.code
+        regs = m.regs
+        breakpoints = self.breakpoints
+        watch_registers = self.watch_registers
+        watch_memory = self.watch_memory
+        pc = m.pc
+        steps = m.steps
+        limit = steps + max_steps if max_steps is not None else 1 << 62
+        start = steps if resume else -1
+        reason, detail = STOP_STEP_LIMIT, None
+        try:
+            while steps < limit:
+                if m.halted:
+                    reason = STOP_HALT
+                    break
+                if pc in breakpoints and steps != start:
+                    m.pc = pc
+                    m.steps = steps
+                    if self.condition_true(pc):
+                        reason = STOP_BREAKPOINT
+                        break
+                handler, rd, rs1, rs2, imm, name, word = code[pc]
+                hit = None
+                if watch_memory and (name == 'lw' or name == 'sw'):
+                    hit = self.memory_hit(name, to_signed(regs[rs1]) + imm)
+                old = None
+                if rd in watch_registers: # rd is 0 for instructions that write no register
+                    old = {rd: regs[rd]}
+                elif name == 'rst' and watch_registers:
+                    old = {i: regs[i] for i in watch_registers}
+                pc = handler(m, regs, pc, rd, rs1, rs2, imm)
+                regs[0] = 0
+                steps += 1
+                if old is not None:
+                    changed = [i for i in sorted(old) if regs[i] != old[i]]
+                    if changed:
+                        reason, detail = STOP_WATCHPOINT, ('register', changed[0], old[changed[0]])
+                        break
+                if hit is not None:
+                    reason, detail = STOP_WATCHPOINT, hit
+                    break
+            else:
+                if max_steps == 1 and not m.halted:
+                    reason = STOP_STEP
+            if m.halted and reason == STOP_STEP_LIMIT:
+                reason = STOP_HALT
+        except Exception as e:
+            m.error = f"{type(e).__name__}: {e}"
+            reason = STOP_FAULT
+        finally:
+            m.pc = pc
+            m.steps = steps
+        self.stop_reason, self.stop_detail = reason, detail
+        return reason
+
+    def step(self):
+        return self.run(1)
+
+    def describe_stop(self):
+        m = self.m
+        if self.stop_reason == STOP_WATCHPOINT:
+            if self.stop_detail[0] == 'register':
+                from tracing import abi
+                i, old = self.stop_detail[1], self.stop_detail[2]
+                return f"watchpoint: {abi(i)} (x{i}) {to_signed(old)} -> {to_signed(m.regs[i])}"
+            kind, addr = self.stop_detail
+            return f"watchpoint: {kind} of 0x{addr:08x}"
+        if self.stop_reason == STOP_FAULT:
+            return f"fault: {m.error}"
+        if self.stop_reason == STOP_BREAKPOINT and self.conditions.get(m.pc):
+            return f"breakpoint if {self.conditions[m.pc]}"
+        return self.stop_reason
+
+
+# the commands other than running: b PC [if EXPR], d PC, watch xN|ADDR [read|write|access],
+# unwatch xN|ADDR, info, regs, mem ADDR, p EXPR. Returns the output, shared by main() and
+# the monitor command of gdbstub.py.
+def command(d, line):
+    from tracing import abi
+    m = d.m
+    cmd, *rest = line.split() or ['']
+    if cmd in ('b', 'break'):
+        condition = line.split(' if ', 1)[1].strip() if ' if ' in line else None
+        d.add_breakpoint(int(rest[0], 0), condition)
+    elif cmd in ('d', 'delete'):
+        d.remove_breakpoint(int(rest[0], 0))
+    elif cmd == 'watch':
+        if rest[0].startswith('x'):
+            d.watch_registers.add(int(rest[0][1:]))
+        else:
+            d.add_watchpoint(int(rest[0], 0), 4, rest[1] if len(rest) > 1 else 'write')
+    elif cmd == 'unwatch':
+        if rest[0].startswith('x'):
+            d.watch_registers.discard(int(rest[0][1:]))
+        else:
+            d.remove_watchpoint(int(rest[0], 0))
+    elif cmd == 'info':
+        lines = []
+        for pc in sorted(d.breakpoints):
+            lines.append(f"break 0x{pc:08x}" + (f" if {d.conditions[pc]}" if d.conditions[pc] else ""))
+        for i in sorted(d.watch_registers):
+            lines.append(f"watch {abi(i)} (x{i})")
+        for word, (kind, addr) in sorted(d.watch_memory.items()):
+            lines.append(f"watch {kind} 0x{word:08x}")
+        return "\n".join(lines)
+    elif cmd == 'regs':
+        return " ".join(f"{abi(i)}={to_signed(r)}" for i, r in enumerate(m.regs))
+    elif cmd == 'mem':
+        return str(to_signed(m.load_word(int(rest[0], 0))))
+    elif cmd in ('p', 'print'):
+        return str(evaluate(parse_expression(line.split(None, 1)[1]), m))
+    elif cmd:
+        raise ValueError(f"unknown command '{cmd}'")
+    return ""
+
+# command loop: c [n], s [n], q and the commands of command()
+def main(argv=None):
+    import argparse
+    from tracing import disassemble
+    parser = argparse.ArgumentParser(description="Run a program with breakpoints and watchpoints")
+    parser.add_argument('program', help="assembled program or program image")
+    args = parser.parse_args(argv)
+
+    m = machine.Machine(machine.read_program(args.program))
+    d = Debugger(m)
+    def where():
+        text = disassemble(m.code[m.pc]) if m.pc in m.program_memory else "(outside the program)"
+        print(f"step {m.steps} pc 0x{m.pc:08x}: {text}" + (" [halted]" if m.halted else ""))
+    where()
+    for line in sys.stdin:
+        cmd, *rest = line.split() or ['']
+        try:
+            if cmd in ('c', 'continue'):
+                d.run(int(rest[0]) if rest else None)
+                print(d.describe_stop())
+            elif cmd in ('s', 'step'):
+                d.run(int(rest[0]) if rest else 1)
+                if d.stop_reason not in (STOP_STEP, STOP_STEP_LIMIT):
+                    print(d.describe_stop())
+            elif cmd in ('q', 'quit'):
+                break
+            else:
+                output = command(d, line)
+                if output:
+                    print(output)
+        except Exception as e:
+            print(f"{type(e).__name__}: {e}")
+        where()
+
+if __name__ == "__main__":
+    main()
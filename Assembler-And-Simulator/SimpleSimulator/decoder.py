@@ -0,0 +1,212 @@
+from collections import namedtuple
+from alu import MASK32, SIGN32, to_signed, reverse_bits
+
+# Decode-once stage: every instruction word is turned into a compact record holding its
+# handler, register indices and the already sign extended immediate. The run loop only
+# has to look the record up by pc and call the handler.
+
+VIRTUAL_HALT_INSTRUCTION = 0b00000000000000000000000001100011
+RST_INSTRUCTION = 0b00000000000000000000000001111111
+HALT_INSTRUCTION = 0b11111111111111111111111111111111
+
+Decoded = namedtuple('Decoded', ['handler', 'rd', 'rs1', 'rs2', 'imm', 'name', 'word'])
+
+# handlers take (machine, registers, pc, rd, rs1, rs2, imm) and return the next pc.
+# The arithmetic is the one of alu.py written out inline, a call per operation would cost
+# more than the operation. Signed comparisons flip the sign bit so they can work directly
+# on the unsigned words.
+
+def op_add(m, regs, pc, rd, rs1, rs2, imm):
+    regs[rd] = (regs[rs1] + regs[rs2]) & MASK32
+    return pc + 4
+
+def op_sub(m, regs, pc, rd, rs1, rs2, imm):
+    regs[rd] = (regs[rs1] - regs[rs2]) & MASK32
+    return pc + 4
+
+def op_sll(m, regs, pc, rd, rs1, rs2, imm):
+    regs[rd] = (regs[rs1] << (regs[rs2] & 0x1F)) & MASK32
+    return pc + 4
+
+def op_slt(m, regs, pc, rd, rs1, rs2, imm):
+    regs[rd] = 1 if regs[rs1] ^ SIGN32 < regs[rs2] ^ SIGN32 else 0
+    return pc + 4
+
+def op_sltu(m, regs, pc, rd, rs1, rs2, imm):
+    regs[rd] = 1 if regs[rs1] < regs[rs2] else 0
+    return pc + 4
+
+def op_xor(m, regs, pc, rd, rs1, rs2, imm):
+    regs[rd] = regs[rs1] ^ regs[rs2]
+    return pc + 4
+
+def op_srl(m, regs, pc, rd, rs1, rs2, imm):
+    regs[rd] = regs[rs1] >> (regs[rs2] & 0x1F)
+    return pc + 4
+
+def op_or(m, regs, pc, rd, rs1, rs2, imm):
+    regs[rd] = regs[rs1] | regs[rs2]
+    return pc + 4
+
+def op_and(m, regs, pc, rd, rs1, rs2, imm):
+    regs[rd] = regs[rs1] & regs[rs2]
+    return pc + 4
+
+def op_mul(m, regs, pc, rd, rs1, rs2, imm): # BONUS
+    regs[rd] = (regs[rs1] * regs[rs2]) & MASK32
+    return pc + 4
+
+def op_lw(m, regs, pc, rd, rs1, rs2, imm):
+    regs[rd] = m.load_word(to_signed(regs[rs1]) + imm)
+    return pc + 4
+
+def op_addi(m, regs, pc, rd, rs1, rs2, imm):
+    regs[rd] = (regs[rs1] + imm) & MASK32
+    return pc + 4
+
+def op_sltiu(m, regs, pc, rd, rs1, rs2, imm): # imm is the unsigned 12 bit field
+    regs[rd] = 1 if regs[rs1] < imm else 0
+    return pc + 4
+
+def op_jalr(m, regs, pc, rd, rs1, rs2, imm):
+    target = to_signed(regs[rs1]) + imm
+    regs[rd] = (pc + 4) & MASK32
+    return target
+
+def op_bad_i_type(m, regs, pc, rd, rs1, rs2, imm):
+    raise ValueError(f"Unsupported I-type instruction at pc {pc}")
+
+def op_sw(m, regs, pc, rd, rs1, rs2, imm):
+    m.store_word(to_signed(regs[rs1]) + imm, regs[rs2])
+    return pc + 4
+
+def op_beq(m, regs, pc, rd, rs1, rs2, imm):
+    return pc + imm if regs[rs1] == regs[rs2] else pc + 4
+
+def op_bne(m, regs, pc, rd, rs1, rs2, imm):
+    return pc + imm if regs[rs1] != regs[rs2] else pc + 4
+
+def op_blt(m, regs, pc, rd, rs1, rs2, imm):
+    return pc + imm if regs[rs1] ^ SIGN32 < regs[rs2] ^ SIGN32 else pc + 4
+
+def op_bge(m, regs, pc, rd, rs1, rs2, imm):
+    return pc + imm if regs[rs1] ^ SIGN32 >= regs[rs2] ^ SIGN32 else pc + 4
+
+def op_bltu(m, regs, pc, rd, rs1, rs2, imm): # imm is the unsigned offset, same as Simulator.py
+    return pc + imm if regs[rs1] < regs[rs2] else pc + 4
+
+def op_bgeu(m, regs, pc, rd, rs1, rs2, imm):
+    return pc + imm if regs[rs1] >= regs[rs2] else pc + 4
+
+def op_lui(m, regs, pc, rd, rs1, rs2, imm):
+    regs[rd] = imm
+    return pc + 4
+
+def op_auipc(m, regs, pc, rd, rs1, rs2, imm):
+    regs[rd] = (pc + imm) & MASK32
+    return pc + 4
+
+def op_jal(m, regs, pc, rd, rs1, rs2, imm):
+    regs[rd] = (pc + 4) & MASK32
+    return pc + imm
+
+def op_rvrs(m, regs, pc, rd, rs1, rs2, imm): # BONUS
+    regs[rd] = reverse_bits(regs[rs1])
+    return pc + 4
+
+def op_rst(m, regs, pc, rd, rs1, rs2, imm): # BONUS
+    m.reset_registers()
+    return pc + 4
+
+def op_halt(m, regs, pc, rd, rs1, rs2, imm):
+    m.halted = True
+    return pc
+
+# words that match no instruction leave the pc where it is, like Simulator.py
+def op_unknown(m, regs, pc, rd, rs1, rs2, imm):
+    return pc
+
+r_handlers = {
+    (0b000, 0): ('add', op_add), (0b000, 1): ('sub', op_sub),
+    (0b001, 0): ('sll', op_sll), (0b001, 1): ('sll', op_sll),
+    (0b010, 0): ('slt', op_slt), (0b010, 1): ('slt', op_slt),
+    (0b011, 0): ('sltu', op_sltu), (0b011, 1): ('sltu', op_sltu),
+    (0b100, 0): ('xor', op_xor), (0b100, 1): ('xor', op_xor),
+    (0b101, 0): ('srl', op_srl), (0b101, 1): ('srl', op_srl),
+    (0b110, 0): ('or', op_or), (0b110, 1): ('or', op_or),
+    (0b111, 0): ('and', op_and), (0b111, 1): ('mul', op_mul),
+}
+
+b_handlers = {
+    0b000: ('beq', op_beq), 0b001: ('bne', op_bne), 0b100: ('blt', op_blt),
+    0b101: ('bge', op_bge), 0b110: ('bltu', op_bltu), 0b111: ('bgeu', op_bgeu),
+}
+
+def b_offset(inst):
+    return (inst >> 31) << 12 | ((inst >> 7) & 1) << 11 | ((inst >> 25) & 0x3F) << 5 | ((inst >> 8) & 0xF) << 1
+
+def j_offset(inst):
+    return (to_signed(inst) >> 31) << 20 | ((inst >> 12) & 0xFF) << 12 | ((inst >> 20) & 1) << 11 | ((inst >> 21) & 0x3FF) << 1
+
+def decode(inst):
+    opcode = inst & 0x7F
+    rd = (inst >> 7) & 0x1F
+    funct3 = (inst >> 12) & 0x7
+    rs1 = (inst >> 15) & 0x1F
+    rs2 = (inst >> 20) & 0x1F
+
+    if inst == RST_INSTRUCTION:
+        return Decoded(op_rst, 0, 0, 0, 0, 'rst', inst)
+    if inst == HALT_INSTRUCTION:
+        return Decoded(op_halt, 0, 0, 0, 0, 'halt', inst)
+    if opcode == 0b0000001:
+        return Decoded(op_rvrs, rd, rs1, 0, 0, 'rvrs', inst)
+    if opcode == 0b0110011:
+        name, handler = r_handlers[(funct3, 1 if inst >> 25 else 0)]
+        return Decoded(handler, rd, rs1, rs2, 0, name, inst)
+    if opcode == 0b0000011 or opcode == 0b0010011 or opcode == 0b1100111:
+        imm = to_signed(inst) >> 20
+        if funct3 == 0b010 and opcode == 0b0000011:
+            return Decoded(op_lw, rd, rs1, 0, imm, 'lw', inst)
+        if funct3 == 0b000 and opcode == 0b0010011:
+            return Decoded(op_addi, rd, rs1, 0, imm, 'addi', inst)
+        if funct3 == 0b011 and opcode == 0b0010011:
+            return Decoded(op_sltiu, rd, rs1, 0, inst >> 20, 'sltiu', inst)
+        if funct3 == 0b000 and opcode == 0b1100111:
+            return Decoded(op_jalr, rd, rs1, 0, imm, 'jalr', inst)
+        return Decoded(op_bad_i_type, rd, rs1, 0, imm, 'unknown', inst)
+    if opcode == 0b0100011:
+        imm = (to_signed(inst) >> 25) << 5 | rd
+        return Decoded(op_sw, 0, rs1, rs2, imm, 'sw', inst)
+    if opcode == 0b1100011:
+        if inst == VIRTUAL_HALT_INSTRUCTION:
+            return Decoded(op_halt, 0, 0, 0, 0, 'virtual_halt', inst)
+        if funct3 not in b_handlers:
+            return Decoded(op_unknown, 0, rs1, rs2, 0, 'unknown', inst)
+        name, handler = b_handlers[funct3]
+        imm = b_offset(inst)
+        if funct3 < 0b110:
+            imm = imm - 0x2000 if imm & 0x1000 else imm
+        return Decoded(handler, 0, rs1, rs2, imm, name, inst)
+    if opcode == 0b0110111:
+        return Decoded(op_lui, rd, 0, 0, inst & 0xFFFFF000, 'lui', inst)
+    if opcode == 0b0010111:
+        return Decoded(op_auipc, rd, 0, 0, to_signed(inst & 0xFFFFF000), 'auipc', inst)
+    if opcode == 0b1101111:
+        return Decoded(op_jal, rd, 0, 0, j_offset(inst), 'jal', inst)
+    return Decoded(op_unknown, 0, 0, 0, 0, 'unknown', inst)
+
+# {pc -> word} to {pc -> Decoded}
+def decode_program(program_memory):
+    return {pc: decode(word) for pc, word in program_memory.items()}
+
+# {pc -> Decoded} that decodes an instruction the first time it is fetched, pcs outside the
+# program raise KeyError like a plain dict
+class DecodedProgram(dict):
+    def __init__(self, program_memory):
+        super().__init__()
+        self.program_memory = program_memory
+
+    def __missing__(self, pc):
+        rec = self[pc] = decode(self.program_memory[pc])
+        return rec
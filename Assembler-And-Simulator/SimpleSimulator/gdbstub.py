@@ -0,0 +1,375 @@
+import sys
+import select
+import socket
+import machine
+import debugger
+from debugger import Debugger
+
+# GDB remote serial protocol stub for the debug engine of debugger.py, so gdb (or any RSP
+# client) can drive a program:
+#
+#   python gdbstub.py program.bin --port 1234
+#   (gdb) set architecture riscv:rv32
+#   (gdb) target remote localhost:1234
+#
+# break/hbreak, watch/rwatch/awatch, stepi, continue, info registers and x/ work, Ctrl-C
+# interrupts a continue. Breakpoints and watchpoints are kept by the stub, so a continue
+# runs in debugger.py's loop instead of gdb stepping the program one instruction at a
+# time. Conditions are evaluated in the stub as well:
+#
+#   (gdb) monitor break 0x10 if t0 == 250
+#   (gdb) monitor watch x10
+#
+# see debugger.command() for the monitor commands. The registers are x0-x31 and pc
+# (register 32), a halt is reported as a stop first and as the exit of the program when
+# it is continued again.
+
+DEFAULT_PORT = 1234
+PACKET_SIZE = 4096
+# instructions between checks for a Ctrl-C from gdb during a continue
+POLL_STEPS = 1 << 16
+
+SIGINT = 2
+SIGTRAP = 5
+SIGSEGV = 11
+
+WATCH_PACKETS = {'2': 'write', '3': 'read', '4': 'access'}
+WATCH_STOPS = {'write': 'watch', 'read': 'rwatch', 'access': 'awatch'}
+
+def target_xml():
+    from tracing import abi
+    regs = "".join(f'<reg name="{abi(i)}" bitsize="32" type="{"code_ptr" if i == 1 else "data_ptr" if i == 2 else "int"}" regnum="{i}"/>'
+                   for i in range(32))
+    return ('<?xml version="1.0"?><!DOCTYPE target SYSTEM "gdb-target.dtd"><target version="1.0">'
+            '<architecture>riscv:rv32</architecture><feature name="org.gnu.gdb.riscv.cpu">'
+            + regs + '<reg name="pc" bitsize="32" type="code_ptr" regnum="32"/></feature></target>')
+
+def checksum(data):
+    return sum(data) & 0xff
+
+# escapes the bytes the protocol reserves
+def escape(data):
+    out = bytearray()
+    for b in data:
+        if b in b'$#}*':
+            out += bytes([0x7d, b ^ 0x20])
+        else:
+            out.append(b)
+    return bytes(out)
+
+def unescape(data):
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        if data[i] == 0x7d and i + 1 < len(data):
+            out.append(data[i + 1] ^ 0x20)
+            i += 2
+        else:
+            out.append(data[i])
+            i += 1
+    return bytes(out)
+
+def word_hex(value):
+    return (value & 0xffffffff).to_bytes(4, 'little').hex()
+
+def hex_word(text):
+    return int.from_bytes(bytes.fromhex(text), 'little')
+
+
+# one gdb connection, the machine and its breakpoints outlive it
+class Stub:
+    def __init__(self, d, conn):
+        self.d = d
+        self.m = d.m
+        self.conn = conn
+        self.buffer = b''
+        self.ack = True
+        # set once the halt was reported, a continue then ends the program
+        self.halt_reported = False
+        self.killed = False
+        self.detached = False
+
+    def send(self, text):
+        data = escape(text.encode('latin-1'))
+        packet = b'$' + data + b'#' + format(checksum(data), '02x').encode()
+        while True:
+            self.conn.sendall(packet)
+            if not self.ack:
+                return
+            reply = self.read_byte()
+            if reply != b'-': # '+', or the connection is gone
+                return
+
+    def read_byte(self):
+        if not self.buffer:
+            self.buffer = self.conn.recv(PACKET_SIZE)
+            if not self.buffer:
+                return b''
+        b, self.buffer = self.buffer[:1], self.buffer[1:]
+        return b
+
+    # the next packet, b'\x03' for an interrupt or None once the connection is closed
+    def receive(self):
+        while True:
+            b = self.read_byte()
+            if not b:
+                return None
+            if b == b'\x03':
+                return b
+            if b != b'$':
+                continue # acks, and noise between packets
+            data = bytearray()
+            while True:
+                b = self.read_byte()
+                if not b:
+                    return None
+                if b == b'#':
+                    break
+                data += b
+            sent = self.read_byte() + self.read_byte()
+            if self.ack:
+                ok = sent == format(checksum(data), '02x').encode()
+                self.conn.sendall(b'+' if ok else b'-')
+                if not ok:
+                    continue
+            return unescape(bytes(data))
+
+    def interrupted(self):
+        if self.buffer[:1] == b'\x03':
+            self.buffer = self.buffer[1:]
+            return True
+        if not self.buffer and select.select([self.conn], [], [], 0)[0]:
+            self.buffer = self.conn.recv(PACKET_SIZE)
+            return self.interrupted()
+        return False
+
+    def console(self, text):
+        self.send('O' + text.encode().hex())
+
+    def serve(self):
+        while not self.killed and not self.detached:
+            packet = self.receive()
+            if packet is None:
+                return
+            if packet == b'\x03':
+                self.send(f"S{SIGINT:02x}")
+                continue
+            reply = self.handle(packet.decode('latin-1'))
+            if reply is not None:
+                self.send(reply)
+
+    # the reply to a packet, None when it needs none (or already sent it)
+    def handle(self, packet):
+        kind, body = packet[:1], packet[1:]
+        m = self.m
+        if not kind:
+            return ''
+        try:
+            if kind == '?':
+                return self.stop_reply()
+            if kind == 'g':
+                return "".join(word_hex(r) for r in m.regs) + word_hex(m.pc)
+            if kind == 'G':
+                for i in range(32):
+                    self.set_register(i, hex_word(body[8*i:8*i + 8]))
+                self.set_register(32, hex_word(body[256:264]))
+                return 'OK'
+            if kind == 'p':
+                n = int(body, 16)
+                return word_hex(m.pc if n == 32 else m.regs[n]) if n <= 32 else 'E01'
+            if kind == 'P':
+                n, value = body.split('=')
+                self.set_register(int(n, 16), hex_word(value))
+                return 'OK'
+            if kind == 'm':
+                addr, length = (int(x, 16) for x in body.split(','))
+                return self.read_memory(addr, length) or 'E14'
+            if kind in 'MX':
+                where, data = body.split(':', 1)
+                addr, length = (int(x, 16) for x in where.split(','))
+                data = bytes.fromhex(data) if kind == 'M' else data.encode('latin-1')
+                self.write_memory(addr, data[:length])
+                return 'OK'
+            if kind in 'cs':
+                if body:
+                    m.pc = int(body, 16)
+                return self.resume(kind == 's')
+            if kind in 'Zz':
+                return self.breakpoint(kind == 'Z', *body.split(',')[:3])
+            if kind == 'H':
+                return 'OK'
+            if kind == 'k':
+                self.killed = True
+                return None
+            if kind == 'D':
+                self.detached = True
+                return 'OK'
+            if kind == 'q':
+                return self.query(body)
+            if kind == 'Q':
+                if body == 'StartNoAckMode':
+                    self.send('OK')
+                    self.ack = False
+                    return None
+                return ''
+            if kind == 'v':
+                return ''
+        except (ValueError, IndexError):
+            return 'E01'
+        return ''
+
+    def query(self, body):
+        name, _, args = body.partition(':')
+        if name == 'Supported':
+            return f"PacketSize={PACKET_SIZE:x};QStartNoAckMode+;swbreak+;hwbreak+;qXfer:features:read+"
+        if name == 'Xfer' and args.startswith('features:read:target.xml:'):
+            offset, length = (int(x, 16) for x in args.rsplit(':', 1)[1].split(','))
+            xml = target_xml()
+            chunk = xml[offset:offset + length]
+            return ('m' if offset + length < len(xml) else 'l') + chunk
+        if name == 'C':
+            return 'QC1'
+        if name == 'Attached':
+            return '1'
+        if name == 'fThreadInfo':
+            return 'm1'
+        if name == 'sThreadInfo':
+            return 'l'
+        if name == 'Symbol':
+            return 'OK'
+        if body.startswith('Rcmd,'):
+            line = bytes.fromhex(body[5:]).decode()
+            try:
+                output = debugger.command(self.d, line)
+            except Exception as e:
+                output = f"{type(e).__name__}: {e}"
+            if output:
+                self.console(output + "\n")
+            return 'OK'
+        return ''
+
+    def set_register(self, n, value):
+        if n == 32:
+            self.m.pc = value
+        elif 0 < n < 32:
+            self.m.regs[n] = value
+
+    # the word at a word aligned address: an instruction inside the program, data memory
+    # everywhere else. None when nothing was stored there.
+    def load(self, addr):
+        if addr in self.m.program_memory:
+            return self.m.program_memory[addr]
+        try:
+            return self.m.load_word(addr)
+        except Exception: # unstored words and memory faults
+            return None
+
+    # hex of the readable bytes from addr on, stops at the first unreadable one
+    def read_memory(self, addr, length):
+        out = []
+        for a in range(addr, addr + length):
+            word = self.load(a & ~3)
+            if word is None:
+                break
+            out.append(format((word >> (8 * (a & 3))) & 0xff, '02x'))
+        return "".join(out)
+
+    def write_memory(self, addr, data):
+        m = self.m
+        for i, b in enumerate(data):
+            a = addr + i
+            base, shift = a & ~3, 8 * (a & 3)
+            word = self.load(base) or 0
+            word = (word & ~(0xff << shift) | b << shift) & 0xffffffff
+            if base in m.program_memory:
+                m.write_program(base, word)
+            else:
+                m.store_word(base, word)
+
+    def breakpoint(self, insert, kind, addr, length):
+        addr = int(addr, 16)
+        d = self.d
+        if kind in '01':
+            if insert:
+                d.add_breakpoint(addr)
+            else:
+                d.remove_breakpoint(addr)
+        elif kind in WATCH_PACKETS:
+            if insert:
+                d.add_watchpoint(addr, int(length, 16), WATCH_PACKETS[kind])
+            else:
+                d.remove_watchpoint(addr, int(length, 16))
+        else:
+            return ''
+        return 'OK'
+
+    def resume(self, single):
+        d, m = self.d, self.m
+        if m.halted and self.halt_reported:
+            self.killed = True
+            return 'W00'
+        if single:
+            d.step()
+        else:
+            first = True
+            while True:
+                d.run(POLL_STEPS, resume=first)
+                first = False
+                if d.stop_reason != debugger.STOP_STEP_LIMIT:
+                    break
+                if self.interrupted():
+                    return f"S{SIGINT:02x}"
+        return self.stop_reply()
+
+    def stop_reply(self):
+        d, m = self.d, self.m
+        reason = d.stop_reason
+        if reason == debugger.STOP_HALT or m.halted:
+            self.halt_reported = True
+            self.console(f"program halted after {m.steps} steps\n")
+            return f"S{SIGTRAP:02x}"
+        if reason == debugger.STOP_FAULT:
+            self.console(d.describe_stop() + "\n")
+            return f"S{SIGSEGV:02x}"
+        if reason == debugger.STOP_BREAKPOINT:
+            return f"T{SIGTRAP:02x}swbreak:;"
+        if reason == debugger.STOP_WATCHPOINT:
+            if d.stop_detail[0] == 'register':
+                self.console(d.describe_stop() + "\n")
+                return f"S{SIGTRAP:02x}"
+            kind, addr = d.stop_detail
+            return f"T{SIGTRAP:02x}{WATCH_STOPS[kind]}:{addr:x};"
+        return f"S{SIGTRAP:02x}"
+
+
+# serves gdb connections one at a time on host:port until one kills the program
+def serve(d, host, port):
+    listener = socket.create_server((host, port))
+    print(f"listening on {host}:{listener.getsockname()[1]}", file=sys.stderr)
+    try:
+        while True:
+            conn, peer = listener.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            stub = Stub(d, conn)
+            try:
+                stub.serve()
+            except (ConnectionError, BrokenPipeError):
+                pass
+            finally:
+                conn.close()
+            if stub.killed:
+                return
+    finally:
+        listener.close()
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Debug a program with gdb over the remote serial protocol")
+    parser.add_argument('program', help="assembled program or program image")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on (default 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"TCP port (default {DEFAULT_PORT}, 0 picks a free one)")
+    args = parser.parse_args(argv)
+    serve(Debugger(machine.Machine(machine.read_program(args.program))), args.host, args.port)
+
+if __name__ == "__main__":
+    main()
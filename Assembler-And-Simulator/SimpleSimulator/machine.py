@@ -0,0 +1,264 @@
+import os
+import sys
+import time
+from array import array
+from decoder import decode, DecodedProgram
+from memory import WindowMemory
+from tracing import TRACE_FINAL, TRACE_REGS, TRACE_VERBOSE, DEFAULT_FLUSH_SIZE, TraceWriter, describe
+
+# Integer-backed machine state. Registers live in an array of unsigned 32 bit words and
+# data memory is indexed by integer address, the '0b...' text form is only built when the
+# trace is written. Instructions are decoded once (decoder.py) and dispatched by pc, with
+# the same semantics as the string engine in Simulator.py.
+
+SP_RESET = 256
+
+# why a run stopped
+EXIT_HALT = 'halt'
+EXIT_STEP_LIMIT = 'step_limit'
+EXIT_TIMEOUT = 'timeout'
+EXIT_FAULT = 'fault'
+EXIT_STUCK = 'stuck'
+
+# steps between wall clock checks when a run has a time limit, and between the state
+# fingerprints of the stuck detection
+CHUNK_STEPS = 1 << 16
+
+# the program image format lives with the assembler
+ASSEMBLER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SimpleAssembler')
+if ASSEMBLER_DIR not in sys.path:
+    sys.path.append(ASSEMBLER_DIR)
+
+# reads the assembler output into {pc -> int}: either one 32 char binary word per line or a
+# packed image (image.py), which also carries the entry pc and a data segment
+def read_program(path):
+    import image
+    if image.is_image(path):
+        return image.read_image(path)
+    with open(path) as f:
+        return parse_program(f.readlines())
+
+def parse_program(lines):
+    program_memory = {}
+    for i, line in enumerate(lines):
+        line = line.strip()
+        program_memory[i*4] = int(line, 2) if line else 0
+    return program_memory
+
+
+# memory is WindowMemory (the data memory of Simulator.py) unless given, see memory.py
+class Machine:
+    def __init__(self, program_memory, memory=None):
+        self.program_memory = program_memory
+        # decoded on first fetch
+        self.code = DecodedProgram(program_memory)
+        self.pc = getattr(program_memory, 'entry', 0)
+        self.regs = array('I', [0] * 32)
+        self.regs[2] = SP_RESET
+        self.memory = memory if memory is not None else WindowMemory()
+        self.load_word = self.memory.load_word
+        self.halted = False
+        self.steps = 0
+        self.exit_reason = None
+        self.error = None
+        # with self_modifying set, stores into the program's address range rewrite the
+        # instruction there, translated blocks and other caches subscribe to code_write_hooks
+        self.self_modifying = False
+        self.code_write_hooks = []
+        # translator.py, created by the first jit run
+        self.translator = None
+        # the data segment of a program image
+        for addr, word in getattr(program_memory, 'data', ()):
+            self.memory.load_image(addr, (word,))
+
+    def reset_registers(self):
+        for i in range(32):
+            self.regs[i] = 0
+        self.regs[2] = SP_RESET
+
+    def store_word(self, addr, value):
+        self.memory.store_word(addr, value)
+        if self.self_modifying and addr in self.program_memory:
+            self.write_program(addr, value)
+
+    def write_program(self, addr, word):
+        self.program_memory[addr] = word
+        self.code[addr] = decode(word)
+        for hook in self.code_write_hooks:
+            hook(addr)
+
+    # executes the instruction at the current pc, returns False once a halt was reached
+    def step(self):
+        handler, rd, rs1, rs2, imm, name, word = self.code[self.pc]
+        self.pc = handler(self, self.regs, self.pc, rd, rs1, rs2, imm)
+        self.regs[0] = 0 # x0 is hardwired to 0
+        self.steps += 1
+        return not self.halted
+
+    # runs until a halt or for at most max_steps instructions, on_step(machine, pc) is called
+    # after every instruction with the pc the instruction was fetched from
+    def run(self, on_step=None, max_steps=None):
+        code = self.code
+        regs = self.regs
+        pc = self.pc
+        steps = self.steps
+        limit = steps + max_steps if max_steps is not None else 1 << 62
+        try:
+            while not self.halted and steps < limit:
+                handler, rd, rs1, rs2, imm, name, word = code[pc]
+                fetched = pc
+                pc = handler(self, regs, pc, rd, rs1, rs2, imm)
+                regs[0] = 0
+                steps += 1
+                if on_step is not None:
+                    self.pc = pc
+                    self.steps = steps
+                    on_step(self, fetched)
+        finally:
+            self.pc = pc
+            self.steps = steps
+
+    # digest of everything the rest of the run depends on: pc, registers and data memory
+    # (stores into the program are data memory stores as well)
+    def fingerprint(self):
+        import hashlib
+        h = hashlib.blake2b(digest_size=16)
+        h.update(self.pc.to_bytes(8, 'little', signed=True))
+        h.update(self.regs)
+        self.memory.fingerprint(h)
+        return h.digest()
+
+    def registers_line(self):
+        return "0b" + format(self.pc, '032b') + " 0b" + " 0b".join([format(r, '032b') for r in self.regs]) + " \n"
+
+    # (address, word) pairs of the memory dump
+    def memory_items(self):
+        return self.memory.items()
+
+    def memory_lines(self):
+        return ["0x" + format(addr, '08x') + ":0b" + format(data, '032b') + "\n" for addr, data in self.memory_items()]
+
+
+# Finds runs that can never halt. The machine is deterministic, so once its whole state
+# (Machine.fingerprint) comes back it repeats the same steps forever, whether that is a
+# branch to itself or a longer loop that changes nothing. check() is called between run
+# chunks and compares the fingerprint with one saved at growing intervals (Brent's cycle
+# detection): a cycle is found within a few times its length in chunks, with one saved
+# fingerprint. Loads from mmio devices are not part of the state, so machines with a
+# device attached are never reported.
+class StuckDetector:
+    def __init__(self, m):
+        self.m = m
+        self.saved = None
+        self.saved_steps = 0
+        self.power = 1
+        self.length = 0
+
+    def check(self):
+        m = self.m
+        if getattr(m.memory, 'devices', None):
+            return False
+        fingerprint = m.fingerprint()
+        if fingerprint == self.saved:
+            return True
+        self.length += 1
+        if self.saved is None or self.length == self.power:
+            self.saved, self.saved_steps = fingerprint, m.steps
+            self.power *= 2
+            self.length = 0
+        return False
+
+# runs m until it halts or hits a limit, sets and returns m.exit_reason. Exceptions raised
+# by the program (for example a fetch outside the program) end the run as a fault. With a
+# profiler (profiler.py, or the timing model of timing.py) the run goes through its counting
+# loop instead. on_checkpoint(m) is called every checkpoint_every steps (at the next block
+# boundary with jit). With detect_stuck a run whose state repeats ends as EXIT_STUCK, m.error tells the steps.
+def run_until(m, on_step=None, jit=False, max_steps=None, max_seconds=None, profiler=None,
+              checkpoint_every=None, on_checkpoint=None, detect_stuck=False):
+    if profiler is not None:
+        runner = lambda limit: profiler.run(on_step, limit)
+    elif jit and on_step is None:
+        import translator
+        runner = translator.translator_for(m).run
+    else:
+        runner = lambda limit: m.run(on_step, limit)
+    deadline = time.monotonic() + max_seconds if max_seconds is not None else None
+    end = m.steps + max_steps if max_steps is not None else None
+    checkpoint = m.steps + checkpoint_every if checkpoint_every and on_checkpoint is not None else None
+    stuck = StuckDetector(m) if detect_stuck else None
+    try:
+        while not m.halted:
+            chunk = CHUNK_STEPS if deadline is not None or stuck is not None else None
+            if end is not None:
+                if m.steps >= end:
+                    m.exit_reason = EXIT_STEP_LIMIT
+                    return m.exit_reason
+                chunk = end - m.steps if chunk is None else min(chunk, end - m.steps)
+            if checkpoint is not None:
+                chunk = checkpoint - m.steps if chunk is None else min(chunk, checkpoint - m.steps)
+            runner(chunk)
+            if checkpoint is not None and m.steps >= checkpoint and not m.halted:
+                on_checkpoint(m)
+                checkpoint = m.steps + checkpoint_every
+            if deadline is not None and not m.halted and time.monotonic() >= deadline:
+                m.exit_reason = EXIT_TIMEOUT
+                return m.exit_reason
+            if stuck is not None and not m.halted and stuck.check():
+                m.error = f"the state after step {stuck.saved_steps} comes back after step {m.steps}"
+                m.exit_reason = EXIT_STUCK
+                return m.exit_reason
+    except Exception as e:
+        m.error = f"{type(e).__name__}: {e}"
+        m.exit_reason = EXIT_FAULT
+        return m.exit_reason
+    m.exit_reason = EXIT_HALT
+    return m.exit_reason
+
+# runs m and writes its trace to out_file at the given trace level, the same trace as
+# Simulator.py. jit runs whole translated blocks and is only possible without per-step
+# output, trace_format 'binary' writes the compact format of bintrace.py instead of text.
+# on_checkpoint(m, trace_offset) is called every checkpoint_every steps with the position
+# reached in a per-step text trace (None otherwise), a run resumed from that point passes
+# it back as trace_offset to continue the same file.
+def simulate(m, out_file=None, level=TRACE_REGS, jit=False, flush_size=DEFAULT_FLUSH_SIZE, compress=None,
+             trace_format='text', max_steps=None, max_seconds=None, profiler=None,
+             checkpoint_every=None, on_checkpoint=None, trace_offset=None, detect_stuck=False):
+    if level < TRACE_FINAL:
+        checkpointed = (lambda m: on_checkpoint(m, None)) if on_checkpoint is not None else None
+        return run_until(m, None, jit, max_steps, max_seconds, profiler, checkpoint_every, checkpointed, detect_stuck)
+    if trace_format == 'binary':
+        import bintrace
+        out = bintrace.BinaryTraceWriter(out_file)
+        record = lambda m: out.step(m.pc, m.regs)
+    else:
+        out = TraceWriter(out_file, flush_size, compress, trace_offset)
+        record = lambda m: out.write(m.registers_line())
+    checkpointed = None
+    if on_checkpoint is not None:
+        resumable = trace_format == 'text' and level >= TRACE_REGS and out.compress is None
+        checkpointed = lambda m: on_checkpoint(m, out.tell() if resumable else None)
+    try:
+        if level >= TRACE_REGS:
+            def on_step(m, pc):
+                record(m)
+                if level >= TRACE_VERBOSE:
+                    print(describe(m.steps, pc, m.code[pc], m.regs))
+            run_until(m, on_step, False, max_steps, max_seconds, profiler, checkpoint_every, checkpointed, detect_stuck)
+        else:
+            run_until(m, None, jit, max_steps, max_seconds, profiler, checkpoint_every, checkpointed, detect_stuck)
+            record(m)
+    finally:
+        if trace_format == 'binary':
+            out.close(m.memory_items())
+        else:
+            out.writelines(m.memory_lines())
+            out.close()
+    return m.exit_reason
+
+# runs a program file, see simulate()
+def run_file(in_file, out_file, level=TRACE_REGS, jit=False, flush_size=DEFAULT_FLUSH_SIZE, compress=None,
+             trace_format='text', max_steps=None, max_seconds=None, memory=None, detect_stuck=False):
+    m = Machine(read_program(in_file), memory)
+    simulate(m, out_file, level, jit, flush_size, compress, trace_format, max_steps, max_seconds,
+             detect_stuck=detect_stuck)
+    return m
@@ -0,0 +1,255 @@
+from array import array
+from collections import namedtuple
+
+# Data memory for machine.py.
+#
+# WindowMemory is the memory of Simulator.py: the 32 words 0x10000 - 0x1007C always exist,
+# any other address that gets stored to becomes its own word (keyed by the exact address,
+# so unaligned and negative addresses work) and loading an address that was never stored
+# is an error. The dump lists the window and then the other words in first-write order.
+#
+# PagedMemory is byte addressed and sparse: 4 KiB pages backed by a bytearray are allocated
+# on the first store, loads from pages that were never written read 0. Accesses have to be
+# word aligned and fall in a region of the (page aligned) memory map, stores to 'rom' regions fault and
+# 'mmio' regions are handled by a device attached with map_device(). A dirty bit per page
+# records the pages stored to since the program was loaded or since the last clear_dirty(),
+# the dump covers every word of the dirty pages: the words a run changed, or after a
+# clear_dirty() an incremental dump of the ones it changed since. load_image() preloads
+# words (the data segment of a program image, the contents of a rom) without the
+# permission check of a store and without making their pages dirty.
+
+# data memory window that is always present (and dumped) 0x10000 - 0x1007C
+DATA_BASE = 0x10000
+DATA_WORDS = 32
+DATA_END = DATA_BASE + 4 * DATA_WORDS
+
+PAGE_SHIFT = 12
+PAGE_SIZE = 1 << PAGE_SHIFT
+PAGE_WORDS = PAGE_SIZE // 4
+PAGE_COUNT = 1 << (32 - PAGE_SHIFT)
+
+# kind is 'ram', 'rom' or 'mmio', end is exclusive
+Region = namedtuple('Region', ['name', 'start', 'end', 'kind'])
+
+# the stack below the data segment (sp starts at 256) and 256 MiB of data and heap
+DEFAULT_MEMORY_MAP = [
+    Region('stack', 0x00000000, 0x00010000, 'ram'),
+    Region('data', 0x00010000, 0x10010000, 'ram'),
+]
+
+class MemoryFault(Exception):
+    def __init__(self, addr, reason):
+        super().__init__(f"{reason} at 0x{addr & 0xFFFFFFFF:08x}")
+        self.addr = addr
+        self.reason = reason
+
+
+# parses 'name:start-end[:kind],...' (numbers in any base int() accepts with base 0)
+def parse_memory_map(spec):
+    regions = []
+    for part in spec.split(','):
+        fields = part.strip().split(':')
+        if len(fields) not in (2, 3) or '-' not in fields[1]:
+            raise ValueError(f"bad memory region '{part}', expected name:start-end[:kind]")
+        start, end = fields[1].split('-')
+        kind = fields[2] if len(fields) == 3 else 'ram'
+        if kind not in ('ram', 'rom', 'mmio'):
+            raise ValueError(f"bad memory region kind '{kind}'")
+        regions.append(Region(fields[0], int(start, 0), int(end, 0), kind))
+    return regions
+
+
+class WindowMemory:
+    def __init__(self):
+        # aligned words of the data window, anything else that gets stored is kept in
+        # insertion order so the memory dump matches Simulator.py
+        self.data = array('I', [0] * DATA_WORDS)
+        self.extra = {}
+
+    def load_word(self, addr):
+        if DATA_BASE <= addr < DATA_END and not addr & 3:
+            return self.data[(addr - DATA_BASE) >> 2]
+        return self.extra[addr]
+
+    def store_word(self, addr, value):
+        if DATA_BASE <= addr < DATA_END and not addr & 3:
+            self.data[(addr - DATA_BASE) >> 2] = value
+        else:
+            self.extra[addr] = value
+
+    def load_image(self, addr, words):
+        for i, word in enumerate(words):
+            self.store_word(addr + 4*i, word)
+
+    # (address, word) pairs of the memory dump in the order Simulator.py writes them
+    def items(self):
+        items = [(DATA_BASE + 4*i, data) for i, data in enumerate(self.data)]
+        items.extend(self.extra.items())
+        return items
+
+    # undoes the first store to an address outside the window
+    def remove_word(self, addr):
+        self.extra.pop(addr, None)
+
+    # a store changes nothing but its word, see PagedMemory.store_flags()
+    def store_flags(self, addr):
+        return None
+
+    # a copy of the contents, for set_state()
+    def state(self):
+        return array('I', self.data), dict(self.extra)
+
+    def set_state(self, state):
+        data, extra = state
+        self.data[:] = data
+        self.extra = dict(extra)
+
+    # feeds the contents to a hashlib object, see Machine.fingerprint()
+    def fingerprint(self, h):
+        h.update(self.data)
+        h.update(repr(self.extra).encode())
+
+
+class PagedMemory:
+    def __init__(self, memory_map=DEFAULT_MEMORY_MAP):
+        for r in memory_map:
+            if r.start % PAGE_SIZE or r.end % PAGE_SIZE:
+                raise ValueError(f"memory region '{r.name}' is not aligned to {PAGE_SIZE} byte pages")
+        self.regions = sorted(memory_map, key=lambda r: r.start)
+        # page number -> the page's words (a memoryview of its bytearray)
+        self.pages = {}
+        # the pages of ram regions that were stored to, stores that hit one skip the checks
+        # (a rom page loaded by load_image() is only in pages)
+        self.writable = {}
+        self.dirty = bytearray(PAGE_COUNT // 8)
+        # region name -> (read(addr), write(addr, value))
+        self.devices = {}
+
+    def region(self, addr):
+        for r in self.regions:
+            if r.start <= addr < r.end:
+                return r
+        return None
+
+    def map_device(self, name, read, write):
+        self.devices[name] = (read, write)
+
+    def load_word(self, addr):
+        page = self.pages.get(addr >> PAGE_SHIFT)
+        if page is not None and not addr & 3:
+            return page[(addr & (PAGE_SIZE - 1)) >> 2]
+        r = self.check(addr, 'load')
+        if r.kind == 'mmio':
+            return self.device(r, addr)[0](addr) & 0xFFFFFFFF
+        return 0
+
+    def store_word(self, addr, value):
+        n = addr >> PAGE_SHIFT
+        page = self.writable.get(n)
+        if page is None or addr & 3:
+            r = self.check(addr, 'store')
+            if r.kind == 'mmio':
+                self.device(r, addr)[1](addr, value)
+                return
+            if r.kind == 'rom':
+                raise MemoryFault(addr, "store to read-only memory")
+            page = self.pages.get(n)
+            if page is None:
+                page = self.pages[n] = self.new_page()
+            self.writable[n] = page
+        page[(addr & (PAGE_SIZE - 1)) >> 2] = value
+        self.dirty[n >> 3] |= 1 << (n & 7)
+
+    # the region of an access that missed the page table, or a fault
+    def check(self, addr, access):
+        if addr & 3:
+            raise MemoryFault(addr, f"misaligned {access}")
+        r = self.region(addr)
+        if r is None:
+            raise MemoryFault(addr, f"{access} outside the memory map")
+        return r
+
+    def device(self, r, addr):
+        if r.name not in self.devices:
+            raise MemoryFault(addr, f"no device attached to '{r.name}'")
+        return self.devices[r.name]
+
+    def new_page(self):
+        return memoryview(bytearray(PAGE_SIZE)).cast('I')
+
+    # writes words from addr on into any ram or rom region, the pages stay clean
+    def load_image(self, addr, words):
+        for i, word in enumerate(words):
+            a = addr + 4*i
+            r = self.check(a, 'load of the image')
+            if r.kind == 'mmio':
+                raise MemoryFault(a, "image loaded into mmio")
+            page = self.pages.get(a >> PAGE_SHIFT)
+            if page is None:
+                page = self.pages[a >> PAGE_SHIFT] = self.new_page()
+            page[(a & (PAGE_SIZE - 1)) >> 2] = word
+
+    def is_dirty(self, n):
+        return self.dirty[n >> 3] >> (n & 7) & 1
+
+    def dirty_pages(self):
+        return sorted(n for n in self.pages if self.is_dirty(n))
+
+    def clear_dirty(self):
+        for n in self.pages:
+            self.dirty[n >> 3] = 0
+
+    def set_dirty(self, n):
+        self.dirty[n >> 3] |= 1 << (n & 7)
+
+    def remove_word(self, addr):
+        self.store_word(addr, 0)
+
+    # what a store to addr changes besides the word, for undoing it with restore_flags():
+    # None when its page is dirty already (or a device's or the store faults), else whether
+    # the page existed before
+    def store_flags(self, addr):
+        if addr & 3 or not 0 <= addr < 1 << 32:
+            return None
+        n = addr >> PAGE_SHIFT
+        if self.is_dirty(n):
+            return None
+        if n in self.pages:
+            return True
+        r = self.region(addr)
+        return None if r is None or r.kind == 'mmio' else False
+
+    # after the word of an undone store was put back: its page is clean again, or gone when
+    # the store allocated it
+    def restore_flags(self, addr, existed):
+        n = addr >> PAGE_SHIFT
+        self.dirty[n >> 3] &= ~(1 << (n & 7)) & 0xFF
+        if not existed:
+            del self.pages[n]
+            self.writable.pop(n, None)
+
+    # a copy of the contents and the dirty bits, for set_state()
+    def state(self):
+        return {n: bytes(page.cast('B')) for n, page in self.pages.items()}, bytes(self.dirty)
+
+    def set_state(self, state):
+        pages, dirty = state
+        self.pages = {}
+        self.writable = {}
+        for n, data in pages.items():
+            page = self.pages[n] = self.new_page()
+            page.cast('B')[:] = data
+        self.dirty[:] = dirty
+
+    def fingerprint(self, h):
+        for n in sorted(self.pages):
+            h.update(n.to_bytes(4, 'little'))
+            h.update(self.pages[n])
+
+    # (address, word) pairs of every word in the dirty pages, by address
+    def items(self):
+        items = []
+        for n in self.dirty_pages():
+            base = n << PAGE_SHIFT
+            items.extend((base + 4*i, word) for i, word in enumerate(self.pages[n]))
+        return items
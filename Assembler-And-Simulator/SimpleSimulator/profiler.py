@@ -0,0 +1,173 @@
+import json
+from array import array
+from tracing import disassemble
+
+# Execution profiler for machine.py. Profiler.run is a copy of Machine.run that also
+# counts, so runs without a profiler pay nothing for it. Per step it only bumps counters
+# in arrays indexed by pc/4 and by call stack, everything else (instruction mix, cycles,
+# branch ratios, hot loops) is worked out from those counts when the report is written.
+#
+# Call stacks follow jal/jalr: a jump that links (rd != 0) calls its target, a jalr that
+# does not link returns and a jal that does not link (j, a loop or a skip inside the
+# function) stays in the frame. The folded stack file has one "frame;frame;... count" line per
+# stack, the format flamegraph.pl and speedscope read.
+
+BRANCHES = {'beq', 'bne', 'blt', 'bge', 'bltu', 'bgeu'}
+
+# estimated cycles per instruction by name, 'default' for names that are not listed and
+# 'branch_taken' for a branch that is taken (a branch that falls through costs its own entry)
+DEFAULT_CPI = {'default': 1, 'lw': 2, 'mul': 3, 'jal': 2, 'jalr': 2, 'branch_taken': 2}
+
+# reads a CPI table from a JSON file or from 'name=cycles,...', on top of DEFAULT_CPI
+def parse_cpi(spec):
+    cpi = dict(DEFAULT_CPI)
+    if spec.endswith('.json'):
+        with open(spec) as f:
+            cpi.update(json.load(f))
+    else:
+        for part in spec.split(','):
+            name, cycles = part.split('=')
+            cpi[name.strip()] = float(cycles)
+    return cpi
+
+
+class Profiler:
+    def __init__(self, machine, cpi=DEFAULT_CPI, symbols=None):
+        self.m = machine
+        self.cpi = cpi
+        # pc -> name of the function starting there, used for the stack frames
+        self.symbols = symbols or {}
+        size = max(machine.program_memory, default=0) // 4 + 1
+        self.counts = array('Q', [0]) * size
+        self.taken = array('Q', [0]) * size
+        # call stacks as tuples of function entry pcs, interned to an index into stack_counts
+        self.frames = [machine.pc]
+        self.stack_ids = {}
+        self.stacks = []
+        self.stack_counts = []
+        self.stack = self.intern()
+
+    def intern(self):
+        key = tuple(self.frames)
+        sid = self.stack_ids.get(key)
+        if sid is None:
+            sid = self.stack_ids[key] = len(self.stacks)
+            self.stacks.append(key)
+            self.stack_counts.append(0)
+        return sid
+
+    # a jal/jalr that left the straight line path
+    def transfer(self, name, rd, target):
+        if rd != 0:
+            self.frames.append(target)
+        elif name == 'jalr' and len(self.frames) > 1:
+            self.frames.pop()
+        else:
+            return
+        self.stack = self.intern()
+
+    # Machine.run with counting, see there
+    def run(self, on_step=None, max_steps=None):
+        m = self.m
+        code = m.code
+        regs = m.regs
+        counts = self.counts
+        taken = self.taken
+        stack_counts = self.stack_counts
+        pc = m.pc
+        steps = m.steps
+        limit = steps + max_steps if max_steps is not None else 1 << 62
+        try:
+            while not m.halted and steps < limit:
+                handler, rd, rs1, rs2, imm, name, word = code[pc]
+                fetched = pc
+                pc = handler(m, regs, pc, rd, rs1, rs2, imm)
+                regs[0] = 0
+                steps += 1
+                counts[fetched >> 2] += 1
+                stack_counts[self.stack] += 1
+                if pc != fetched + 4:
+                    if name in BRANCHES:
+                        taken[fetched >> 2] += 1
+                    elif name == 'jal' or name == 'jalr':
+                        self.transfer(name, rd, pc)
+                if on_step is not None:
+                    m.pc = pc
+                    m.steps = steps
+                    on_step(m, fetched)
+        finally:
+            m.pc = pc
+            m.steps = steps
+
+    def cycles(self, pc):
+        name = self.m.code[pc].name
+        count = self.counts[pc >> 2]
+        cpi = self.cpi.get(name, self.cpi['default'])
+        if name in BRANCHES:
+            taken = self.taken[pc >> 2]
+            return taken * self.cpi['branch_taken'] + (count - taken) * cpi
+        return count * cpi
+
+    # backward taken branches as loops: (first pc, branch pc, iterations, instructions run inside)
+    def loops(self):
+        loops = []
+        for i, taken in enumerate(self.taken):
+            pc = 4 * i
+            if taken and self.m.code[pc].imm < 0:
+                start = pc + self.m.code[pc].imm
+                inside = sum(self.counts[start >> 2:i + 1])
+                loops.append((start, pc, taken, inside))
+        loops.sort(key=lambda loop: -loop[3])
+        return loops
+
+    def report(self, top=20):
+        code = self.m.code
+        executed = [4 * i for i, count in enumerate(self.counts) if count]
+        steps = sum(self.counts)
+        cycles = sum(self.cycles(pc) for pc in executed)
+        lines = [f"instructions {steps}, estimated cycles {cycles:g}, CPI {cycles / steps if steps else 0:.2f}", ""]
+
+        mix = {}
+        for pc in executed:
+            name = code[pc].name
+            count, cyc = mix.get(name, (0, 0))
+            mix[name] = (count + self.counts[pc >> 2], cyc + self.cycles(pc))
+        lines.append("instruction mix")
+        for name, (count, cyc) in sorted(mix.items(), key=lambda item: -item[1][0]):
+            lines.append(f"  {name:<12} {count:>12} {100 * count / steps:6.2f}%  {cyc:>12g} cycles")
+
+        lines += ["", f"hot instructions (top {top})"]
+        for pc in sorted(executed, key=lambda pc: -self.counts[pc >> 2])[:top]:
+            count = self.counts[pc >> 2]
+            lines.append(f"  0x{pc:08x} {count:>12} {100 * count / steps:6.2f}%  {disassemble(code[pc])}")
+
+        lines += ["", "branches"]
+        for pc in executed:
+            if code[pc].name in BRANCHES:
+                count, taken = self.counts[pc >> 2], self.taken[pc >> 2]
+                lines.append(f"  0x{pc:08x} {disassemble(code[pc]):<28} taken {taken:>10}  not taken {count - taken:>10}"
+                             f"  {100 * taken / count:6.2f}% taken")
+
+        lines += ["", "hot loops"]
+        for start, end, iterations, inside in self.loops()[:top]:
+            lines.append(f"  0x{start:08x}-0x{end:08x} {iterations:>12} iterations {inside:>12} instructions"
+                         f" {100 * inside / steps:6.2f}%")
+        return "\n".join(lines) + "\n"
+
+    def frame_name(self, pc):
+        return self.symbols.get(pc, f"0x{pc:08x}")
+
+    def folded(self):
+        lines = []
+        for stack, count in zip(self.stacks, self.stack_counts):
+            if count:
+                lines.append(";".join(self.frame_name(pc) for pc in stack) + f" {count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, report_path=None, folded_path=None):
+        if report_path is not None:
+            with open(report_path, 'w') as f:
+                f.write(self.report())
+        if folded_path is not None:
+            with open(folded_path, 'w') as f:
+                f.write(self.folded())
@@ -1,5 +1,17 @@
-opcodes = { 
-    'add' : '0110011', 'sub' : '0110011', 'sll' : '0110011', 'slt' : '0110011', 'sltu' : '0110011', 'xor' : '0110011', 'srl' : '0110011', 'or' : '0110011', 'and' : '0110011',
+import sys
+
+# Disassembler. Whole programs are decoded at once: the bit fields and immediates of every
+# word are extracted column by column (with NumPy when it is installed, plain list
+# comprehensions otherwise) and each row is then formatted through precomputed name
+# tables. The output is assembler syntax with register names only, so it assembles back
+# to the same words. Words the assembler cannot produce are written as '.word 0x........'.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+opcodes = {
+    'add' : '0110011', 'sub' : '0110011', 'sll' : '0110011', 'slt' : '0110011', 'sltu' : '0110011', 'xor' : '0110011', 'srl' : '0110011', 'or' : '0110011', 'and' : '0110011', 'mul' : '0110011',
     'lw' : '0000011', 'addi' : '0010011', 'sltiu' : '0010011', 'jalr' : '1100111',
     'sw' : '0100011',
     'beq' : '1100011', 'bne' : '1100011', 'blt' : '1100011', 'bge' : '1100011', 'bltu' : '1100011', 'bgeu' : '1100011',
@@ -9,7 +21,7 @@ opcodes = {
 
 # for different types of commands in the processor/assembler
 types = {
-    'R' : ['add','sub','sll','slt','sltu','xor','srl','or','and'],
+    'R' : ['add','sub','sll','slt','sltu','xor','srl','or','and','mul'],
     'I' : ['lw','addi','sltiu','jalr'],
     'S' : ['sw'],
     'B' : ['beq','bne','blt','bge','bltu','bgeu'],
@@ -27,80 +39,118 @@ registers = {
     "t5": "11110", "t6": "11111"
 }
 
+# register values for bin_to_abi, set by Simulator.py
 reg_mem = {}
 
 rev_regs = {v: k for k, v in registers.items()}
 
+# register number -> ABI name
+register_names = [None] * 32
+for name, binary in registers.items():
+    register_names[int(binary, 2)] = name
+
 VIRTUAL_HALT_INSTRUCTION_BIN = "00000000000000000000000001100011"
+RST_INSTRUCTION = 0x0000007F
+HALT_INSTRUCTION = 0xFFFFFFFF
 
-def reverse_assembler(binary_string):
-    # Reverse the opcodes dictionary to get the instruction names
-    opcodes_reverse = {v: k for k, v in opcodes.items()}
-    
-    # Split the binary string into 32-bit chunks
-    chunks = [binary_string[i:i+32] for i in range(0, len(binary_string), 32)]
-    
-    # Initialize an empty list to store the instructions
-    instructions = []
-    
-    # Iterate over the chunks and convert them back to instructions
-    for chunk in chunks:
-        opcode = chunk[-7:]
-        
-        # Check if the opcode is a virtual halt instruction
-        if opcode == VIRTUAL_HALT_INSTRUCTION_BIN:
-            instructions.append("virtual_halt")
+# name tables by opcode and function fields
+R_NAMES = {(0b000, 0): 'add', (0b000, 0b0100000): 'sub', (0b001, 0): 'sll', (0b010, 0): 'slt', (0b011, 0): 'sltu',
+           (0b100, 0): 'xor', (0b101, 0): 'srl', (0b110, 0): 'or', (0b111, 0): 'and', (0b111, 0b0100000): 'mul'}
+I_NAMES = {(0b0000011, 0b010): 'lw', (0b0010011, 0b000): 'addi', (0b0010011, 0b011): 'sltiu', (0b1100111, 0b000): 'jalr'}
+B_NAMES = {0b000: 'beq', 0b001: 'bne', 0b100: 'blt', 0b101: 'bge', 0b110: 'bltu', 0b111: 'bgeu'}
+U_NAMES = {0b0110111: 'lui', 0b0010111: 'auipc'}
+
+# Bit fields and sign extended immediates of all words, one list per field:
+# opcode, rd, funct3, rs1, rs2, funct7, I, S, B, U and J immediates
+def decode_columns(words):
+    if np is not None:
+        w = np.asarray(words, dtype=np.uint32).astype(np.int64)
+        s = w - ((w & 0x80000000) << 1) # the word as a signed 32 bit value
+        columns = [
+            w & 0x7F, (w >> 7) & 0x1F, (w >> 12) & 0x7, (w >> 15) & 0x1F, (w >> 20) & 0x1F, w >> 25,
+            s >> 20,
+            ((s >> 25) << 5) | ((w >> 7) & 0x1F),
+            ((s >> 31) << 12) | (((w >> 7) & 1) << 11) | (((w >> 25) & 0x3F) << 5) | (((w >> 8) & 0xF) << 1),
+            (s >> 12) << 12,
+            ((s >> 31) << 20) | (((w >> 12) & 0xFF) << 12) | (((w >> 20) & 1) << 11) | (((w >> 21) & 0x3FF) << 1),
+        ]
+        return [c.tolist() for c in columns]
+    w = list(words)
+    s = [x - ((x & 0x80000000) << 1) for x in w]
+    return [
+        [x & 0x7F for x in w], [(x >> 7) & 0x1F for x in w], [(x >> 12) & 0x7 for x in w],
+        [(x >> 15) & 0x1F for x in w], [(x >> 20) & 0x1F for x in w], [x >> 25 for x in w],
+        [x >> 20 for x in s],
+        [((y >> 25) << 5) | ((x >> 7) & 0x1F) for x, y in zip(w, s)],
+        [((y >> 31) << 12) | (((x >> 7) & 1) << 11) | (((x >> 25) & 0x3F) << 5) | (((x >> 8) & 0xF) << 1) for x, y in zip(w, s)],
+        [(y >> 12) << 12 for y in s],
+        [((y >> 31) << 20) | (((x >> 12) & 0xFF) << 12) | (((x >> 20) & 1) << 11) | (((x >> 21) & 0x3FF) << 1) for x, y in zip(w, s)],
+    ]
+
+# assembly text of every word, each distinct word is decoded and formatted once
+def disassemble(words):
+    if np is not None:
+        words = np.asarray(words, dtype=np.uint32).tolist()
+    lines = dict(zip(*format_words(list(dict.fromkeys(words)))))
+    return [lines[w] for w in words]
+
+# (words, assembly text) of a list of words
+def format_words(words):
+    columns = decode_columns(words)
+    reg = register_names
+    lines = []
+    append = lines.append
+    for w, op, rd, f3, rs1, rs2, f7, imm_i, imm_s, imm_b, imm_u, imm_j in zip(words, *columns):
+        if op == 0b0110011:
+            name = R_NAMES.get((f3, f7))
+            if name is not None:
+                append(f"{name} {reg[rd]}, {reg[rs1]}, {reg[rs2]}")
+                continue
+        elif op == 0b0000011 or op == 0b0010011 or op == 0b1100111:
+            name = I_NAMES.get((op, f3))
+            if name == 'lw':
+                append(f"lw {reg[rd]}, {imm_i}({reg[rs1]})")
+                continue
+            if name is not None:
+                append(f"{name} {reg[rd]}, {reg[rs1]}, {imm_i}")
+                continue
+        elif op == 0b0100011:
+            if f3 == 0b010:
+                append(f"sw {reg[rs2]}, {imm_s}({reg[rs1]})")
+                continue
+        elif op == 0b1100011:
+            name = B_NAMES.get(f3)
+            if name is not None:
+                append(f"{name} {reg[rs1]}, {reg[rs2]}, {imm_b}")
+                continue
+        elif op == 0b0110111 or op == 0b0010111:
+            append(f"{U_NAMES[op]} {reg[rd]}, {imm_u}")
+            continue
+        elif op == 0b1101111:
+            # the assembler puts immediate bit 10 into word bit 20, other words have no source form
+            if (w >> 20) & 1 == (w >> 30) & 1:
+                append(f"jal {reg[rd]}, {imm_j}")
+                continue
+        elif op == 0b0000001:
+            if w == rs1 << 15 | rd << 7 | 0b0000001:
+                append(f"rvrs {reg[rd]}, {reg[rs1]}")
+                continue
+        elif w == RST_INSTRUCTION:
+            append("rst")
             continue
-        
-        # Get the instruction name based on the opcode
-        instruction = opcodes_reverse.get(opcode)
-        
-        # Check if the instruction is of type R
-        if instruction in types['R']:
-            funct3 = chunk[-15:-12]
-            funct7 = chunk[-32:-25]
-            rd = bin_to_abi(chunk[-12:-7])
-            rs1 = bin_to_abi(chunk[-20:-15])
-            rs2 = bin_to_abi(chunk[-25:-20])
-            instructions.append(f"{instruction} {rd}, {rs1}, {rs2}")
-        
-        # Check if the instruction is of type I
-        elif instruction in types['I']:
-            funct3 = chunk[-15:-12]
-            rd = bin_to_abi(chunk[-12:-7])
-            rs = bin_to_abi(chunk[-20:-15])
-            imm = bin_to_dec(chunk[:-20])
-            instructions.append(f"{instruction} {rd}, {rs}, {imm}")
-        
-        # Check if the instruction is of type S
-        elif instruction in types['S']:
-            funct3 = chunk[-15:-12]
-            rs2 = bin_to_abi(chunk[-25:-20])
-            rs1 = bin_to_abi(chunk[-20:-15])
-            imm = bin_to_dec(chunk[:-25] + chunk[-12:-7])
-            instructions.append(f"{instruction} {rs2}, {imm}({rs1})")
-        
-        # Check if the instruction is of type B
-        elif instruction in types['B']:
-            funct3 = chunk[-15:-12]
-            rs1 = bin_to_abi(chunk[-20:-15])
-            rs2 = bin_to_abi(chunk[-25:-20])
-            imm = bin_to_dec(chunk[0] + chunk[24] + chunk[1:7] + chunk[20:24] + "0")
-            instructions.append(f"{instruction} {rs1}, {rs2}, {imm}")
-        
-        # Check if the instruction is of type U
-        elif instruction in types['U']:
-            rd = bin_to_abi(chunk[-12:-7])
-            imm = bin_to_dec(chunk[:-12] + chunk[-32:-12])
-            instructions.append(f"{instruction} {rd}, {imm}")
-        
-        # Check if the instruction is of type J
-        elif instruction in types['J']:
-            rd = bin_to_abi(chunk[-12:-7])
-            imm = bin_to_dec(chunk[0] + chunk[12:20] + chunk[11] + chunk[1:11] + "0")
-            instructions.append(f"{instruction} {rd}, {imm}")
-    
-    return instructions
+        elif w == HALT_INSTRUCTION:
+            append("halt")
+            continue
+        append(f".word 0x{w:08x}")
+    return words, lines
+
+def disassemble_word(word):
+    return disassemble([word])[0]
+
+# disassembles a string of 32 bit binary words
+def reverse_assembler(binary_string):
+    words = [int(binary_string[i:i+32], 2) for i in range(0, len(binary_string), 32)]
+    return disassemble(words)
 
 
 def to_dec(binary, unsigned=False):
@@ -113,14 +163,13 @@ def to_dec(binary, unsigned=False):
     else:
         return int(binary, 2)
 
+# ABI name of a 5 bit register string with its current value from reg_mem, for the
+# verbose output of Simulator.py
 def bin_to_abi(binary, unsigend=False):
-    # Convert the binary string to ABI register name
-    # Implement the reverse logic of bin_from_abi function
-    
-    for register, value in registers.items():
-        if value == binary:
-            return register + '(x' + str(int(binary, 2)) + ': ' + str(to_dec(reg_mem[binary], unsigend)) + ')'
-    return None
+    register = rev_regs.get(binary)
+    if register is None:
+        return None
+    return register + '(x' + str(int(binary, 2)) + ': ' + str(to_dec(reg_mem[binary], unsigend)) + ')'
 
 def bin_to_dec(binary):
     # Convert the binary string to decimal number
@@ -130,28 +179,32 @@ def bin_to_dec(binary):
         decimal -= 2 ** len(binary)
     return decimal
 
+# (words, address of the first word) of an assembled program, text or program image
+def read_words(path):
+    import machine # puts the assembler directory with image.py on the path
+    import image
+    if image.is_image(path):
+        program = image.read_image(path)
+        return program.words, program.text_base
+    with open(path) as f:
+        return [int(line, 2) if line.strip() else 0 for line in f], 0
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Disassemble an assembled program")
+    parser.add_argument('program', help="one 32 bit binary word per line, or a program image")
+    parser.add_argument('out_file', nargs='?', help="output file (default: stdout)")
+    parser.add_argument('--addresses', action='store_true', help="prefix every line with its address")
+    args = parser.parse_args(argv)
+
+    words, base = read_words(args.program)
+    lines = disassemble(words)
+    if args.addresses:
+        lines = [f"0x{base + 4*i:08x}: {line}" for i, line in enumerate(lines)]
+    out = open(args.out_file, 'w') if args.out_file else sys.stdout
+    out.write("\n".join(lines) + "\n")
+    if args.out_file:
+        out.close()
+
 if __name__ == "__main__":
-    infile = 's_test3_input.txt'
-
-    # Example usage
-    with open(infile) as f:
-        lines = f.readlines()
-
-    i_memory = {}
-    i = 0
-    for line in lines:
-        binary_string = line.strip()
-        instructions = reverse_assembler(binary_string)
-        i_memory[i*4] = instructions
-        # print(format(i*4, '02d'), ': ', instructions[0])
-        print(instructions[0])
-        i += 1
-
-    # with open('Simulator/s_test2.txt') as f:
-    #     lines = f.readlines()
-
-    #     for line in lines:
-    #         pc = line.strip().split()[0]
-    #         if pc[:2] == '0b':
-    #             pc = int(pc, 2)
-    #             print(i_memory[pc-4])
\ No newline at end of file
+    main()
@@ -0,0 +1,143 @@
+import os
+import sys
+import zlib
+import struct
+from array import array
+import machine
+from memory import WindowMemory, PagedMemory, Region, PAGE_SIZE
+
+# Snapshots of a machine.py run: pc, registers, step count, program memory (it may have
+# been rewritten by the program), data memory and the position reached in the text trace.
+# A snapshot has everything needed to continue the run, the program file is not needed.
+# For PagedMemory the memory map and the pages are saved, the dirty pages (dirty_pages())
+# apart from the clean ones a program image or a rom was loaded into, so the dump of a
+# resumed run has the same pages as the uninterrupted one. Devices attached to mmio regions
+# have to be attached again after load().
+#
+# Version 1 packed the pcs as 32 bit signed integers and versions 1 and 2 saved the pages in
+# one list, all dirty. load() still reads both.
+#
+# file:  '<4sH' magic, version, then zlib compressed:
+#        '<qQBq'  pc, steps, flags (1 halted, 2 self_modifying), trace offset (-1 for none)
+#        '<32I'   registers
+#        '<I' count, count * '<qI'   program memory (pc, word)
+#        'W' '<32I' data window, '<I' count, count * '<qI' other words in first-write order
+#     or 'P' '<I' count, count * ('<IIB' start, end, kind, '<B' name length, name)
+#            '<I' count, count * ('<I' page number, PAGE_SIZE little-endian bytes)   dirty pages
+#            '<I' count, count * ('<I' page number, PAGE_SIZE little-endian bytes)   clean pages
+
+SNAPSHOT_MAGIC = b'RVSN'
+VERSION = 3
+HEADER = struct.Struct('<4sH')
+# version -> pc, steps, flags, trace offset and (pc, word) of the program memory
+STATE = {1: struct.Struct('<iQBq'), 2: struct.Struct('<qQBq'), 3: struct.Struct('<qQBq')}
+PROGRAM_ENTRY = {1: struct.Struct('<iI'), 2: struct.Struct('<qI'), 3: struct.Struct('<qI')}
+KINDS = ['ram', 'rom', 'mmio']
+
+FLAG_HALTED = 1
+FLAG_SELF_MODIFYING = 2
+
+def words_bytes(words):
+    words = array('I', words)
+    if sys.byteorder != 'little':
+        words.byteswap()
+    return words.tobytes()
+
+def bytes_words(data):
+    words = array('I')
+    words.frombytes(data)
+    if sys.byteorder != 'little':
+        words.byteswap()
+    return words
+
+def save(m, path, trace_offset=None):
+    flags = (FLAG_HALTED if m.halted else 0) | (FLAG_SELF_MODIFYING if m.self_modifying else 0)
+    parts = [STATE[VERSION].pack(m.pc, m.steps, flags, -1 if trace_offset is None else trace_offset), words_bytes(m.regs)]
+    program = list(m.program_memory.items())
+    parts.append(struct.pack('<I', len(program)))
+    parts.extend(PROGRAM_ENTRY[VERSION].pack(pc, word) for pc, word in program)
+
+    memory = m.memory
+    if isinstance(memory, WindowMemory):
+        parts += [b'W', words_bytes(memory.data), struct.pack('<I', len(memory.extra))]
+        parts.extend(struct.pack('<qI', addr, word) for addr, word in memory.extra.items())
+    else:
+        parts += [b'P', struct.pack('<I', len(memory.regions))]
+        for r in memory.regions:
+            name = r.name.encode()
+            parts.append(struct.pack('<IIBB', r.start, r.end, KINDS.index(r.kind), len(name)) + name)
+        dirty = memory.dirty_pages()
+        clean = sorted(set(memory.pages) - set(dirty))
+        for numbers in (dirty, clean):
+            parts.append(struct.pack('<I', len(numbers)))
+            parts.extend(struct.pack('<I', n) + words_bytes(memory.pages[n]) for n in numbers)
+
+    # written next to the old snapshot and renamed over it, a crash never leaves half a file
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(SNAPSHOT_MAGIC, VERSION))
+        f.write(zlib.compress(b''.join(parts)))
+    os.replace(tmp, path)
+
+# returns (machine, trace offset or None)
+def load(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version = HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version not in STATE:
+        raise ValueError(f"{path} is not a simulator snapshot")
+    data = zlib.decompress(data[HEADER.size:])
+
+    pc, steps, flags, trace_offset = STATE[version].unpack_from(data)
+    pos = STATE[version].size
+    regs = bytes_words(data[pos:pos + 128])
+    pos += 128
+    count, = struct.unpack_from('<I', data, pos)
+    pos += 4
+    program = {}
+    entry = PROGRAM_ENTRY[version]
+    for i in range(count):
+        addr, word = entry.unpack_from(data, pos)
+        program[addr] = word
+        pos += entry.size
+
+    kind = data[pos:pos + 1]
+    pos += 1
+    if kind == b'W':
+        memory = WindowMemory()
+        memory.data = bytes_words(data[pos:pos + 128])
+        pos += 128
+        count, = struct.unpack_from('<I', data, pos)
+        pos += 4
+        for i in range(count):
+            addr, word = struct.unpack_from('<qI', data, pos)
+            memory.extra[addr] = word
+            pos += 12
+    else:
+        count, = struct.unpack_from('<I', data, pos)
+        pos += 4
+        regions = []
+        for i in range(count):
+            start, end, kind, length = struct.unpack_from('<IIBB', data, pos)
+            pos += 10
+            regions.append(Region(data[pos:pos + length].decode(), start, end, KINDS[kind]))
+            pos += length
+        memory = PagedMemory(regions)
+        for dirty in ((True, False) if version >= 3 else (True,)):
+            count, = struct.unpack_from('<I', data, pos)
+            pos += 4
+            for i in range(count):
+                n, = struct.unpack_from('<I', data, pos)
+                page = memory.pages[n] = memory.new_page()
+                page[:] = bytes_words(data[pos + 4:pos + 4 + PAGE_SIZE])
+                if dirty:
+                    memory.set_dirty(n)
+                pos += 4 + PAGE_SIZE
+
+    m = machine.Machine(program, memory)
+    m.pc = pc
+    m.steps = steps
+    m.regs[:] = regs
+    m.halted = bool(flags & FLAG_HALTED)
+    m.self_modifying = bool(flags & FLAG_SELF_MODIFYING)
+    return m, (None if trace_offset < 0 else trace_offset)
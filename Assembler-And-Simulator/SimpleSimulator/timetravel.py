@@ -0,0 +1,268 @@
+import sys
+from array import array
+from alu import to_signed
+import machine
+
+# Reverse execution for machine.py. Every step forward records what it is about to
+# overwrite in an undo log: the old pc plus the old value of the one register or memory
+# word the instruction writes. Stepping back pops records and puts the old values back.
+#
+# The log is a ring buffer of `capacity` steps, older records are evicted. Every
+# `keyframe_interval` steps a full copy of the machine state is kept as well (at most
+# `max_keyframes` of them), and going back past the oldest undo record restores the last
+# keyframe before the target and runs forward from there. Memory for the history is
+# bounded by capacity and max_keyframes however long the run is.
+#
+# Undoing a store to a PagedMemory also makes its page clean again if it was before, or
+# drops the page if the store allocated it, so the memory dump is the one of the step gone
+# back to. Stores to mmio regions of a PagedMemory reach a device and cannot be undone.
+
+# what an undo record restores
+UNDO_NONE = 0      # only the pc (branches, jumps without a link register, halts)
+UNDO_REGISTER = 1  # register `where`
+UNDO_MEMORY = 2    # memory word at address `where`
+UNDO_NEW_WORD = 3  # memory word at `where` that did not exist before the store
+UNDO_SIDE = 4      # more than one value, kept in TimeTravel.side (rst, self-modifying stores)
+UNDO_PAGE = 5      # memory word at `where` whose page the store made dirty, store_flags() in TimeTravel.side
+
+NO_RD = {'sw', 'beq', 'bne', 'blt', 'bge', 'bltu', 'bgeu', 'rst', 'halt', 'virtual_halt', 'unknown'}
+
+DEFAULT_CAPACITY = 1 << 20
+DEFAULT_KEYFRAME_INTERVAL = 1 << 16
+DEFAULT_MAX_KEYFRAMES = 64
+
+
+class TimeTravel:
+    def __init__(self, m, capacity=DEFAULT_CAPACITY, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL,
+                 max_keyframes=DEFAULT_MAX_KEYFRAMES):
+        self.m = m
+        self.capacity = capacity
+        self.pcs = array('q', [0]) * capacity
+        self.kinds = array('b', [0]) * capacity
+        self.wheres = array('q', [0]) * capacity
+        self.values = array('q', [0]) * capacity
+        # undo records of the steps [m.steps - count, m.steps), the record of step s is at s % capacity
+        self.count = 0
+        # step -> values of an UNDO_SIDE record
+        self.side = {}
+        self.keyframe_interval = keyframe_interval
+        self.max_keyframes = max_keyframes
+        self.keyframes = {}
+        self.breakpoints = set()
+        self.watch_registers = set()
+        self.watch_memory = set()
+        self.keyframe()
+
+    # oldest step that can still be reached
+    def earliest(self):
+        oldest = self.m.steps - self.count
+        if self.keyframes:
+            oldest = min(oldest, min(self.keyframes))
+        return oldest
+
+    def keyframe(self):
+        m = self.m
+        self.keyframes[m.steps] = (m.pc, m.halted, array('I', m.regs), m.memory.state(),
+                                   dict(m.program_memory) if m.self_modifying else None)
+        while len(self.keyframes) > self.max_keyframes:
+            del self.keyframes[min(self.keyframes)]
+
+    def restore_keyframe(self, step):
+        m = self.m
+        pc, halted, regs, memory, program = self.keyframes[step]
+        m.pc, m.steps, m.halted = pc, step, halted
+        m.regs[:] = regs
+        m.memory.set_state(memory)
+        if program is not None:
+            for addr, word in program.items():
+                if m.program_memory[addr] != word:
+                    m.write_program(addr, word)
+        self.count = 0
+        self.side.clear()
+
+    # executes one instruction and logs how to undo it, returns False once halted
+    def step(self):
+        m = self.m
+        if m.halted:
+            return False
+        pc = m.pc
+        handler, rd, rs1, rs2, imm, name, word = m.code[pc]
+        kind, where, value, side = UNDO_NONE, 0, 0, None
+        if name == 'sw':
+            where = to_signed(m.regs[rs1]) + imm
+            flags = m.memory.store_flags(where)
+            try:
+                value = m.load_word(where)
+                kind = UNDO_MEMORY
+            except Exception: # never stored (or the store faults below)
+                kind = UNDO_NEW_WORD
+            if m.self_modifying and where in m.program_memory:
+                side = (kind, value, m.program_memory[where], flags)
+                kind = UNDO_SIDE
+            elif flags is not None:
+                kind, side = UNDO_PAGE, flags
+        elif name == 'rst':
+            kind, side = UNDO_SIDE, array('I', m.regs)
+        elif rd and name not in NO_RD:
+            kind, where, value = UNDO_REGISTER, rd, m.regs[rd]
+        m.step()
+
+        step = m.steps - 1
+        i = step % self.capacity
+        if self.count == self.capacity: # evict the oldest record
+            self.side.pop(step - self.capacity, None)
+        else:
+            self.count += 1
+        self.pcs[i], self.kinds[i], self.wheres[i], self.values[i] = pc, kind, where, value
+        if side is not None:
+            self.side[step] = side
+        if m.steps % self.keyframe_interval == 0 and m.steps not in self.keyframes:
+            self.keyframe()
+        return not m.halted
+
+    # undoes the last step, returns the (kind, where) it restored or None at the start of history
+    def undo(self):
+        m = self.m
+        if self.count == 0:
+            if m.steps <= self.earliest():
+                return None
+            # refill the log from the last keyframe before this step
+            target = m.steps
+            self.restore_keyframe(max(step for step in self.keyframes if step < target))
+            while m.steps < target:
+                self.step()
+        step = m.steps - 1
+        i = step % self.capacity
+        kind, where, value = self.kinds[i], self.wheres[i], self.values[i]
+        if kind == UNDO_REGISTER:
+            m.regs[where] = value
+        elif kind == UNDO_MEMORY:
+            m.memory.store_word(where, value)
+        elif kind == UNDO_NEW_WORD:
+            m.memory.remove_word(where)
+        elif kind == UNDO_PAGE:
+            m.memory.store_word(where, value)
+            m.memory.restore_flags(where, self.side.pop(step))
+        elif kind == UNDO_SIDE:
+            side = self.side.pop(step)
+            if isinstance(side, array):
+                m.regs[:] = side
+            else:
+                kind, value, program_word, flags = side
+                if kind == UNDO_MEMORY:
+                    m.memory.store_word(where, value)
+                else:
+                    m.memory.remove_word(where)
+                if flags is not None:
+                    m.memory.restore_flags(where, flags)
+                m.write_program(where, program_word)
+        m.pc = self.pcs[i]
+        m.steps = step
+        m.halted = False
+        self.count -= 1
+        return kind, where
+
+    # moves to an earlier or later step
+    def goto(self, target):
+        m = self.m
+        if target < self.earliest():
+            raise ValueError(f"step {target} is no longer in the history (earliest {self.earliest()})")
+        if target < m.steps - self.count: # further back than the undo log, replay from a keyframe
+            self.restore_keyframe(max(step for step in self.keyframes if step <= target))
+        while m.steps > target:
+            self.undo()
+        while m.steps < target and self.step():
+            pass
+
+    def step_back(self, n=1):
+        self.goto(max(self.m.steps - n, self.earliest()))
+
+    def watched(self, kind, where):
+        if kind == UNDO_REGISTER:
+            return where in self.watch_registers
+        if kind in (UNDO_MEMORY, UNDO_NEW_WORD, UNDO_PAGE):
+            return where in self.watch_memory
+        if kind == UNDO_SIDE:
+            return bool(self.watch_registers) or where in self.watch_memory
+        return False
+
+    # runs forward until a breakpoint pc is reached, a watched location is written, the
+    # machine halts or max_steps were run. Returns the reason.
+    def cont(self, max_steps=None):
+        m = self.m
+        end = m.steps + max_steps if max_steps is not None else None
+        while end is None or m.steps < end:
+            if not self.step():
+                return 'halt'
+            i = (m.steps - 1) % self.capacity
+            if self.watched(self.kinds[i], self.wheres[i]):
+                return 'watchpoint'
+            if m.pc in self.breakpoints:
+                return 'breakpoint'
+        return 'step_limit'
+
+    # runs backwards until a breakpoint pc is reached, the step that wrote a watched location
+    # has been undone, or the start of the history
+    def reverse_cont(self):
+        m = self.m
+        while True:
+            undone = self.undo()
+            if undone is None:
+                return 'start'
+            if self.watched(*undone):
+                return 'watchpoint'
+            if m.pc in self.breakpoints:
+                return 'breakpoint'
+
+
+# a small command loop: s [n], b [n], c, rc, goto N, break PC, watch xN|ADDR, regs, mem ADDR, q
+def main(argv=None):
+    import argparse
+    from tracing import abi, disassemble
+    parser = argparse.ArgumentParser(description="Step a program forwards and backwards")
+    parser.add_argument('program', help="assembled program or program image")
+    parser.add_argument('--capacity', type=int, default=DEFAULT_CAPACITY, help="undo records kept")
+    parser.add_argument('--keyframe-interval', type=int, default=DEFAULT_KEYFRAME_INTERVAL, help="steps between full state copies")
+    args = parser.parse_args(argv)
+
+    m = machine.Machine(machine.read_program(args.program))
+    tt = TimeTravel(m, args.capacity, args.keyframe_interval)
+    def where():
+        text = disassemble(m.code[m.pc]) if m.pc in m.program_memory else "(outside the program)"
+        print(f"step {m.steps} pc 0x{m.pc:08x}: {text}" + (" [halted]" if m.halted else ""))
+    where()
+    for line in sys.stdin:
+        cmd, *rest = line.split() or ['']
+        try:
+            if cmd in ('s', 'step'):
+                for i in range(int(rest[0]) if rest else 1):
+                    tt.step()
+            elif cmd in ('b', 'back'):
+                tt.step_back(int(rest[0]) if rest else 1)
+            elif cmd in ('c', 'continue'):
+                print(tt.cont())
+            elif cmd in ('rc', 'reverse-continue'):
+                print(tt.reverse_cont())
+            elif cmd == 'goto':
+                tt.goto(int(rest[0]))
+            elif cmd == 'break':
+                tt.breakpoints.add(int(rest[0], 0))
+            elif cmd == 'watch':
+                if rest[0].startswith('x'):
+                    tt.watch_registers.add(int(rest[0][1:]))
+                else:
+                    tt.watch_memory.add(int(rest[0], 0))
+            elif cmd == 'regs':
+                print(" ".join(f"{abi(i)}={to_signed(r)}" for i, r in enumerate(m.regs)))
+            elif cmd == 'mem':
+                print(m.load_word(int(rest[0], 0)))
+            elif cmd in ('q', 'quit'):
+                break
+            elif cmd:
+                print(f"unknown command '{cmd}'")
+        except Exception as e:
+            print(f"{type(e).__name__}: {e}")
+        where()
+
+if __name__ == "__main__":
+    main()
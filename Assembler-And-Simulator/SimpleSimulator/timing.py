@@ -0,0 +1,293 @@
+import json
+from alu import to_signed
+
+# Timing model for machine.py: a classic 5 stage in-order pipeline (IF ID EX MEM WB) with
+# a branch predictor and L1 instruction and data caches. It does not change what a program
+# computes, Timing.run is a copy of Machine.run that also works out in which cycle every
+# instruction leaves ID:
+#
+# - a source register can be read once its producer is far enough ahead: the next cycle
+#   with forwarding (a load one more, the load-use stall), after the producer's WB
+#   without it. mul keeps EX busy for mul_cycles.
+# - branches are predicted in ID and resolved in EX. A misprediction costs
+#   branch_penalty cycles, a branch predicted taken (its target is computed in ID) and a
+#   jal cost taken_penalty, a jalr is always resolved in EX and costs branch_penalty.
+# - every fetch goes through the instruction cache and every lw/sw through the data
+#   cache, a miss holds the pipeline for miss_penalty cycles. The caches allocate on
+#   writes as well and only the tags are modelled.
+#
+# cycles = instructions + 4 (filling the pipeline) + stalls, the report splits the stalls
+# by cause.
+
+BRANCHES = {'beq', 'bne', 'blt', 'bge', 'bltu', 'bgeu'}
+PREDICTORS = ('static', '2bit', 'gshare')
+
+# sizes in bytes, ways per set, penalties in cycles. predictor_bits is the log2 of the
+# number of 2 bit counters, history_bits the global history length of gshare.
+DEFAULT_TIMING = {
+    'predictor': '2bit', 'predictor_bits': 10, 'history_bits': 8,
+    'forwarding': 1, 'mul_cycles': 3,
+    'branch_penalty': 2, 'taken_penalty': 1, 'miss_penalty': 20,
+    'icache_size': 4096, 'icache_ways': 2, 'icache_line': 32,
+    'dcache_size': 4096, 'dcache_ways': 4, 'dcache_line': 32,
+}
+
+STALLS = ('load_use', 'data', 'mul', 'branch_mispredict', 'taken_branch', 'jump', 'icache_miss', 'dcache_miss')
+
+# reads a timing configuration from a JSON file or from 'name=value,...', on top of DEFAULT_TIMING
+def parse_timing(spec):
+    config = dict(DEFAULT_TIMING)
+    if spec.endswith('.json'):
+        with open(spec) as f:
+            config.update(json.load(f))
+    else:
+        for part in spec.split(','):
+            name, value = part.split('=')
+            name, value = name.strip(), value.strip()
+            config[name] = value if name == 'predictor' else int(value, 0)
+    unknown = set(config) - set(DEFAULT_TIMING)
+    if unknown:
+        raise ValueError(f"unknown timing settings: {', '.join(sorted(unknown))}")
+    if config['predictor'] not in PREDICTORS:
+        raise ValueError(f"unknown predictor '{config['predictor']}', expected one of {', '.join(PREDICTORS)}")
+    return config
+
+
+# set associative cache with LRU replacement, every set is a list of tags with the most
+# recently used one last
+class Cache:
+    def __init__(self, size, ways, line):
+        if line <= 0 or line & (line - 1) or ways <= 0 or size % (line * ways):
+            raise ValueError(f"bad cache geometry: {size} bytes, {ways} ways, {line} byte lines")
+        self.size = size
+        self.ways = ways
+        self.line = line
+        self.line_shift = line.bit_length() - 1
+        self.set_count = size // (line * ways)
+        self.sets = [[] for i in range(self.set_count)]
+        self.accesses = 0
+        self.misses = 0
+
+    # True on a hit
+    def access(self, addr):
+        self.accesses += 1
+        block = addr >> self.line_shift
+        tags = self.sets[block % self.set_count]
+        if block in tags:
+            if tags[-1] != block:
+                tags.remove(block)
+                tags.append(block)
+            return True
+        self.misses += 1
+        tags.append(block)
+        if len(tags) > self.ways:
+            del tags[0]
+        return False
+
+    def describe(self):
+        return f"{self.size} bytes, {self.ways} way, {self.line} byte lines"
+
+
+# backward taken, forward not taken
+class StaticPredictor:
+    def predict(self, pc, imm):
+        return imm < 0
+
+    def update(self, pc, taken):
+        pass
+
+# a 2 bit saturating counter per pc (modulo the table size), starting weakly not taken
+class TwoBitPredictor:
+    def __init__(self, bits):
+        self.mask = (1 << bits) - 1
+        self.counters = bytearray([1]) * (1 << bits)
+
+    def index(self, pc):
+        return (pc >> 2) & self.mask
+
+    def predict(self, pc, imm):
+        return self.counters[self.index(pc)] >= 2
+
+    def update(self, pc, taken):
+        i = self.index(pc)
+        counter = self.counters[i]
+        if taken:
+            if counter < 3:
+                self.counters[i] = counter + 1
+        elif counter > 0:
+            self.counters[i] = counter - 1
+
+# 2 bit counters indexed by the pc xor the global history of branch outcomes
+class GsharePredictor(TwoBitPredictor):
+    def __init__(self, bits, history_bits):
+        super().__init__(bits)
+        self.history = 0
+        self.history_mask = (1 << history_bits) - 1
+
+    def index(self, pc):
+        return ((pc >> 2) ^ self.history) & self.mask
+
+    def update(self, pc, taken):
+        super().update(pc, taken)
+        self.history = ((self.history << 1) | taken) & self.history_mask
+
+def make_predictor(config):
+    if config['predictor'] == 'static':
+        return StaticPredictor()
+    if config['predictor'] == '2bit':
+        return TwoBitPredictor(config['predictor_bits'])
+    return GsharePredictor(config['predictor_bits'], config['history_bits'])
+
+
+class Timing:
+    def __init__(self, machine, config=DEFAULT_TIMING):
+        self.m = machine
+        self.config = config
+        self.predictor = make_predictor(config)
+        self.icache = Cache(config['icache_size'], config['icache_ways'], config['icache_line'])
+        self.dcache = Cache(config['dcache_size'], config['dcache_ways'], config['dcache_line'])
+        self.instructions = 0
+        self.branches = 0
+        self.mispredicted = 0
+        self.stalls = dict.fromkeys(STALLS, 0)
+        # cycle the last instruction left ID (the first one leaves in cycle 1) and the
+        # earliest cycle the next one can
+        self.issued = 0
+        self.next_issue = 1
+        # per register: first cycle a reader can leave ID, and the stall it is charged to
+        self.ready = [0] * 32
+        self.ready_kind = ['data'] * 32
+        self.ex_free = 0
+
+    def cycles(self):
+        return self.issued + 4 if self.instructions else 0
+
+    # Machine.run with the timing model, see there
+    def run(self, on_step=None, max_steps=None):
+        m = self.m
+        code = m.code
+        regs = m.regs
+        config = self.config
+        forwarding = config['forwarding']
+        mul_cycles = config['mul_cycles']
+        branch_penalty = config['branch_penalty']
+        taken_penalty = config['taken_penalty']
+        miss_penalty = config['miss_penalty']
+        icache = self.icache
+        dcache = self.dcache
+        predictor = self.predictor
+        stalls = self.stalls
+        ready = self.ready
+        ready_kind = self.ready_kind
+        pc = m.pc
+        steps = m.steps
+        limit = steps + max_steps if max_steps is not None else 1 << 62
+        try:
+            while not m.halted and steps < limit:
+                handler, rd, rs1, rs2, imm, name, word = code[pc]
+                fetched = pc
+                issue = self.next_issue
+                if not icache.access(pc):
+                    issue += miss_penalty
+                    stalls['icache_miss'] += miss_penalty
+                # registers that are not read are 0 in the decoded record, x0 is always ready
+                wait = max(ready[rs1], ready[rs2])
+                if wait > issue:
+                    stalls[ready_kind[rs1] if ready[rs1] >= ready[rs2] else ready_kind[rs2]] += wait - issue
+                    issue = wait
+                if self.ex_free > issue:
+                    stalls['mul'] += self.ex_free - issue
+                    issue = self.ex_free
+                addr = to_signed(regs[rs1]) + imm if name == 'lw' or name == 'sw' else None
+
+                pc = handler(m, regs, pc, rd, rs1, rs2, imm)
+                regs[0] = 0
+                steps += 1
+
+                next_issue = issue + 1
+                result = issue + 1 if forwarding else issue + 3
+                kind = 'data'
+                if addr is not None and not dcache.access(addr):
+                    next_issue += miss_penalty
+                    stalls['dcache_miss'] += miss_penalty
+                    result += miss_penalty
+                if name == 'lw':
+                    if forwarding:
+                        result += 1
+                        kind = 'load_use'
+                elif name == 'mul':
+                    self.ex_free = issue + mul_cycles
+                    result = max(result, issue + mul_cycles)
+                    kind = 'mul'
+                elif name in BRANCHES:
+                    taken = pc != fetched + 4
+                    predicted = predictor.predict(fetched, imm)
+                    predictor.update(fetched, taken)
+                    self.branches += 1
+                    if predicted != taken:
+                        self.mispredicted += 1
+                        next_issue += branch_penalty
+                        stalls['branch_mispredict'] += branch_penalty
+                    elif taken:
+                        next_issue += taken_penalty
+                        stalls['taken_branch'] += taken_penalty
+                elif name == 'jal':
+                    next_issue += taken_penalty
+                    stalls['jump'] += taken_penalty
+                elif name == 'jalr':
+                    next_issue += branch_penalty
+                    stalls['jump'] += branch_penalty
+                if rd:
+                    ready[rd] = result
+                    ready_kind[rd] = kind
+                self.issued = issue
+                self.next_issue = next_issue
+                self.instructions += 1
+                if on_step is not None:
+                    m.pc = pc
+                    m.steps = steps
+                    on_step(m, fetched)
+        finally:
+            m.pc = pc
+            m.steps = steps
+
+    def stats(self):
+        cycles = self.cycles()
+        return {
+            'instructions': self.instructions,
+            'cycles': cycles,
+            'cpi': cycles / self.instructions if self.instructions else 0,
+            'stalls': dict(self.stalls),
+            'branches': self.branches,
+            'mispredicted': self.mispredicted,
+            'icache': {'accesses': self.icache.accesses, 'misses': self.icache.misses},
+            'dcache': {'accesses': self.dcache.accesses, 'misses': self.dcache.misses},
+            'config': dict(self.config),
+        }
+
+    def report(self):
+        cycles = self.cycles()
+        lines = [f"instructions {self.instructions}, cycles {cycles}, CPI {cycles / self.instructions if self.instructions else 0:.3f}", ""]
+        stalled = sum(self.stalls.values())
+        lines.append(f"stalls {stalled} cycles")
+        for name in STALLS:
+            count = self.stalls[name]
+            lines.append(f"  {name:<18} {count:>12} {100 * count / cycles if cycles else 0:6.2f}% of cycles")
+
+        lines += ["", f"branches ({self.config['predictor']} predictor)"]
+        rate = 100 * self.mispredicted / self.branches if self.branches else 0
+        lines.append(f"  {self.branches} branches, {self.mispredicted} mispredicted ({rate:.2f}%)")
+
+        lines += ["", "caches"]
+        for name, cache in (('icache', self.icache), ('dcache', self.dcache)):
+            rate = 100 * cache.misses / cache.accesses if cache.accesses else 0
+            lines.append(f"  {name} ({cache.describe()}): {cache.accesses} accesses, {cache.misses} misses ({rate:.2f}%)")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump(self.stats(), f, indent=2)
+                f.write("\n")
+            else:
+                f.write(self.report())
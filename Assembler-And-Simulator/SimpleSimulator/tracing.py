@@ -0,0 +1,132 @@
+# Trace levels shared by both engines:
+#   none    - nothing is written
+#   final   - only the last register line and the memory dump
+#   regs    - a register line after every instruction plus the memory dump (the usual output)
+#   verbose - regs, and every executed instruction is disassembled to stdout
+TRACE_NONE = 0
+TRACE_FINAL = 1
+TRACE_REGS = 2
+TRACE_VERBOSE = 3
+
+TRACE_LEVELS = {'none': TRACE_NONE, 'final': TRACE_FINAL, 'regs': TRACE_REGS, 'verbose': TRACE_VERBOSE}
+
+abi_names = None
+
+# ABI names by register number, only built once verbose output is requested
+def abi(i):
+    global abi_names
+    if abi_names is None:
+        import reversesim
+        abi_names = reversesim.register_names
+    return abi_names[i]
+
+def signed(value):
+    return value - 0x100000000 if value & 0x80000000 else value
+
+# assembly text of a decoded instruction
+def disassemble(rec):
+    handler, rd, rs1, rs2, imm, name, word = rec
+    if name in ('add', 'sub', 'sll', 'slt', 'sltu', 'xor', 'srl', 'or', 'and', 'mul'):
+        return f"{name} {abi(rd)}, {abi(rs1)}, {abi(rs2)}"
+    if name in ('addi', 'sltiu', 'jalr'):
+        return f"{name} {abi(rd)}, {abi(rs1)}, {imm}"
+    if name == 'lw':
+        return f"lw {abi(rd)}, {imm}({abi(rs1)})"
+    if name == 'sw':
+        return f"sw {abi(rs2)}, {imm}({abi(rs1)})"
+    if name in ('beq', 'bne', 'blt', 'bge', 'bltu', 'bgeu'):
+        return f"{name} {abi(rs1)}, {abi(rs2)}, {imm}"
+    if name in ('lui', 'auipc', 'jal'):
+        return f"{name} {abi(rd)}, {imm}"
+    if name == 'rvrs':
+        return f"rvrs {abi(rd)}, {abi(rs1)}"
+    return name
+
+# one line of verbose output for the instruction that was just executed at pc
+def describe(step, pc, rec, regs):
+    handler, rd, rs1, rs2, imm, name, word = rec
+    text = disassemble(rec)
+    if name == 'sw':
+        text += f" = {signed(regs[rs2])}"
+    if rd and name not in ('sw', 'beq', 'bne', 'blt', 'bge', 'bltu', 'bgeu'):
+        text += f" -> {abi(rd)}(x{rd}: {signed(regs[rd])})"
+    return f"#{step:02d} {pc:02d}: {text}"
+
+DEFAULT_FLUSH_SIZE = 1 << 20
+
+# Streaming sink for the text trace. Lines are buffered and written to out_file every
+# flush_size characters, so memory stays flat however long the run is and everything up to
+# the last flush is on disk if the run is killed. compress is None, 'gzip' or 'zstd', by
+# default it is picked from the file name (.gz / .zst).
+# With offset (a value of tell() from an earlier run) an uncompressed trace is cut back to
+# that point and continued, which is how a run resumed from a snapshot picks up its trace.
+# path can also be an open text file (io.StringIO for a trace kept in memory), which is
+# written uncompressed and left open by close().
+class TraceWriter:
+    def __init__(self, path, flush_size=DEFAULT_FLUSH_SIZE, compress=None, offset=None):
+        self.owns_file = isinstance(path, str)
+        if compress is None and self.owns_file:
+            compress = 'gzip' if path.endswith('.gz') else 'zstd' if path.endswith('.zst') else None
+        if offset is not None and compress is not None:
+            raise ValueError("only uncompressed traces can be continued")
+        if not self.owns_file:
+            if compress is not None or offset is not None:
+                raise ValueError("compressed and continued traces need a file name")
+            self.f = path
+        elif compress == 'gzip':
+            import gzip
+            self.f = gzip.open(path, 'wt')
+        elif compress == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError("zstd compressed traces need the 'zstandard' package") from None
+            import io
+            self.f = io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(path, 'wb')))
+        elif compress is None:
+            self.f = open(path, 'w' if offset is None else 'r+')
+            if offset is not None:
+                self.f.seek(offset)
+                self.f.truncate()
+        else:
+            raise ValueError(f"Unknown trace compression '{compress}'")
+        self.compress = compress
+        self.flush_size = flush_size
+        self.buffer = []
+        self.size = 0
+        self.closed = False
+
+    def write(self, line):
+        self.buffer.append(line)
+        self.size += len(line)
+        if self.size >= self.flush_size:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self.f.write("".join(self.buffer))
+        self.buffer = []
+        self.size = 0
+
+    # position in the file after everything written so far, flushes first
+    def tell(self):
+        if self.compress is not None:
+            raise ValueError("compressed traces have no resumable position")
+        self.flush()
+        return self.f.tell()
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            if self.owns_file:
+                self.f.close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,188 @@
+from alu import to_signed, reverse_bits
+
+# Basic-block translation. Starting at an entry pc, straight-line instructions are collected
+# up to (and including) the next branch, jal or jalr, turned into Python source and compiled
+# once into a function that runs the whole block. Registers used by the block are kept in
+# locals and written back in a finally clause, so a fault in the middle of a block still
+# leaves the machine in the state the interpreter would have left it in.
+# Blocks are cached by entry pc and dropped whenever the program memory they cover changes.
+# A machine has one translator (translator_for), its blocks and its hook on code writes
+# last from one run to the next.
+
+MAX_BLOCK_LENGTH = 64
+
+TERMINATORS = {'beq', 'bne', 'blt', 'bge', 'bltu', 'bgeu', 'jal', 'jalr'}
+
+def reg(i):
+    return '0' if i == 0 else f'r{i}'
+
+# source lines for the body of one instruction, rd == 0 writes are dropped
+def emit(rec, pc, self_modifying):
+    handler, rd, rs1, rs2, imm, name, word = rec
+    a, b, d = reg(rs1), reg(rs2), f'r{rd}'
+    if name in ('add', 'sub', 'sll', 'slt', 'sltu', 'xor', 'srl', 'or', 'and', 'mul',
+                'addi', 'sltiu', 'lui', 'auipc', 'rvrs') and rd == 0:
+        return []
+    if name == 'add': return [f'{d} = ({a} + {b}) & 0xFFFFFFFF']
+    if name == 'sub': return [f'{d} = ({a} - {b}) & 0xFFFFFFFF']
+    if name == 'sll': return [f'{d} = ({a} << ({b} & 31)) & 0xFFFFFFFF']
+    if name == 'slt': return [f'{d} = 1 if {a} ^ 0x80000000 < {b} ^ 0x80000000 else 0']
+    if name == 'sltu': return [f'{d} = 1 if {a} < {b} else 0']
+    if name == 'xor': return [f'{d} = {a} ^ {b}']
+    if name == 'srl': return [f'{d} = {a} >> ({b} & 31)']
+    if name == 'or': return [f'{d} = {a} | {b}']
+    if name == 'and': return [f'{d} = {a} & {b}']
+    if name == 'mul': return [f'{d} = ({a} * {b}) & 0xFFFFFFFF']
+    if name == 'addi': return [f'{d} = ({a} + {imm}) & 0xFFFFFFFF']
+    if name == 'sltiu': return [f'{d} = 1 if {a} < {imm} else 0']
+    if name == 'lui': return [f'{d} = {imm}']
+    if name == 'auipc': return [f'{d} = {(pc + imm) & 0xFFFFFFFF}']
+    if name == 'rvrs': return [f'{d} = reverse_bits({a})']
+    if name == 'lw':
+        load = f'm.load_word(to_signed({a}) + {imm})'
+        return [f'm.pc = {pc}', f'{d} = {load}' if rd else load]
+    if name == 'sw':
+        lines = [f'm.pc = {pc}', f'm.store_word(to_signed({a}) + {imm}, {b})']
+        if self_modifying: # the store may have rewritten this block
+            lines.append(f'return {pc + 4}')
+        return lines
+    if name == 'jal':
+        return ([f'{d} = {(pc + 4) & 0xFFFFFFFF}'] if rd else []) + [f'return {pc + imm}']
+    if name == 'jalr':
+        return ([f'target = to_signed({a}) + {imm}'] + ([f'{d} = {(pc + 4) & 0xFFFFFFFF}'] if rd else [])
+                + ['return target'])
+    if name in ('beq', 'bne', 'bltu', 'bgeu'):
+        op = {'beq': '==', 'bne': '!=', 'bltu': '<', 'bgeu': '>='}[name]
+        return [f'return {pc + imm} if {a} {op} {b} else {pc + 4}']
+    if name in ('blt', 'bge'):
+        op = '<' if name == 'blt' else '>='
+        return [f'return {pc + imm} if {a} ^ 0x80000000 {op} {b} ^ 0x80000000 else {pc + 4}']
+    return None # no template, left to the interpreter
+
+
+# the translator of a machine, created by its first jit run
+def translator_for(m):
+    t = m.translator
+    if t is None:
+        t = m.translator = Translator(m)
+    elif t.self_modifying != m.self_modifying: # the blocks were translated for the other mode
+        t.cache.clear()
+        t.covering.clear()
+        t.self_modifying = m.self_modifying
+    return t
+
+# number of instructions of a block that completed before the exception with traceback tb
+# was raised inside it: the line it was raised from belongs to the first one that did not
+def completed(fn, tb):
+    while tb is not None:
+        if tb.tb_frame.f_code is fn.__code__:
+            return fn.instruction_at.get(tb.tb_lineno, 0)
+        tb = tb.tb_next
+    return 0 # raised before the block started
+
+
+class Translator:
+    def __init__(self, machine):
+        self.m = machine
+        self.self_modifying = machine.self_modifying
+        # entry pc -> (function, instruction count), function is None for pcs that are interpreted
+        self.cache = {}
+        # pc -> entry pcs of the blocks that contain it
+        self.covering = {}
+        machine.code_write_hooks.append(self.invalidate)
+
+    def invalidate(self, addr):
+        self.cache.pop(addr, None)
+        for entry in self.covering.pop(addr, ()):
+            self.cache.pop(entry, None)
+
+    def translate(self, entry):
+        code = self.m.code
+        self_modifying = self.m.self_modifying
+        body = []
+        # index into body -> number of the instruction the line belongs to
+        owners = []
+        used, written = set(), set()
+        pc = entry
+        count = 0
+        terminated = False
+        while count < MAX_BLOCK_LENGTH and pc in self.m.program_memory:
+            rec = code[pc]
+            lines = emit(rec, pc, self_modifying)
+            if lines is None:
+                break
+            body.extend(lines)
+            owners += [count] * len(lines)
+            count += 1
+            if rec.name in TERMINATORS or (self_modifying and rec.name == 'sw'):
+                terminated = True
+            for i in (rec.rs1, rec.rs2):
+                if i: used.add(i)
+            if rec.rd and rec.name not in ('sw', 'beq', 'bne', 'blt', 'bge', 'bltu', 'bgeu'):
+                used.add(rec.rd)
+                written.add(rec.rd)
+            pc += 4
+            if terminated:
+                break
+        if count == 0:
+            code[entry] # KeyError once the pc leaves the program, like the interpreter
+            return None, 0
+        if not terminated:
+            body.append(f'return {pc}')
+            owners.append(count)
+
+        src = ['def block(m, regs):']
+        src += [f'    r{i} = regs[{i}]' for i in sorted(used)]
+        if written:
+            src.append('    try:')
+        first_line = len(src) + 1 # source lines are numbered from 1
+        src += [('        ' if written else '    ') + line for line in body]
+        if written:
+            src.append('    finally:')
+            src += [f'        regs[{i}] = r{i}' for i in sorted(written)]
+        namespace = {'to_signed': to_signed, 'reverse_bits': reverse_bits}
+        exec(compile('\n'.join(src) + '\n', f'<block {entry}>', 'exec'), namespace)
+        # line number -> instruction, for completed()
+        namespace['block'].instruction_at = {first_line + i: owner for i, owner in enumerate(owners)}
+
+        for covered in range(entry, entry + 4 * count, 4):
+            self.covering.setdefault(covered, []).append(entry)
+        return namespace['block'], count
+
+    # runs the machine until a halt, a whole block per dispatch. With max_steps it stops at the
+    # first block boundary at or after that many instructions.
+    def run(self, max_steps=None):
+        m = self.m
+        cache = self.cache
+        code = m.code
+        regs = m.regs
+        pc = m.pc
+        steps = m.steps
+        limit = steps + max_steps if max_steps is not None else 1 << 62
+        in_block = False
+        try:
+            while not m.halted and steps < limit:
+                entry = cache.get(pc)
+                if entry is None:
+                    entry = cache[pc] = self.translate(pc)
+                fn, count = entry
+                if fn is None:
+                    handler, rd, rs1, rs2, imm, name, word = code[pc]
+                    pc = handler(m, regs, pc, rd, rs1, rs2, imm)
+                    regs[0] = 0
+                    steps += 1
+                else:
+                    in_block = True
+                    start = pc
+                    pc = fn(m, regs)
+                    in_block = False
+                    steps += count
+        except BaseException as e:
+            if in_block: # a fault or an interrupt part way through the block
+                done = completed(fn, e.__traceback__)
+                steps += done
+                pc = start + 4 * done
+            raise
+        finally:
+            m.pc = pc
+            m.steps = steps
@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import time
+import bisect
+import random
+import platform
+import argparse
+
+# Round trip fuzzing and benchmarks for the assembler, disassembler and simulators.
+#
+#   python3 harness.py fuzz [--programs N] [--length N] [--seed S]
+#       random programs over every instruction (labels, bonus instructions and all
+#       immediate ranges included) are assembled, disassembled with reversesim and
+#       assembled again, the words of both assemblies have to be the same
+#   python3 harness.py bench [--save FILE] [--baseline FILE]
+#       times assembly, disassembly and simulation on fixed workloads, the results are
+#       JSON so the numbers of two versions can be compared: every rate more than
+#       --threshold below the baseline is reported and makes the exit status 1
+#
+# tests/ runs the round trip and the engine comparisons with fixed seeds under pytest.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+for directory in ('SimpleAssembler', 'SimpleSimulator'):
+    if os.path.join(HERE, directory) not in sys.path:
+        sys.path.insert(0, os.path.join(HERE, directory))
+
+import encoder
+import Assembler
+import reversesim
+
+REGISTERS = list(encoder.registers)
+VIRTUAL_HALT = "beq zero,zero,0"
+
+# branch targets are labels at most this many instructions away, within the range of a
+# branch immediate however long the program is
+LABEL_DISTANCE = 4000
+
+# a random source line, a label operand is picked by near_label()
+def random_instruction(rng, near_label):
+    kind = rng.choice(['R', 'I', 'S', 'B', 'U', 'J', 'bonus'])
+    reg = lambda: rng.choice(REGISTERS)
+    if kind == 'bonus':
+        name = rng.choice(['rst', 'halt', 'rvrs'])
+        return f"rvrs {reg()},{reg()}" if name == 'rvrs' else name
+    name = rng.choice(encoder.types[kind])
+    if kind == 'R':
+        return f"{name} {reg()},{reg()},{reg()}"
+    if kind == 'I':
+        imm = rng.randint(-2048, 2047)
+        return f"lw {reg()},{imm}({reg()})" if name == 'lw' else f"{name} {reg()},{reg()},{imm}"
+    if kind == 'S':
+        return f"sw {reg()},{rng.randint(-2048, 2047)}({reg()})"
+    if kind == 'U':
+        return f"{name} {reg()},{rng.randint(-(1 << 31), (1 << 31) - 1)}"
+    # branches and jumps take a label or any immediate the assembler accepts
+    label = near_label() if rng.random() < 0.5 else None
+    if kind == 'B':
+        return f"{name} {reg()},{reg()},{label or rng.randint(-(1 << 15), (1 << 15) - 1)}"
+    return f"jal {reg()},{label or rng.randint(-(1 << 20), (1 << 20) - 1)}"
+
+# source text of a random program of `length` instructions ending in the virtual halt
+def random_program(rng, length):
+    places = sorted(rng.sample(range(length), rng.randint(0, max(1, length // 8))))
+    labels = {place: f"L{n}" for n, place in enumerate(places)}
+    lines = []
+    for i in range(length):
+        def near_label():
+            n = bisect.bisect_left(places, i + rng.randint(-LABEL_DISTANCE, 0))
+            return labels[places[n]] if n < len(places) and places[n] - i <= LABEL_DISTANCE else None
+        line = random_instruction(rng, near_label)
+        lines.append(labels[i] + ": " + line if i in labels else line)
+    lines.append(VIRTUAL_HALT)
+    return "\n".join(lines) + "\n"
+
+def assemble(text):
+    result = Assembler.Assembler().assemble(text)
+    if result.diagnostics:
+        error = result.diagnostics[0]
+        raise ValueError(f"line {error.line}: {error.message}")
+    return result.words
+
+# assembles, disassembles and reassembles one program, returns None or what went wrong
+def round_trip(text):
+    try:
+        words = assemble(text)
+    except ValueError as e:
+        return f"the generated program does not assemble: {e}"
+    listing = reversesim.reverse_assembler(encoder.to_text(words).replace("\n", ""))
+    try:
+        again = assemble("\n".join(listing))
+    except ValueError as e:
+        return f"the disassembly does not assemble: {e}"
+    for i, (a, b) in enumerate(zip(words, again)):
+        if a != b:
+            return f"word {i} 0x{a:08x} came back as 0x{b:08x} (disassembled as '{listing[i]}')"
+    if len(words) != len(again):
+        return f"{len(words)} words came back as {len(again)}"
+    return None
+
+def fuzz(args):
+    seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+    print(f"seed {seed}")
+    for n in range(args.programs):
+        rng = random.Random(seed + n)
+        text = random_program(rng, rng.randint(1, args.length))
+        problem = round_trip(text)
+        if problem is not None:
+            with open(args.failure, 'w') as f:
+                f.write(text)
+            print(f"program {n} (seed {seed + n}): {problem}, source written to {args.failure}")
+            return 1
+    print(f"{args.programs} programs round tripped")
+    return 0
+
+
+# fixed simulation workload: a loop with a call, arithmetic, mul, memory traffic and
+# branches that runs 17 instructions per iteration
+LOOP_PROGRAM = """addi s0,zero,0
+lui s1,{upper}
+addi s1,s1,{lower}
+lui t0,65536
+addi s2,zero,3
+loop: mul t1,s0,s2
+add t2,t2,t1
+sw t2,0(t0)
+lw t3,0(t0)
+xor t4,t3,s0
+srl t5,t4,s2
+sltu t6,t5,t4
+or a0,a0,t6
+jal ra,work
+bne t6,zero,skip
+addi a1,a1,1
+skip: addi s0,s0,1
+blt s0,s1,loop
+beq zero,zero,0
+work: sub a2,a2,s0
+and a3,a2,t4
+sll a4,a3,s2
+sltiu a5,a4,100
+jalr zero,ra,0
+"""
+
+def loop_program(iterations):
+    upper = (iterations + 0x800) & ~0xFFF
+    return assemble(LOOP_PROGRAM.format(upper=upper, lower=iterations - upper))
+
+def best(repeat, fn):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def bench_assemble(repeat):
+    text = random_program(random.Random(1), 20000)
+    lines = text.count("\n")
+    return lines / best(repeat, lambda: assemble(text)), 'lines/s'
+
+def bench_disassemble(repeat):
+    words = assemble(random_program(random.Random(2), 20000)) * 10
+    return len(words) / best(repeat, lambda: reversesim.disassemble(words)), 'words/s'
+
+def bench_string_engine(repeat):
+    import Simulator
+    lines = encoder.to_text(loop_program(5000)).split("\n")
+    def run():
+        Simulator.load_program(lines)
+        while Simulator.step():
+            pass
+    elapsed = best(repeat, run)
+    return Simulator.step_count / elapsed, 'inst/s'
+
+def bench_machine(repeat, jit=False):
+    import machine
+    program = machine.parse_program(encoder.to_text(loop_program(50000)).split("\n"))
+    steps = []
+    def run():
+        m = machine.Machine(program)
+        machine.run_until(m, jit=jit)
+        steps.append(m.steps)
+    elapsed = best(repeat, run)
+    return steps[-1] / elapsed, 'inst/s'
+
+BENCHMARKS = {
+    'assemble': bench_assemble,
+    'disassemble': bench_disassemble,
+    'simulate_string': bench_string_engine,
+    'simulate_int': bench_machine,
+    'simulate_jit': lambda repeat: bench_machine(repeat, jit=True),
+}
+
+def commit():
+    import subprocess
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# prints old/new for every rate, returns the names that got slower than threshold allows
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, entry in results['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        change = entry['rate'] / old['rate'] - 1
+        slower = change < -threshold
+        if slower:
+            regressions.append(name)
+        print(f"  {name:<16} {old['rate']:>14,.0f} -> {entry['rate']:>14,.0f} {entry['unit']:<8} {100 * change:+7.1f}%"
+              + ("  REGRESSION" if slower else ""))
+    return regressions
+
+def bench(args):
+    names = args.only or list(BENCHMARKS)
+    results = {
+        'commit': commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'numpy': reversesim.np is not None,
+        'results': {},
+    }
+    for name in names:
+        rate, unit = BENCHMARKS[name](args.repeat)
+        results['results'][name] = {'rate': rate, 'unit': unit}
+        print(f"  {name:<16} {rate:>14,.0f} {unit}")
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"against {args.baseline} (commit {baseline.get('commit')})")
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Round trip fuzzing and benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('fuzz', help="assemble -> disassemble -> assemble random programs")
+    p.add_argument('--programs', type=int, default=500, help="programs to generate")
+    p.add_argument('--length', type=int, default=200, help="most instructions per program")
+    p.add_argument('--seed', type=int, help="seed of the first program (default: random)")
+    p.add_argument('--failure', default='fuzz_failure.s', help="where the source of a failing program is written")
+    p = commands.add_parser('bench', help="time assembly, disassembly and simulation")
+    p.add_argument('--repeat', type=int, default=3, help="runs per benchmark, the fastest counts")
+    p.add_argument('--only', nargs='+', choices=BENCHMARKS, help="run only these benchmarks")
+    p.add_argument('--save', metavar='FILE', help="write the results as JSON")
+    p.add_argument('--baseline', metavar='FILE', help="compare with results saved by an earlier version")
+    p.add_argument('--threshold', type=float, default=0.1, help="slowdown reported as a regression (default 0.1 = 10%%)")
+    args = parser.parse_args(argv)
+    return fuzz(args) if args.command == 'fuzz' else bench(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the modules are flat scripts in their directories, the same path setup as harness.py
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ('', 'SimpleAssembler', 'SimpleSimulator'):
+    if os.path.join(ROOT, directory) not in sys.path:
+        sys.path.insert(0, os.path.join(ROOT, directory))
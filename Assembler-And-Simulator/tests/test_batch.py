@@ -0,0 +1,33 @@
+import os
+import time
+import batch
+import machine
+
+HALT = "00000000000000000000000001100011\n"
+
+def test_time_limit_kills_a_job_that_overruns(monkeypatch, tmp_path):
+    for name in ('a.txt', 'hangs.txt', 'z.txt'):
+        (tmp_path / name).write_text(HALT)
+    run_job = batch.run_job
+    # stuck where the machine never looks at the clock, the workers inherit the patch
+    def hang(program, *args):
+        if program.endswith('hangs.txt'):
+            time.sleep(60)
+        return run_job(program, *args)
+    monkeypatch.setattr(batch, 'run_job', hang)
+    monkeypatch.setattr(batch, 'KILL_GRACE', 0.2)
+    start = time.monotonic()
+    results = batch.run_batch(batch.load_jobs(str(tmp_path)), workers=1, max_seconds=0.1)
+    assert time.monotonic() - start < 10
+    # the killed worker is replaced for the job after it
+    assert [r['exit_reason'] for r in results] == [machine.EXIT_HALT, machine.EXIT_TIMEOUT, machine.EXIT_HALT]
+    assert results[1]['error'].startswith('killed after')
+
+def test_time_limit_reuses_its_workers(monkeypatch, tmp_path):
+    for i in range(6):
+        (tmp_path / f'{i}.txt').write_text(HALT)
+    run_job = batch.run_job
+    monkeypatch.setattr(batch, 'run_job', lambda *args: dict(run_job(*args), worker=os.getpid()))
+    results = batch.run_batch(batch.load_jobs(str(tmp_path)), workers=2, max_seconds=10)
+    assert all(r['exit_reason'] == machine.EXIT_HALT for r in results)
+    assert len({r['worker'] for r in results}) <= 2
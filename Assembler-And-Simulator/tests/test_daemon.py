@@ -0,0 +1,50 @@
+import os
+import stat
+import tempfile
+import threading
+import time
+import pytest
+import daemon
+import machine
+
+HALT = "00000000000000000000000001100011\n"
+
+def test_default_socket_is_in_a_private_directory(monkeypatch, tmp_path):
+    monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+    monkeypatch.setattr(tempfile, 'gettempdir', lambda: str(tmp_path))
+    path = daemon.default_socket()
+    directory = os.path.dirname(path)
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+    os.chmod(directory, 0o755)
+    with pytest.raises(RuntimeError):
+        daemon.default_socket()
+
+def test_socket_only_lets_in_its_owner(tmp_path):
+    path = str(tmp_path / 'simulator.sock')
+    with daemon.JobServer(path, daemon.JobHandler):
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+def test_job_past_its_deadline_is_killed(monkeypatch):
+    job_program = daemon.job_program
+    # stuck where the machine never looks at the clock, the workers inherit the patch
+    def hang(job):
+        time.sleep(60 if job['id'] == 'hangs' else job.get('sleep', 0))
+        return job_program(job)
+    monkeypatch.setattr(daemon, 'job_program', hang)
+    monkeypatch.setattr(daemon, 'KILL_GRACE', 0.3)
+    service = daemon.Service(workers=2, max_seconds=0.2)
+    try:
+        answers = {}
+        jobs = [{'id': 'hangs', 'binary': HALT}, {'id': 'slow', 'binary': HALT, 'sleep': 0.3}]
+        threads = [threading.Thread(target=lambda job=job: answers.update({job['id']: service.handle(job)})) for job in jobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        assert answers['hangs']['status'] == 'error' and answers['hangs']['exit_reason'] == machine.EXIT_TIMEOUT
+        # killed with the pool of the job that overran and run again
+        assert answers['slow']['status'] == 'ok'
+        assert service.handle({'id': 'after', 'binary': HALT})['exit_reason'] == machine.EXIT_HALT
+        assert service.handle({'op': 'stats'})['running'] == 0
+    finally:
+        service.shutdown()
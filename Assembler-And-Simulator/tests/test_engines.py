@@ -0,0 +1,119 @@
+import os
+import random
+import pytest
+import encoder
+import harness
+import machine
+import memory
+import cosim
+import snapshot
+import Simulator
+from tracing import TRACE_FINAL, TRACE_REGS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REGISTERS = [r for r in encoder.registers if r not in ('zero', 's11')]
+
+# a random program that always halts: arithmetic, words loaded from and stored to the first
+# 32 words of data memory (s11 holds their address, the string engine has no more) and forward branches and jumps
+def halting_program(rng, length):
+    lines = ["lui s11,65536"]
+    reg = lambda: rng.choice(REGISTERS)
+    for i in range(length):
+        kind = rng.choice(['R', 'R', 'I', 'U', 'lw', 'sw', 'B', 'J'])
+        label = f"L{rng.randint(i + 1, length)}"
+        if kind == 'R':
+            line = f"{rng.choice(encoder.types['R'])} {reg()},{reg()},{reg()}"
+        elif kind == 'I':
+            line = f"{rng.choice(['addi', 'sltiu'])} {reg()},{reg()},{rng.randint(-2048, 2047)}"
+        elif kind == 'U':
+            line = f"{rng.choice(encoder.types['U'])} {reg()},{rng.randint(-(1 << 31), (1 << 31) - 1)}"
+        elif kind == 'lw':
+            line = f"lw {reg()},{4 * rng.randint(0, 31)}(s11)"
+        elif kind == 'sw':
+            line = f"sw {reg()},{4 * rng.randint(0, 31)}(s11)"
+        elif kind == 'B':
+            line = f"{rng.choice(encoder.types['B'])} {reg()},{reg()},{label}"
+        else:
+            line = f"jal {reg()},{label}"
+        lines.append(f"L{i}: {line}")
+    lines.append(f"L{length}: beq zero,zero,0")
+    return encoder.to_text(harness.assemble("\n".join(lines))).splitlines()
+
+def loop_lines(iterations):
+    return encoder.to_text(harness.loop_program(iterations)).splitlines()
+
+def string_trace(lines, path, level=TRACE_REGS):
+    Simulator.simulate_lines(lines, str(path), level)
+    return path.read_text()
+
+def registers_only(trace):
+    return [line for line in trace.splitlines() if not line.startswith('0x')]
+
+def machine_trace(lines, path, level=TRACE_REGS, jit=False, paged=False):
+    m = machine.Machine(machine.parse_program(lines), memory.PagedMemory() if paged else None)
+    machine.simulate(m, str(path), level, jit)
+    assert m.exit_reason == machine.EXIT_HALT
+    return path.read_text()
+
+
+def test_string_engine_matches_reference_trace(tmp_path):
+    Simulator.simulate(os.path.join(ROOT, 'bin_bonus.txt'), str(tmp_path / 'out'))
+    with open(os.path.join(ROOT, 'trace_bonus.txt')) as f:
+        assert (tmp_path / 'out').read_text() == f.read()
+
+@pytest.mark.parametrize('paged', [False, True])
+def test_interpreter_matches_string_engine(tmp_path, paged):
+    with open(os.path.join(ROOT, 'bin_bonus.txt')) as f:
+        lines = f.readlines()
+    for program in (lines, loop_lines(40)):
+        trace = machine_trace(program, tmp_path / 'int', paged=paged)
+        expected = string_trace(program, tmp_path / 'ref')
+        if paged: # the memory dump only holds the allocated pages
+            trace, expected = registers_only(trace), registers_only(expected)
+        assert trace == expected
+
+def test_jit_matches_string_engine(tmp_path):
+    program = loop_lines(300)
+    assert machine_trace(program, tmp_path / 'jit', TRACE_FINAL, jit=True) == string_trace(program, tmp_path / 'ref', TRACE_FINAL)
+
+@pytest.mark.parametrize('jit', [False, True])
+@pytest.mark.parametrize('seed', range(8))
+def test_lockstep_random_programs(seed, jit):
+    rng = random.Random(seed)
+    result = cosim.Lockstep(halting_program(rng, 150), jit, 8 if jit else 1).run()
+    assert result.outcome == 'match', cosim.report(result)
+    assert result.end == 'halted'
+
+
+# periodic checkpoints without a callback (the --checkpoint-every default of a run that does
+# not write checkpoints) must not stop the run
+@pytest.mark.parametrize('jit', [False, True])
+def test_checkpoint_interval_without_callback(jit):
+    m = machine.Machine(machine.parse_program(loop_lines(200)))
+    machine.run_until(m, jit=jit, checkpoint_every=1000)
+    assert m.exit_reason == machine.EXIT_HALT, m.error
+
+def test_snapshot_resume_matches_uninterrupted_run(tmp_path):
+    program = machine.parse_program(loop_lines(100))
+    whole = machine.Machine(program)
+    machine.run_until(whole)
+
+    first = machine.Machine(program)
+    machine.run_until(first, max_steps=777)
+    snapshot.save(first, str(tmp_path / 'snap'))
+    resumed, offset = snapshot.load(str(tmp_path / 'snap'))
+    assert resumed.fingerprint() == first.fingerprint()
+    machine.run_until(resumed)
+    assert resumed.steps == whole.steps
+    assert resumed.fingerprint() == whole.fingerprint()
+
+# a pc of 2**31 or more (a jump past the signed range, or the text of an image placed that
+# high) has to survive a snapshot
+def test_snapshot_of_a_high_pc(tmp_path):
+    m = machine.Machine(machine.parse_program(loop_lines(10)))
+    machine.run_until(m, max_steps=50)
+    m.pc = 0xFFFFF000
+    snapshot.save(m, str(tmp_path / 'snap'))
+    resumed, offset = snapshot.load(str(tmp_path / 'snap'))
+    assert resumed.pc == 0xFFFFF000
+    assert resumed.fingerprint() == m.fingerprint()
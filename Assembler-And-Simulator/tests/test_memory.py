@@ -0,0 +1,44 @@
+import pytest
+import machine
+import snapshot
+from memory import PagedMemory, Region, MemoryFault, PAGE_SIZE
+
+MEMORY_MAP = [
+    Region('ram', 0x0000, 0x10000, 'ram'),
+    Region('rom', 0x10000, 0x11000, 'rom'),
+    Region('heap', 0x11000, 0x20000, 'ram'),
+]
+
+def test_rom_is_loaded_but_not_writable():
+    memory = PagedMemory(MEMORY_MAP)
+    memory.load_image(0x10000, [40, 2])
+    assert memory.load_word(0x10004) == 2
+    with pytest.raises(MemoryFault):
+        memory.store_word(0x10000, 1)
+    assert memory.load_word(0x10000) == 40
+
+def test_dump_covers_only_dirty_pages():
+    memory = PagedMemory(MEMORY_MAP)
+    memory.load_image(0x10000, [40, 2])
+    memory.load_image(0x12000, [7])
+    assert memory.items() == []
+    memory.store_word(0x11004, 5)
+    assert memory.dirty_pages() == [0x11]
+    assert len(memory.items()) == PAGE_SIZE // 4
+    assert memory.items()[1] == (0x11004, 5)
+    memory.clear_dirty()
+    memory.store_word(0x12000, 8)
+    assert [addr for addr, word in memory.items() if word] == [0x12000]
+
+def test_snapshot_keeps_clean_and_dirty_pages(tmp_path):
+    memory = PagedMemory(MEMORY_MAP)
+    memory.load_image(0x10000, [40, 2])
+    memory.store_word(0x11000, 5)
+    m = machine.Machine({0: 0x63}, memory)
+    snapshot.save(m, str(tmp_path / 'snap'))
+    resumed, offset = snapshot.load(str(tmp_path / 'snap'))
+    assert resumed.memory.dirty_pages() == [0x11]
+    assert resumed.memory.load_word(0x10004) == 2
+    assert resumed.memory_items() == m.memory_items()
+    with pytest.raises(MemoryFault):
+        resumed.memory.store_word(0x10000, 1)
@@ -0,0 +1,30 @@
+import encoder
+import harness
+import machine
+import profiler
+
+# a callee with a loop closed by j (jal zero) and a forward j, both stay inside the callee
+PROGRAM = """addi s0,zero,0
+jal ra,callee
+beq zero,zero,0
+callee: addi t0,zero,5
+loop: addi t0,t0,-1
+beq t0,zero,done
+j loop
+done: j out
+addi s0,s0,1
+out: jalr zero,ra,0
+"""
+CALLEE = 12
+
+def test_jumps_inside_a_function_stay_in_its_frame():
+    m = machine.Machine(machine.parse_program(encoder.to_text(harness.assemble(PROGRAM)).splitlines()))
+    prof = profiler.Profiler(m)
+    machine.run_until(m, profiler=prof)
+    assert m.exit_reason == machine.EXIT_HALT
+    stacks = dict(zip(prof.stacks, prof.stack_counts))
+    # addi t0 + 5 * (addi, beq) + 4 * j loop + j out + jalr
+    assert stacks[(0, CALLEE)] == 1 + 10 + 4 + 1 + 1
+    # addi s0, jal, then the halt after the return
+    assert stacks[(0,)] == 3
+    assert set(stacks) == {(0,), (0, CALLEE)}
@@ -0,0 +1,132 @@
+import random
+import pytest
+import harness
+import Assembler
+import linker
+
+SEED = 7
+
+@pytest.mark.parametrize('n', range(20))
+def test_fuzz_round_trip(n):
+    rng = random.Random(SEED + n)
+    text = harness.random_program(rng, rng.randint(1, 300))
+    assert harness.round_trip(text) is None
+
+
+# single instructions against their encodings
+@pytest.mark.parametrize('line, word', [
+    ("jal ra,-1024", "11000000000111111111000011101111"),
+    ("blt a4,a5,200", "00001100111101110100010001100011"),
+    ("add s1,s2,s3", "00000001001110010000010010110011"),
+    ("jalr ra,a5,-07", "11111111100101111000000011100111"),
+    ("lw a4,20(s1)", "00000001010001001010011100000011"),
+    ("sw ra,32(sp)", "00000010000100010010000000100011"),
+    ("auipc s2,-30", "11111111111111111111100100010111"),
+])
+def test_encode(line, word):
+    assert Assembler.encode(Assembler.tokenize_line(line)[1]) == (int(word, 2), None)
+
+
+# random edits of a source through update/insert/delete_line give what assembling the
+# edited source from scratch gives
+LABELS = ['a', 'b', 'c', 'd', 'buf']
+MACRO = [".macro twice x, y", "add \\x,\\x,\\y", "lp\\@: add \\x,\\x,\\y", "beq \\x,\\y,lp\\@", ".endm"]
+
+def random_line(rng):
+    label = lambda: rng.choice(LABELS)
+    prefix = label() + ": " if rng.random() < 0.2 else ""
+    return prefix + rng.choice([
+        "add a0,a1,a2", f"beq a0,a1,{label()}", f"jal ra,{label()}", f"li t0,{rng.choice([5, -3, 4096, 0x12345678, -70000])}",
+        f"la a0,{label()}", f"j {label()}", "ret", "nop", f"bgt a0,a1,{label()}", ".data", ".text", f".word 1,{label()},0x20",
+        f"lui a0,%hi({label()})", f"addi a0,a0,%lo({label()})", "twice a0,a1", "", "beq zero,zero,0", f"call {label()}",
+        ".space 8", f"addi a0,zero,{label()}", "bogus a0", "# comment",
+    ])
+
+def summary(result):
+    return result.words, result.labels, [(d.line, d.message) for d in result.diagnostics], list(result.data)
+
+@pytest.mark.parametrize('seed', range(4))
+def test_incremental_edits(seed):
+    rng = random.Random(seed)
+    for trial in range(40):
+        source = [random_line(rng) for _ in range(rng.randint(0, 25))]
+        at = rng.randint(0, len(source))
+        source[at:at] = MACRO
+        asm = Assembler.Assembler()
+        asm.assemble_lines(list(source))
+        for edit in range(10):
+            op = rng.random()
+            if op < 0.4 and source:
+                n = rng.randint(1, len(source))
+                source[n - 1] = text = random_line(rng)
+                result = asm.update_line(n, text)
+            elif op < 0.7:
+                n = rng.randint(1, len(source) + 1)
+                source.insert(n - 1, random_line(rng))
+                result = asm.insert_line(n, source[n - 1])
+            elif source:
+                n = rng.randint(1, len(source))
+                source.pop(n - 1)
+                result = asm.delete_line(n)
+            else:
+                continue
+            assert summary(result) == summary(Assembler.Assembler().assemble_lines(list(source)))
+
+
+def test_pseudo_instructions_and_data():
+    result = Assembler.Assembler().assemble("\n".join([
+        "li t0, 0x12345678",
+        "la a0, table",
+        "lw a1, 4(a0)",
+        "call double",
+        "beq zero,zero,0",
+        "double: add a1, a1, a1",
+        "ret",
+        ".data",
+        "table: .word 1, 21",
+    ]))
+    assert result.diagnostics == []
+    assert list(result.data) == [1, 21]
+    assert result.labels['table'] == Assembler.DATA_BASE
+
+def test_link_matches_direct_assembly():
+    rng = random.Random(SEED)
+    text = harness.random_program(rng, 200)
+    obj, diagnostics = linker.assemble_object(text, 'random.s')
+    assert diagnostics == []
+    assert linker.link([obj]).words == Assembler.Assembler().assemble(text).words
+
+def test_link_resolves_globals_across_files():
+    main, _ = linker.assemble_object(".globl start\nstart: call twice\nla t0, value\nlw t1, 0(t0)\nbeq zero,zero,0\n", 'main.s')
+    lib, _ = linker.assemble_object(".globl twice, value\ntwice: add a0, a0, a0\nret\n.data\nvalue: .word twice\n", 'lib.s')
+    result = linker.link([main, lib])
+    assert result.diagnostics == []
+    assert result.labels == {'start': 0, 'twice': 4 * len(main['text']), 'value': Assembler.DATA_BASE}
+    assert list(result.data) == [4 * len(main['text'])]
+
+# a name in a register position is a register typo, not a symbol of another file
+@pytest.mark.parametrize('text', ["addi a9,zero,1\n", "lw a9,value(s1)\n", "beq a9,zero,far\n", "sw t0,x(a9)\n"])
+def test_object_reports_invalid_registers_by_name(text):
+    obj, diagnostics = linker.assemble_object(text, 't.s')
+    assert [d.message for d in diagnostics] == ["Invalid Register 'a9'"]
+
+def test_link_reports_undefined_and_duplicate_labels():
+    main, _ = linker.assemble_object(".globl f\nf: call missing\nbeq zero,zero,0\n", 'main.s')
+    other, _ = linker.assemble_object(".globl f\nf: nop\n", 'other.s')
+    messages = [d.message for d in linker.link([main, other]).diagnostics]
+    assert "Duplicate Label 'f'" in messages
+    assert "Undefined Label 'missing'" in messages
+
+
+def test_image_program_keys():
+    import image
+    program = image.ImageProgram([1, 2, 3], 8, 8, [])
+    assert len(program) == 3 and list(program) == [8, 12, 16]
+    assert program.get(12) == 2 and program.get(20) is None and 4 not in program
+    program[0] = 7
+    program[12] = 9
+    program[40] = 5
+    assert len(program) == 5
+    assert program.keys() == [0, 8, 12, 16, 40]
+    assert program.items() == [(0, 7), (8, 1), (12, 9), (16, 3), (40, 5)]
+    assert max(program) == 40
@@ -0,0 +1,51 @@
+import pytest
+import Assembler
+import machine
+from memory import PagedMemory
+from timetravel import TimeTravel
+
+SOURCE = """lui s0,16
+sw zero,0(s0)
+addi t0,zero,5
+sw t0,4(s0)
+lui s1,32
+sw t0,0(s1)
+sw t0,8(s0)
+beq zero,zero,0
+"""
+
+def new_machine(paged):
+    memory = None
+    if paged:
+        memory = PagedMemory()
+        memory.load_image(0x20000, [7]) # a clean page the program stores to
+    return machine.Machine(Assembler.program_memory(Assembler.Assembler().assemble(SOURCE)), memory)
+
+def state(m):
+    return m.pc, list(m.regs), m.memory_lines(), m.fingerprint()
+
+# stepping back to a step gives the state the machine had there, memory dump included
+# with a short log the older steps are replayed from keyframes
+@pytest.mark.parametrize('paged', [False, True])
+@pytest.mark.parametrize('capacity', [3, 1 << 10])
+def test_step_back_restores_every_step(paged, capacity):
+    m = new_machine(paged)
+    tt = TimeTravel(m, capacity, keyframe_interval=2)
+    states = [state(m)]
+    while tt.step():
+        states.append(state(m))
+    assert len(states) == 8
+    for step in reversed(range(len(states))):
+        tt.goto(step)
+        assert state(m) == states[step]
+    if paged:
+        assert m.memory_lines() == [] and sorted(m.memory.pages) == [0x20]
+
+def test_step_back_over_the_first_store_to_a_page():
+    m = new_machine(True)
+    tt = TimeTravel(m)
+    tt.step()
+    tt.step()
+    assert len(m.memory_lines()) == 1024
+    tt.step_back(2)
+    assert m.memory_lines() == []
@@ -0,0 +1,36 @@
+import pytest
+import encoder
+import harness
+import machine
+import translator
+
+def load(source):
+    return machine.Machine(machine.parse_program(encoder.to_text(harness.assemble(source)).splitlines()))
+
+# an interrupt part way through a block without loads or stores stops at the instruction
+# it interrupted, with the instructions before it counted and their registers written back
+def test_interrupt_inside_a_block(monkeypatch):
+    def interrupted(value):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(translator, 'reverse_bits', interrupted)
+    m = load("addi a0,zero,1\naddi a1,zero,2\nrvrs a2,a0\naddi a3,zero,3\nbeq zero,zero,0\n")
+    with pytest.raises(KeyboardInterrupt):
+        translator.translator_for(m).run()
+    assert (m.pc, m.steps) == (8, 2)
+    assert (m.regs[10], m.regs[11], m.regs[13]) == (1, 2, 0)
+
+def test_fault_in_a_load_matches_the_interpreter():
+    source = "addi a0,zero,1\naddi a1,zero,3\nlw a2,0(a1)\naddi a3,zero,3\nbeq zero,zero,0\n"
+    expected = load(source)
+    with pytest.raises(Exception):
+        expected.run()
+    m = load(source)
+    with pytest.raises(Exception):
+        translator.translator_for(m).run()
+    assert (m.pc, m.steps, list(m.regs)) == (expected.pc, expected.steps, list(expected.regs))
+
+def test_one_code_write_hook_per_machine():
+    m = load(harness.LOOP_PROGRAM.format(upper=0, lower=50))
+    for n in range(5):
+        machine.run_until(m, jit=True, max_steps=100)
+    assert len(m.code_write_hooks) == 1